@@ -0,0 +1,183 @@
+from typing import Iterator, List, Optional, Tuple
+
+import itertools
+
+from .Molecule import Molecule
+
+import numpy as np
+from numpy.typing import ArrayLike
+
+""" Kernels for comparing geometries. Geometries are given as Molecule, (nAtoms, 3) arrays or stacks of
+    frames (nFrames, nAtoms, 3) (lists of Molecules are stacked automatically). Large intermediates are
+    processed in blocks (along all axes of the result) of at most maxChunkElements floating point numbers to
+    keep memory bounded. The only exception is a single pair of frames in the pairwise kernels whose
+    intermediates alone exceed maxChunkElements, which is processed at once. """
+
+# Upper bound for the number of elements of intermediate arrays (2^24 doubles = 128 MiB)
+maxChunkElements = 2**24
+
+
+def _asCoordinates(geometry: Molecule | List[Molecule] | ArrayLike) -> np.ndarray:
+    if isinstance(geometry, Molecule):
+        return geometry.coordinates()
+    if isinstance(geometry, list) and len(geometry) > 0 and isinstance(geometry[0], Molecule):
+        return np.stack([molecule.coordinates() for molecule in geometry])
+
+    coordinates = np.asarray(geometry, dtype=float)
+    assert coordinates.shape[-1] == 3
+
+    return coordinates
+
+
+def _blocks(shape: Tuple[int, ...], elementsPerItem: int) -> Iterator[Tuple[slice, ...]]:
+    """Splits an array of the given shape into blocks, such that every block has at most maxChunkElements
+    elements if each of its items requires elementsPerItem elements (or a single item if that is more).
+    The last axes are kept whole as far as possible"""
+    steps = []
+    budget = max(1, maxChunkElements // max(1, elementsPerItem))
+    for n in reversed(shape):
+        step = max(1, min(n, budget))
+        steps.append(step)
+        budget = max(1, budget // step)
+    steps.reverse()
+
+    ranges = [range(0, n, step) for n, step in zip(shape, steps)]
+    for starts in itertools.product(*ranges):
+        yield tuple(slice(start, start + step) for start, step in zip(starts, steps))
+
+
+def distanceMatrix(
+    geometry: Molecule | List[Molecule] | ArrayLike,
+    other: Optional[Molecule | List[Molecule] | ArrayLike] = None,
+) -> np.ndarray:
+    """Computes the matrix of distances between all atoms of geometry and all atoms of other (geometry
+    itself if not given). For stacks of frames, an array of shape (nFrames, nAtoms, nAtomsOther) is
+    returned"""
+    a = _asCoordinates(geometry)
+    b = a if other is None else _asCoordinates(other)
+
+    frameShape = np.broadcast_shapes(a.shape[:-2], b.shape[:-2])
+    nFrames = int(np.prod(frameShape, dtype=int))
+    distances = np.empty((nFrames, a.shape[-2], b.shape[-2]))
+
+    # Flat stacks of frames (views unless frames of different shapes have to be merged)
+    a = np.broadcast_to(a, frameShape + a.shape[-2:]).reshape((nFrames,) + a.shape[-2:])
+    b = np.broadcast_to(b, frameShape + b.shape[-2:]).reshape((nFrames,) + b.shape[-2:])
+
+    # Blocks of (frames, rows, columns) such that the differences (3 per entry) stay bounded
+    for frames, rows, cols in _blocks(distances.shape, 3):
+        diff = a[frames, rows, np.newaxis, :] - b[frames, np.newaxis, cols, :]
+        distances[frames, rows, cols] = np.sqrt(np.einsum("...k,...k->...", diff, diff))
+
+    return distances.reshape(frameShape + distances.shape[-2:])
+
+
+def _kabschRotations(a: np.ndarray, b: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """Rotations R (..., 3, 3) minimizing sum_i w_i |R a_i - b_i|^2 for centered a and b"""
+    H = np.einsum("...ni,n,...nj->...ij", a, weights, b)
+    U, _, Vt = np.linalg.svd(H)
+    # Avoid improper rotations
+    d = np.sign(np.linalg.det(np.matmul(U, Vt)))
+    D = np.zeros(d.shape + (3, 3))
+    D[..., 0, 0] = 1
+    D[..., 1, 1] = 1
+    D[..., 2, 2] = d
+    return np.matmul(np.swapaxes(Vt, -1, -2), np.matmul(D, np.swapaxes(U, -1, -2)))
+
+
+def rmsd(
+    geometry: Molecule | List[Molecule] | ArrayLike,
+    other: Molecule | List[Molecule] | ArrayLike,
+    masses: Optional[ArrayLike] = None,
+    align: bool = False,
+) -> np.ndarray:
+    """Computes the (optionally mass-weighted) root-mean-square deviation between corresponding atoms of
+    the given geometries (or stacks of geometries, which are broadcast against each other). If align is
+    set, the geometries are optimally superimposed (translation and rotation) first"""
+    a = _asCoordinates(geometry)
+    b = _asCoordinates(other)
+    nAtoms = a.shape[-2]
+    assert b.shape[-2] == nAtoms
+
+    weights = np.ones(nAtoms) if masses is None else np.asarray(masses, dtype=float)
+    weights = weights / np.sum(weights)
+
+    if align:
+        a = a - np.einsum("n,...ni->...i", weights, a)[..., np.newaxis, :]
+        b = b - np.einsum("n,...ni->...i", weights, b)[..., np.newaxis, :]
+        R = _kabschRotations(a, b, weights)
+        a = np.matmul(a, np.swapaxes(R, -1, -2))
+
+    diff = a - b
+
+    return np.sqrt(np.einsum("n,...ni,...ni->...", weights, diff, diff))
+
+
+def maxDeviation(
+    geometry: Molecule | List[Molecule] | ArrayLike,
+    other: Molecule | List[Molecule] | ArrayLike,
+) -> np.ndarray:
+    """Computes the largest displacement of any atom between the given geometries (or stacks of geometries)"""
+    diff = _asCoordinates(geometry) - _asCoordinates(other)
+
+    return np.max(np.sqrt(np.einsum("...k,...k->...", diff, diff)), axis=-1)
+
+
+def pairwiseRMSD(
+    frames: List[Molecule] | ArrayLike,
+    otherFrames: Optional[List[Molecule] | ArrayLike] = None,
+    masses: Optional[ArrayLike] = None,
+    align: bool = False,
+) -> np.ndarray:
+    """Computes the RMSD (see rmsd) between all pairs of frames of the two stacks (or of the given stack
+    with itself). Returns an array of shape (nFrames, nFramesOther)"""
+    a = _asCoordinates(frames)
+    b = a if otherFrames is None else _asCoordinates(otherFrames)
+    nAtoms = a.shape[-2]
+
+    weights = np.ones(nAtoms) if masses is None else np.asarray(masses, dtype=float)
+    weights = weights / np.sum(weights)
+
+    if align:
+        a = a - np.einsum("n,fni->fi", weights, a)[:, np.newaxis, :]
+        b = b - np.einsum("n,fni->fi", weights, b)[:, np.newaxis, :]
+
+    result = np.empty((a.shape[0], b.shape[0]))
+
+    # Differences are formed explicitly (instead of expanding |a - b|^2) to stay accurate for
+    # (nearly) identical frames, which is what tolerance-based comparisons care about
+    # (the rotated copies of a and the differences take 3 * nAtoms elements per pair each)
+    for rows, cols in _blocks(result.shape, 6 * nAtoms):
+        chunk = a[rows, np.newaxis]
+        if align:
+            R = _kabschRotations(chunk, b[np.newaxis, cols], weights)
+            chunk = np.matmul(chunk, np.swapaxes(R, -1, -2))
+        diff = chunk - b[np.newaxis, cols]
+        result[rows, cols] = np.einsum("n,fgni,fgni->fg", weights, diff, diff)
+
+    return np.sqrt(result)
+
+
+def pairwiseMaxDeviation(
+    frames: List[Molecule] | ArrayLike,
+    otherFrames: Optional[List[Molecule] | ArrayLike] = None,
+) -> np.ndarray:
+    """Computes the maximum atomic deviation (see maxDeviation) between all pairs of frames of the two stacks
+    (or of the given stack with itself). Returns an array of shape (nFrames, nFramesOther)"""
+    a = _asCoordinates(frames)
+    b = a if otherFrames is None else _asCoordinates(otherFrames)
+
+    result = np.empty((a.shape[0], b.shape[0]))
+
+    for rows, cols in _blocks(result.shape, 4 * b.shape[1]):
+        diff = a[rows, np.newaxis] - b[np.newaxis, cols]
+        result[rows, cols] = np.max(np.einsum("fgnk,fgnk->fgn", diff, diff), axis=-1)
+
+    return np.sqrt(result)
+
+
+def sameGeometry(
+    geometry: Molecule | ArrayLike, other: Molecule | ArrayLike, tolerance: float = 1e-6
+) -> bool:
+    """Checks whether no atom deviates by more than tolerance between the two geometries"""
+    return bool(maxDeviation(geometry, other) <= tolerance)
@@ -0,0 +1,57 @@
+from typing import Tuple
+
+from .Element import ElementCovalentRadiusTable
+
+import numpy as np
+from numpy.typing import ArrayLike
+from scipy.spatial import KDTree
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+# Two atoms are considered bonded, if their distance is below this factor times the sum of their covalent radii
+defaultBondTolerance = 1.2
+
+
+def findBonds(
+    atomicNumbers: ArrayLike, coordinates: ArrayLike, tolerance: float = defaultBondTolerance
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Determines all bonded atom pairs based on covalent radii. Candidate pairs are found via a KD-tree
+    using the largest possible bond length as cutoff, such that the cost scales linearly with the number
+    of atoms (for reasonable geometries). Atoms without known covalent radius never form bonds.
+    Returns an (nBonds, 2) array of atom indices (i < j) and the corresponding bond lengths"""
+    atomicNumbers = np.asarray(atomicNumbers, dtype=int)
+    coordinates = np.asarray(coordinates, dtype=float)
+
+    radii = ElementCovalentRadiusTable[atomicNumbers]
+
+    if len(atomicNumbers) < 2 or np.all(np.isnan(radii)):
+        return np.zeros((0, 2), dtype=int), np.zeros(0)
+
+    cutoff = 2 * tolerance * np.nanmax(radii)
+
+    pairs = KDTree(coordinates).query_pairs(r=cutoff, output_type="ndarray")
+    pairs = np.sort(pairs.reshape((-1, 2)), axis=1)
+
+    distances = np.linalg.norm(coordinates[pairs[:, 0]] - coordinates[pairs[:, 1]], axis=1)
+    bonded = distances < tolerance * (radii[pairs[:, 0]] + radii[pairs[:, 1]])
+
+    pairs = pairs[bonded]
+    distances = distances[bonded]
+
+    order = np.lexsort((pairs[:, 1], pairs[:, 0]))
+
+    return pairs[order], distances[order]
+
+
+def bondGraph(bonds: np.ndarray, lengths: np.ndarray, nAtoms: int) -> csr_matrix:
+    """Builds the symmetric, sparse adjacency matrix of the given bonds. The stored values are the bond lengths"""
+    rows = np.concatenate((bonds[:, 0], bonds[:, 1]))
+    cols = np.concatenate((bonds[:, 1], bonds[:, 0]))
+
+    return csr_matrix((np.concatenate((lengths, lengths)), (rows, cols)), shape=(nAtoms, nAtoms))
+
+
+def findFragments(graph: csr_matrix) -> Tuple[int, np.ndarray]:
+    """Determines the connected fragments of the given bond graph. Returns the number of fragments and
+    the fragment index of every atom"""
+    return connected_components(graph, directed=False)
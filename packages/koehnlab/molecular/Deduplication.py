@@ -0,0 +1,66 @@
+from typing import Dict, List, Tuple
+
+import bisect
+
+from .Molecule import Molecule
+
+import numpy as np
+from scipy.spatial.distance import pdist
+
+
+def _distanceKey(molecule: Molecule, permutationInvariant: bool) -> Tuple[bytes, np.ndarray]:
+    """Returns the composition of the molecule (as bytes) and its interatomic distances. The distances are
+    sorted by the element pair and length if permutationInvariant is set"""
+    atomicNumbers = molecule.atomicNumbers()
+    distances = pdist(molecule.coordinates())
+
+    if not permutationInvariant:
+        return atomicNumbers.astype(np.int64).tobytes(), distances
+
+    # pdist returns the upper triangle of the distance matrix in row-major order
+    rows, cols = np.triu_indices(molecule.nAtoms(), k=1)
+    Zi = np.minimum(atomicNumbers[rows], atomicNumbers[cols])
+    Zj = np.maximum(atomicNumbers[rows], atomicNumbers[cols])
+    order = np.lexsort((distances, Zj, Zi))
+
+    return np.sort(atomicNumbers).astype(np.int64).tobytes(), distances[order]
+
+
+def findDuplicateGeometries(
+    molecules: List[Molecule], tolerance: float = 1e-3, permutationInvariant: bool = False
+) -> np.ndarray:
+    """Finds geometries that are identical up to translations, rotations and reflections (and the order of
+    the atoms if permutationInvariant is set), i.e. whose interatomic distances all agree to within
+    tolerance. Returns for every molecule the index of the first molecule with the same geometry (its own
+    index if it is the first one of its kind).
+    Unlike comparing fingerprints (see Molecule.fingerprint), this doesn't depend on where the distances
+    lie relative to rounding boundaries: molecules are grouped by their composition and, within a group,
+    sorted by the norm of their distance vector. Two geometries can only be the same if their norms differ
+    by at most sqrt(nPairs) * tolerance, so only these candidates are compared explicitly"""
+    # per composition: sorted norms and the indices and distances of the original geometries
+    groups: Dict[bytes, Tuple[List[float], List[int], List[np.ndarray]]] = {}
+    original = np.zeros(len(molecules), dtype=int)
+
+    for idx, molecule in enumerate(molecules):
+        composition, distances = _distanceKey(molecule, permutationInvariant)
+        norm = float(np.linalg.norm(distances))
+        window = np.sqrt(len(distances)) * tolerance
+        norms, indices, candidates = groups.setdefault(composition, ([], [], []))
+
+        matches = [
+            indices[k]
+            for k in range(bisect.bisect_left(norms, norm - window), bisect.bisect_right(norms, norm + window))
+            if np.max(np.abs(candidates[k] - distances), initial=0.0) <= tolerance
+        ]
+
+        if matches:
+            original[idx] = min(matches)
+            continue
+
+        original[idx] = idx
+        position = bisect.bisect_left(norms, norm)
+        norms.insert(position, norm)
+        indices.insert(position, idx)
+        candidates.insert(position, distances)
+
+    return original
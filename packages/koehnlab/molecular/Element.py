@@ -1,7 +1,12 @@
-from typing import Optional
+from typing import Dict, Optional
 
 from enum import Enum
 
+import re
+
+import numpy as np
+from numpy.typing import ArrayLike
+
 
 class Element(Enum):
     """Enumeration listing all known elements"""
@@ -272,6 +277,10 @@ class Element(Enum):
         """Gets the block to which this element belongs to. This is one of "s", "p", "d" or "f"."""
         return ElementBlocks[self]
 
+    def covalentRadius(self) -> Optional[float]:
+        """Gets the covalent radius of this element (in Angstrom) or None if it is not known"""
+        return ElementCovalentRadii.get(self)
+
 
 ElementNames = {
     Element.H: "Hydrogen",
@@ -884,3 +893,163 @@ ElementBlocks = {
     Element.Ts: "p",
     Element.Og: "p",
 }
+
+
+# Covalent radii (in Angstrom) as given in
+#   Cordero et al., Dalton Trans. 2008, 2832. https://doi.org/10.1039/B801115J
+# For Mn, Fe and Co the low-spin values are used. No values are available beyond Cm.
+ElementCovalentRadii = {
+    Element.H: 0.31,
+    Element.He: 0.28,
+    Element.Li: 1.28,
+    Element.Be: 0.96,
+    Element.B: 0.84,
+    Element.C: 0.76,
+    Element.N: 0.71,
+    Element.O: 0.66,
+    Element.F: 0.57,
+    Element.Ne: 0.58,
+    Element.Na: 1.66,
+    Element.Mg: 1.41,
+    Element.Al: 1.21,
+    Element.Si: 1.11,
+    Element.P: 1.07,
+    Element.S: 1.05,
+    Element.Cl: 1.02,
+    Element.Ar: 1.06,
+    Element.K: 2.03,
+    Element.Ca: 1.76,
+    Element.Sc: 1.70,
+    Element.Ti: 1.60,
+    Element.V: 1.53,
+    Element.Cr: 1.39,
+    Element.Mn: 1.39,
+    Element.Fe: 1.32,
+    Element.Co: 1.26,
+    Element.Ni: 1.24,
+    Element.Cu: 1.32,
+    Element.Zn: 1.22,
+    Element.Ga: 1.22,
+    Element.Ge: 1.20,
+    Element.As: 1.19,
+    Element.Se: 1.20,
+    Element.Br: 1.20,
+    Element.Kr: 1.16,
+    Element.Rb: 2.20,
+    Element.Sr: 1.95,
+    Element.Y: 1.90,
+    Element.Zr: 1.75,
+    Element.Nb: 1.64,
+    Element.Mo: 1.54,
+    Element.Tc: 1.47,
+    Element.Ru: 1.46,
+    Element.Rh: 1.42,
+    Element.Pd: 1.39,
+    Element.Ag: 1.45,
+    Element.Cd: 1.44,
+    Element.In: 1.42,
+    Element.Sn: 1.39,
+    Element.Sb: 1.39,
+    Element.Te: 1.38,
+    Element.I: 1.39,
+    Element.Xe: 1.40,
+    Element.Cs: 2.44,
+    Element.Ba: 2.15,
+    Element.La: 2.07,
+    Element.Ce: 2.04,
+    Element.Pr: 2.03,
+    Element.Nd: 2.01,
+    Element.Pm: 1.99,
+    Element.Sm: 1.98,
+    Element.Eu: 1.98,
+    Element.Gd: 1.96,
+    Element.Tb: 1.94,
+    Element.Dy: 1.92,
+    Element.Ho: 1.92,
+    Element.Er: 1.89,
+    Element.Tm: 1.90,
+    Element.Yb: 1.87,
+    Element.Lu: 1.87,
+    Element.Hf: 1.75,
+    Element.Ta: 1.70,
+    Element.W: 1.62,
+    Element.Re: 1.51,
+    Element.Os: 1.44,
+    Element.Ir: 1.41,
+    Element.Pt: 1.36,
+    Element.Au: 1.36,
+    Element.Hg: 1.32,
+    Element.Tl: 1.45,
+    Element.Pb: 1.46,
+    Element.Bi: 1.48,
+    Element.Po: 1.40,
+    Element.At: 1.50,
+    Element.Rn: 1.50,
+    Element.Fr: 2.60,
+    Element.Ra: 2.21,
+    Element.Ac: 2.15,
+    Element.Th: 2.06,
+    Element.Pa: 2.00,
+    Element.U: 1.96,
+    Element.Np: 1.90,
+    Element.Pu: 1.87,
+    Element.Am: 1.80,
+    Element.Cm: 1.69,
+}
+
+
+# Element properties as contiguous arrays indexed by atomic number. Index 0 doesn't correspond to
+# any element and holds a placeholder entry. This allows looking up properties of many atoms at once
+# via fancy indexing, e.g. ElementMassTable[atomicNumbers]
+MaxAtomicNumber = max(element.value for element in Element)
+
+# Encoding of the element blocks in ElementBlockTable (index into this list)
+BlockCodes = ["s", "p", "d", "f"]
+
+ElementSymbolTable = np.array([""] + [Element(Z).symbol() for Z in range(1, MaxAtomicNumber + 1)])
+ElementMassTable = np.array([np.nan] + [ElementMasses[Element(Z)] for Z in range(1, MaxAtomicNumber + 1)])
+# f-block elements (group None) are assigned group 0
+ElementGroupTable = np.array(
+    [0] + [ElementGroups[Element(Z)] or 0 for Z in range(1, MaxAtomicNumber + 1)], dtype=int
+)
+ElementPeriodTable = np.array(
+    [0] + [ElementPeriods[Element(Z)] for Z in range(1, MaxAtomicNumber + 1)], dtype=int
+)
+# Elements without known covalent radius are assigned NaN
+ElementCovalentRadiusTable = np.array(
+    [np.nan]
+    + [ElementCovalentRadii.get(Element(Z), np.nan) for Z in range(1, MaxAtomicNumber + 1)]
+)
+ElementBlockTable = np.array(
+    [-1] + [BlockCodes.index(ElementBlocks[Element(Z)]) for Z in range(1, MaxAtomicNumber + 1)],
+    dtype=int,
+)
+
+# Lower-case symbols and full names mapped to atomic numbers
+_lowerCaseNames: Dict[str, int] = {
+    name.lower(): member.value for name, member in Element.__members__.items()
+}
+
+# Leading element name of labels such as "C12" or "Fe_1" (as used by e.g. Molpro)
+_labelPattern = re.compile(r"^\s*([A-Za-z]+)")
+
+
+def atomicNumberFromLabel(label: str) -> int:
+    """Gets the atomic number for the given atom label. Labels are matched case-insensitively
+    against element symbols and full names and may carry a numeric suffix (e.g. "C12" or "FE1")"""
+    match = _labelPattern.match(label)
+
+    if match is None or match.group(1).lower() not in _lowerCaseNames:
+        raise KeyError("Unknown element label '%s'" % label)
+
+    return _lowerCaseNames[match.group(1).lower()]
+
+
+def symbolsToAtomicNumbers(labels: ArrayLike) -> np.ndarray:
+    """Maps an array of atom labels (see atomicNumberFromLabel) to an array of atomic numbers.
+    Every distinct label is only parsed once"""
+    uniqueLabels, inverse = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+
+    lookup = np.array([atomicNumberFromLabel(label) for label in uniqueLabels], dtype=int)
+
+    return lookup[inverse].reshape(np.shape(labels))
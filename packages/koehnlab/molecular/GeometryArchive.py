@@ -0,0 +1,170 @@
+from typing import Iterable, Iterator, List, Optional
+
+from .Molecule import Molecule
+
+import numpy as np
+
+import h5py
+
+
+class GeometryArchive:
+    """Compact binary (HDF5) storage for a sequence of molecular geometries (frames), e.g. the
+    frames of a trajectory or a set of displaced geometries. Frames may differ in their number of
+    atoms. Next to the atomic numbers and coordinates, every frame can carry an energy and a label.
+    New frames can only be appended; existing frames can be accessed in any order.
+
+    Usage:
+        with GeometryArchive("geometries.h5", "w") as archive:
+            archive.append(molecule, energy=-1.5, label="eq")
+        with GeometryArchive("geometries.h5") as archive:
+            molecule = archive[0]
+    """
+
+    def __init__(self, path: str, mode: str = "r"):
+        """Opens the archive at the given path. Mode is one of "r" (read-only), "a" (append to
+        existing archive or create a new one) or "w" (create a new archive, truncating existing ones)
+        """
+        if mode not in ["r", "a", "w"]:
+            raise RuntimeError("Unsupported archive mode '%s'" % mode)
+
+        self.file = h5py.File(path, mode)
+
+        if "offsets" not in self.file:
+            if mode == "r":
+                raise RuntimeError("'%s' is not a geometry archive" % path)
+
+            self.file.create_dataset(
+                "offsets", data=np.zeros(1, dtype=np.int64), maxshape=(None,), chunks=True
+            )
+            self.file.create_dataset(
+                "atomic numbers", shape=(0,), dtype=np.int16, maxshape=(None,), chunks=(4096,)
+            )
+            self.file.create_dataset(
+                "coordinates", shape=(0, 3), dtype=float, maxshape=(None, 3), chunks=(4096, 3)
+            )
+            self.file.create_dataset(
+                "energies", shape=(0,), dtype=float, maxshape=(None,), chunks=True
+            )
+            self.file.create_dataset(
+                "labels",
+                shape=(0,),
+                dtype=h5py.string_dtype(),
+                maxshape=(None,),
+                chunks=True,
+            )
+
+        # The frame offsets are small and needed for every access, so we keep a copy in memory
+        self._offsets: np.ndarray = np.array(self.file["offsets"][:])  # type: ignore
+
+        if mode != "r":
+            # Drop rows left behind by an interrupted extend (written before the offsets were)
+            self._truncate("atomic numbers", self._offsets[-1])
+            self._truncate("coordinates", self._offsets[-1])
+            self._truncate("energies", len(self))
+            self._truncate("labels", len(self))
+
+    def __enter__(self) -> "GeometryArchive":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Closes the underlying file"""
+        self.file.close()
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def _frameIndex(self, idx: int) -> int:
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("Frame index %d out of range" % idx)
+        return idx
+
+    def __getitem__(self, idx: int) -> Molecule:
+        idx = self._frameIndex(idx)
+        start, end = self._offsets[idx], self._offsets[idx + 1]
+
+        return Molecule.fromArrays(
+            atomicNumbers=self.file["atomic numbers"][start:end],  # type: ignore
+            coordinates=self.file["coordinates"][start:end],  # type: ignore
+        )
+
+    def __iter__(self) -> Iterator[Molecule]:
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def energy(self, idx: int) -> Optional[float]:
+        """Gets the energy stored for the given frame (None if no energy was stored)"""
+        energy = float(self.file["energies"][self._frameIndex(idx)])  # type: ignore
+        return None if np.isnan(energy) else energy
+
+    def energies(self) -> np.ndarray:
+        """Gets the energies of all frames (NaN for frames without energy)"""
+        return np.array(self.file["energies"][: len(self)])  # type: ignore
+
+    def label(self, idx: int) -> str:
+        """Gets the label stored for the given frame (empty if no label was stored)"""
+        return self.file["labels"].asstr()[self._frameIndex(idx)]  # type: ignore
+
+    def labels(self) -> List[str]:
+        """Gets the labels of all frames"""
+        return list(self.file["labels"].asstr()[: len(self)])  # type: ignore
+
+    def append(
+        self, molecule: Molecule, energy: Optional[float] = None, label: str = ""
+    ) -> None:
+        """Appends the given molecule as a new frame to the end of the archive"""
+        self.extend([molecule], energies=[energy], labels=[label])
+
+    def extend(
+        self,
+        molecules: Iterable[Molecule],
+        energies: Optional[Iterable[Optional[float]]] = None,
+        labels: Optional[Iterable[str]] = None,
+    ) -> None:
+        """Appends all given molecules (and optionally their energies and labels) as new frames. This
+        is considerably cheaper than appending the frames one by one"""
+        molecules = list(molecules)
+        nFrames = len(molecules)
+
+        if nFrames == 0:
+            return
+
+        energyList = [np.nan] * nFrames if energies is None else list(energies)
+        labelList = [""] * nFrames if labels is None else list(labels)
+
+        assert len(energyList) == nFrames
+        assert len(labelList) == nFrames
+
+        atomicNumbers = np.concatenate([m.atomicNumbers() for m in molecules])
+        coordinates = np.concatenate([m.coordinates() for m in molecules])
+        offsets = self._offsets[-1] + np.cumsum([m.nAtoms() for m in molecules])
+
+        # Everything is written at the positions given by the offsets, such that rows left behind by
+        # an interrupted write are overwritten
+        self._writeAt("atomic numbers", self._offsets[-1], atomicNumbers)
+        self._writeAt("coordinates", self._offsets[-1], coordinates)
+        self._writeAt(
+            "energies",
+            len(self),
+            np.array([np.nan if e is None else e for e in energyList], dtype=float),
+        )
+        self._writeAt("labels", len(self), np.array(labelList, dtype=object))
+        # Offsets are written last such that an interrupted write doesn't produce a corrupt frame
+        self._writeAt("offsets", len(self._offsets), offsets)
+
+        self._offsets = np.concatenate((self._offsets, offsets))
+
+    def _writeAt(self, name: str, start: int, data: np.ndarray) -> None:
+        """Writes data to the given dataset starting at row start and truncates it after the data"""
+        dataset: h5py.Dataset = self.file[name]  # type: ignore
+        dataset.resize(start + data.shape[0], axis=0)
+        dataset[start:] = data
+
+    def _truncate(self, name: str, size: int) -> None:
+        dataset: h5py.Dataset = self.file[name]  # type: ignore
+        if dataset.shape[0] > size:
+            dataset.resize(size, axis=0)
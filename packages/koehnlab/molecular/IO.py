@@ -1,71 +1,210 @@
+from typing import IO, Iterable, List, Optional
+
 from enum import Enum
 
+import gzip
+import itertools
+
 from .Molecule import Molecule
-from .Atom import Atom
-from .Element import Element
+from .Element import symbolsToAtomicNumbers, ElementSymbolTable
+from .GeometryArchive import GeometryArchive
 
 import numpy as np
 
 
 class FileFormat(Enum):
     XYZ = 0
+    HDF5 = 1
+    TURBOMOLE = 2
 
 
-def readMolecule(path: str, fmt: FileFormat = FileFormat.XYZ) -> Molecule:
-    """Reads a molecule in the given format from the given path on the filesystem"""
-    if fmt != FileFormat.XYZ:
-        raise RuntimeError("Unsupported file format %s" % str(fmt))
+# https://physics.nist.gov/cgi-bin/cuu/Value?bohrrada0
+bohrToAngstrom = 0.529177210903
+
+
+def guessFileFormat(path: str) -> FileFormat:
+    """Guesses the format of the given geometry file from its extension (.xyz, .xyz.gz, .h5, .hdf5).
+    Files without a known extension are considered to be turbomole coord files"""
+    if path.endswith(".xyz") or path.endswith(".xyz.gz"):
+        return FileFormat.XYZ
+    if path.endswith(".h5") or path.endswith(".hdf5"):
+        return FileFormat.HDF5
+
+    return FileFormat.TURBOMOLE
+
+
+def _openText(path: str, mode: str = "r") -> IO[str]:
+    """Opens the given file in text mode, transparently (de)compressing files ending in .gz"""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t")  # type: ignore
+
+    return open(path, mode)
+
+
+def _readXYZFrame(inputFile: IO[str], path: str) -> Optional[Molecule]:
+    """Reads a single XYZ frame from the given stream. Returns None if the stream is exhausted"""
+    header = inputFile.readline()
+
+    if not header.strip():
+        return None
+
+    nAtoms = int(header)
+
+    # second line is only the comment, which we don't care about
+    inputFile.readline()
+
+    lines = list(itertools.islice(inputFile, nAtoms))
+
+    if len(lines) < nAtoms:
+        raise RuntimeError("Invalid XYZ file '%s'" % path)
+
+    if nAtoms == 0:
+        return Molecule()
+
+    try:
+        # Parse the entire coordinate block at once instead of handling every line separately
+        coordinates = np.loadtxt(lines, usecols=(1, 2, 3), ndmin=2)
+        symbols = np.loadtxt(lines, usecols=0, dtype=str, ndmin=1)
+        atomicNumbers = symbolsToAtomicNumbers(symbols)
+    except (ValueError, IndexError) as e:
+        raise RuntimeError("Invalid line in XYZ file '%s': %s" % (path, e))
+    except KeyError as e:
+        raise RuntimeError("Invalid XYZ file '%s': %s" % (path, e))
+
+    return Molecule.fromArrays(atomicNumbers=atomicNumbers, coordinates=coordinates)
+
 
-    molecule = Molecule()
-    with open(path, "r") as inputFile:
-        lines = inputFile.readlines()
+def _readTurbomole(inputFile: IO[str], path: str) -> Molecule:
+    """Reads the $coord section of a turbomole file (coordinates in bohr)"""
+    lines = inputFile.read().split("\n")
 
-        if len(lines) < 3:
-            raise RuntimeError("Invalid XYZ file '%s'" % path)
+    try:
+        start = next(i for i, line in enumerate(lines) if line.strip().startswith("$coord"))
+    except StopIteration:
+        raise RuntimeError("No $coord section in turbomole file '%s'" % path)
 
-        nAtoms = int(lines[0])
+    end = start + 1
+    while end < len(lines) and not lines[end].strip().startswith("$"):
+        end += 1
 
-        # second line is only the comment, which we don't care about
+    block = [line for line in lines[start + 1 : end] if line.strip()]
 
-        for i in range(nAtoms):
-            components = lines[i + 2].split()
+    if len(block) == 0:
+        return Molecule()
 
-            if len(components) < 4:
-                raise RuntimeError("Invalid line in XYZ file: '%s':%d" % (path, i + 2))
+    try:
+        coordinates = np.loadtxt(block, usecols=(0, 1, 2), ndmin=2)
+        symbols = np.loadtxt(block, usecols=3, dtype=str, ndmin=1)
+        atomicNumbers = symbolsToAtomicNumbers(symbols)
+    except (ValueError, IndexError, KeyError) as e:
+        raise RuntimeError("Invalid turbomole file '%s': %s" % (path, e))
 
-            molecule.addAtom(
-                Atom(
-                    element=Element[components[0]],
-                    coordinates=np.asarray(
-                        [
-                            float(components[1]),
-                            float(components[2]),
-                            float(components[3]),
-                        ]
-                    ),
-                )
+    return Molecule.fromArrays(atomicNumbers, coordinates * bohrToAngstrom)
+
+
+def _writeTurbomole(outputFile: IO[str], molecule: Molecule) -> None:
+    outputFile.write("$coord\n")
+    symbols = ElementSymbolTable[molecule.atomicNumbers()]
+    for symbol, coordinates in zip(symbols, molecule.coordinates() / bohrToAngstrom):
+        outputFile.write(
+            "{: 20.14f}  {: 20.14f}  {: 20.14f}      {:s}\n".format(
+                coordinates[0], coordinates[1], coordinates[2], symbol.lower()
             )
+        )
+    outputFile.write("$end\n")
+
 
-    assert len(molecule.atoms) == nAtoms
+def readMolecule(path: str, fmt: FileFormat = FileFormat.XYZ) -> Molecule:
+    """Reads a molecule in the given format from the given path on the filesystem. Text files ending
+    in .gz are decompressed on the fly. For files containing multiple frames, the first one is read"""
+    if fmt == FileFormat.HDF5:
+        with GeometryArchive(path) as archive:
+            if len(archive) == 0:
+                raise RuntimeError("Empty geometry archive '%s'" % path)
+            return archive[0]
+
+    if fmt == FileFormat.TURBOMOLE:
+        with _openText(path) as inputFile:
+            return _readTurbomole(inputFile, path)
+
+    if fmt != FileFormat.XYZ:
+        raise RuntimeError("Unsupported file format %s" % str(fmt))
+
+    with _openText(path) as inputFile:
+        molecule = _readXYZFrame(inputFile, path)
+
+    if molecule is None:
+        raise RuntimeError("Invalid XYZ file '%s'" % path)
 
     return molecule
 
 
+def readTrajectory(path: str, fmt: FileFormat = FileFormat.XYZ) -> List[Molecule]:
+    """Reads all frames (concatenated XYZ blocks or the frames of a geometry archive) from the given file"""
+    if fmt == FileFormat.HDF5:
+        with GeometryArchive(path) as archive:
+            return list(archive)
+
+    if fmt == FileFormat.TURBOMOLE:
+        return [readMolecule(path, fmt)]
+
+    if fmt != FileFormat.XYZ:
+        raise RuntimeError("Unsupported file format %s" % str(fmt))
+
+    frames: List[Molecule] = []
+    with _openText(path) as inputFile:
+        while True:
+            molecule = _readXYZFrame(inputFile, path)
+            if molecule is None:
+                break
+            frames.append(molecule)
+
+    return frames
+
+
+def _writeXYZFrame(outputFile: IO[str], molecule: Molecule) -> None:
+    outputFile.write("{}\n\n".format(molecule.nAtoms()))
+    symbols = ElementSymbolTable[molecule.atomicNumbers()]
+    for symbol, coordinates in zip(symbols, molecule.coordinates()):
+        outputFile.write(
+            "{: <2s} {: 17.12f} {: 17.12f} {: 17.12f}\n".format(
+                symbol,
+                coordinates[0],
+                coordinates[1],
+                coordinates[2],
+            )
+        )
+
+
 def writeMolecule(
     molecule: Molecule, path: str, fmt: FileFormat = FileFormat.XYZ
 ) -> None:
-    """Writes the given Molecule's geometry to a file at the given path and in the specified format"""
+    """Writes the given Molecule's geometry to a file at the given path and in the specified format.
+    XYZ files ending in .gz are compressed"""
+    writeTrajectory([molecule], path, fmt)
+
+
+def writeTrajectory(
+    molecules: Iterable[Molecule], path: str, fmt: FileFormat = FileFormat.XYZ
+) -> None:
+    """Writes the given Molecules as consecutive frames to a file at the given path and in the specified
+    format. Use GeometryArchive directly to append to existing archives or to store energies and labels"""
+    if fmt == FileFormat.HDF5:
+        with GeometryArchive(path, "w") as archive:
+            archive.extend(molecules)
+        return
+
+    if fmt == FileFormat.TURBOMOLE:
+        molecules = list(molecules)
+        if len(molecules) != 1:
+            raise RuntimeError("Turbomole files can only hold a single geometry")
+        with _openText(path, "w") as outputFile:
+            _writeTurbomole(outputFile, molecules[0])
+        return
+
     if fmt != FileFormat.XYZ:
         raise RuntimeError("Unsupported file format %s" % str(fmt))
 
-    with open(path, "w") as outputFile:
-        outputFile.write("{}\n\n".format(len(molecule.atoms)))
-        for currentAtom in molecule.atoms:
-            outputFile.write(
-                "{: <2s} {: 17.12f} {: 17.12f} {: 17.12f}\n".format(
-                    currentAtom.element.symbol(),
-                    currentAtom.coordinates[0],
-                    currentAtom.coordinates[1],
-                    currentAtom.coordinates[2],
-                )
-            )
+    with _openText(path, "w") as outputFile:
+        for molecule in molecules:
+            _writeXYZFrame(outputFile, molecule)
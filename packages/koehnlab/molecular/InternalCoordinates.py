@@ -0,0 +1,230 @@
+from typing import Optional, Tuple
+from itertools import combinations
+
+from .Molecule import Molecule
+
+import numpy as np
+from numpy.typing import ArrayLike
+
+""" Vectorized evaluation of internal coordinates (bond lengths, bond angles and dihedral angles) and
+    their first derivatives w.r.t. Cartesian coordinates (rows of the Wilson B matrix).
+    All routines accept a single geometry (nAtoms, 3) or a stack of frames (nFrames, nAtoms, 3) and
+    an index list of the atoms involved in each internal coordinate. Angles are given in radians. """
+
+
+def _coordinateArray(geometry: Molecule | ArrayLike) -> np.ndarray:
+    if isinstance(geometry, Molecule):
+        return geometry.coordinates()
+
+    coordinates = np.asarray(geometry, dtype=float)
+    assert coordinates.shape[-1] == 3
+
+    return coordinates
+
+
+def _cross(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # np.cross is comparatively slow for many short vectors
+    return np.stack(
+        (
+            a[..., 1] * b[..., 2] - a[..., 2] * b[..., 1],
+            a[..., 2] * b[..., 0] - a[..., 0] * b[..., 2],
+            a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0],
+        ),
+        axis=-1,
+    )
+
+
+def _dot(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return np.einsum("...k,...k->...", a, b)
+
+
+def bondLengths(geometry: Molecule | ArrayLike, indices: ArrayLike) -> np.ndarray:
+    """Computes the distances between the atom pairs in indices (shape (nBonds, 2))"""
+    coord = _coordinateArray(geometry)
+    indices = np.asarray(indices, dtype=int).reshape((-1, 2))
+
+    return np.linalg.norm(coord[..., indices[:, 0], :] - coord[..., indices[:, 1], :], axis=-1)
+
+
+def bondAngles(geometry: Molecule | ArrayLike, indices: ArrayLike) -> np.ndarray:
+    """Computes the angles a-b-c for the atom triples in indices (shape (nAngles, 3), b is the apex)"""
+    coord = _coordinateArray(geometry)
+    indices = np.asarray(indices, dtype=int).reshape((-1, 3))
+
+    u = coord[..., indices[:, 0], :] - coord[..., indices[:, 1], :]
+    v = coord[..., indices[:, 2], :] - coord[..., indices[:, 1], :]
+
+    cosine = _dot(u, v) / (np.linalg.norm(u, axis=-1) * np.linalg.norm(v, axis=-1))
+
+    return np.arccos(np.clip(cosine, -1.0, 1.0))
+
+
+def dihedralAngles(geometry: Molecule | ArrayLike, indices: ArrayLike) -> np.ndarray:
+    """Computes the dihedral angles a-b-c-d (in the range (-pi, pi]) for the atom quadruples in
+    indices (shape (nDihedrals, 4))"""
+    coord = _coordinateArray(geometry)
+    indices = np.asarray(indices, dtype=int).reshape((-1, 4))
+
+    b1 = coord[..., indices[:, 1], :] - coord[..., indices[:, 0], :]
+    b2 = coord[..., indices[:, 2], :] - coord[..., indices[:, 1], :]
+    b3 = coord[..., indices[:, 3], :] - coord[..., indices[:, 2], :]
+
+    n1 = _cross(b1, b2)
+    n2 = _cross(b2, b3)
+
+    return np.arctan2(np.linalg.norm(b2, axis=-1) * _dot(b1, n2), _dot(n1, n2))
+
+
+def bondLengthDerivatives(geometry: Molecule | ArrayLike, indices: ArrayLike) -> np.ndarray:
+    """Derivatives of the bond lengths w.r.t. the Cartesian coordinates of the two involved atoms.
+    Returns an array of shape (..., nBonds, 2, 3)"""
+    coord = _coordinateArray(geometry)
+    indices = np.asarray(indices, dtype=int).reshape((-1, 2))
+
+    u = coord[..., indices[:, 0], :] - coord[..., indices[:, 1], :]
+    u /= np.linalg.norm(u, axis=-1)[..., np.newaxis]
+
+    return np.stack((u, -u), axis=-2)
+
+
+def bondAngleDerivatives(geometry: Molecule | ArrayLike, indices: ArrayLike) -> np.ndarray:
+    """Derivatives of the bond angles w.r.t. the Cartesian coordinates of the three involved atoms.
+    Returns an array of shape (..., nAngles, 3, 3). Undefined for linear arrangements"""
+    coord = _coordinateArray(geometry)
+    indices = np.asarray(indices, dtype=int).reshape((-1, 3))
+
+    u = coord[..., indices[:, 0], :] - coord[..., indices[:, 1], :]
+    v = coord[..., indices[:, 2], :] - coord[..., indices[:, 1], :]
+    lu = np.linalg.norm(u, axis=-1)[..., np.newaxis]
+    lv = np.linalg.norm(v, axis=-1)[..., np.newaxis]
+    eu = u / lu
+    ev = v / lv
+
+    cosine = np.clip(_dot(eu, ev), -1.0, 1.0)[..., np.newaxis]
+    sine = np.sqrt(1.0 - cosine**2)
+
+    da = (cosine * eu - ev) / (lu * sine)
+    dc = (cosine * ev - eu) / (lv * sine)
+
+    return np.stack((da, -da - dc, dc), axis=-2)
+
+
+def dihedralAngleDerivatives(geometry: Molecule | ArrayLike, indices: ArrayLike) -> np.ndarray:
+    """Derivatives of the dihedral angles w.r.t. the Cartesian coordinates of the four involved atoms.
+    Returns an array of shape (..., nDihedrals, 4, 3). Undefined if three atoms are collinear"""
+    coord = _coordinateArray(geometry)
+    indices = np.asarray(indices, dtype=int).reshape((-1, 4))
+
+    # See Blondel, Karplus; J. Comput. Chem. 1996, 17, 1132.
+    # https://doi.org/10.1002/(SICI)1096-987X(19960715)17:9<1132::AID-JCC5>3.0.CO;2-T
+    b1 = coord[..., indices[:, 1], :] - coord[..., indices[:, 0], :]
+    b2 = coord[..., indices[:, 2], :] - coord[..., indices[:, 1], :]
+    b3 = coord[..., indices[:, 3], :] - coord[..., indices[:, 2], :]
+
+    n1 = _cross(b1, b2)
+    n2 = _cross(b2, b3)
+    lb2 = np.linalg.norm(b2, axis=-1)[..., np.newaxis]
+
+    da = -lb2 / _dot(n1, n1)[..., np.newaxis] * n1
+    dd = lb2 / _dot(n2, n2)[..., np.newaxis] * n2
+
+    f1 = -_dot(b1, b2)[..., np.newaxis] / lb2**2
+    f3 = -_dot(b3, b2)[..., np.newaxis] / lb2**2
+
+    db = (f1 - 1.0) * da - f3 * dd
+    dc = (f3 - 1.0) * dd - f1 * da
+
+    return np.stack((da, db, dc, dd), axis=-2)
+
+
+def _scatterBRows(derivatives: np.ndarray, indices: np.ndarray, nAtoms: int) -> np.ndarray:
+    """Scatters the per-atom derivatives (..., nInternal, nInvolved, 3) into dense B matrix rows
+    (..., nInternal, 3 * nAtoms)"""
+    nInternal, nInvolved = indices.shape
+    rows = np.zeros(derivatives.shape[:-3] + (nInternal, nAtoms, 3))
+
+    internalIdx = np.arange(nInternal)
+    for k in range(nInvolved):
+        rows[..., internalIdx, indices[:, k], :] += derivatives[..., k, :]
+
+    return rows.reshape(derivatives.shape[:-3] + (nInternal, 3 * nAtoms))
+
+
+def internalCoordinates(
+    geometry: Molecule | ArrayLike,
+    bonds: Optional[ArrayLike] = None,
+    angles: Optional[ArrayLike] = None,
+    dihedrals: Optional[ArrayLike] = None,
+) -> np.ndarray:
+    """Evaluates the given bonds, angles and dihedrals (in this order) for the given geometry or stack of
+    geometries. Returns an array of shape (..., nInternal)"""
+    values = []
+    if bonds is not None:
+        values.append(bondLengths(geometry, bonds))
+    if angles is not None:
+        values.append(bondAngles(geometry, angles))
+    if dihedrals is not None:
+        values.append(dihedralAngles(geometry, dihedrals))
+
+    return np.concatenate(values, axis=-1)
+
+
+def wilsonBMatrix(
+    geometry: Molecule | ArrayLike,
+    bonds: Optional[ArrayLike] = None,
+    angles: Optional[ArrayLike] = None,
+    dihedrals: Optional[ArrayLike] = None,
+) -> np.ndarray:
+    """Computes the Wilson B matrix B[q, 3*i+c] = dq / dx_{i,c} for the given bonds, angles and dihedrals
+    (rows in this order). For a stack of geometries, an array of shape (nFrames, nInternal, 3 * nAtoms)
+    is returned. Cartesian displacements (e.g. normal modes) are projected onto the internal coordinates
+    via np.matmul(B, displacements)"""
+    coord = _coordinateArray(geometry)
+    nAtoms = coord.shape[-2]
+
+    blocks = []
+    if bonds is not None:
+        bonds = np.asarray(bonds, dtype=int).reshape((-1, 2))
+        blocks.append(_scatterBRows(bondLengthDerivatives(coord, bonds), bonds, nAtoms))
+    if angles is not None:
+        angles = np.asarray(angles, dtype=int).reshape((-1, 3))
+        blocks.append(_scatterBRows(bondAngleDerivatives(coord, angles), angles, nAtoms))
+    if dihedrals is not None:
+        dihedrals = np.asarray(dihedrals, dtype=int).reshape((-1, 4))
+        blocks.append(
+            _scatterBRows(dihedralAngleDerivatives(coord, dihedrals), dihedrals, nAtoms)
+        )
+
+    return np.concatenate(blocks, axis=-2)
+
+
+def internalCoordinateIndices(
+    molecule: Molecule,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Generates the index lists of all bonds, bond angles and proper dihedral angles from the
+    molecule's connectivity (see Molecule.connectivity)"""
+    graph = molecule.connectivity()
+    bonds = molecule.bonds()
+
+    neighbors = [
+        graph.indices[graph.indptr[i] : graph.indptr[i + 1]] for i in range(molecule.nAtoms())
+    ]
+
+    angles = [
+        (a, b, c) for b in range(molecule.nAtoms()) for a, c in combinations(neighbors[b], 2)
+    ]
+
+    dihedrals = [
+        (a, b, c, d)
+        for b, c in bonds
+        for a in neighbors[b]
+        if a != c
+        for d in neighbors[c]
+        if d != b and d != a
+    ]
+
+    return (
+        bonds,
+        np.array(angles, dtype=int).reshape((-1, 3)),
+        np.array(dihedrals, dtype=int).reshape((-1, 4)),
+    )
@@ -1,114 +1,197 @@
-from typing import List
+from typing import Dict, Iterable, List, MutableSequence, Optional, Tuple, Union, overload
 
-from copy import deepcopy
+import hashlib
 
-from .Element import Element
+from .Element import Element, ElementMassTable
 from .Atom import Atom
+from .Connectivity import defaultBondTolerance, findBonds, bondGraph, findFragments
 
 import numpy as np
 from numpy.typing import ArrayLike
+from scipy.sparse import csr_matrix, triu
+from scipy.spatial.distance import pdist
 
 
 class Molecule:
-    """Class representing a molecule as a list of Atoms"""
+    """Class representing a molecule. Internally, the atoms are stored as an array of atomic numbers
+    and an (nAtoms, 3) array of coordinates"""
 
     def __init__(self, atoms: List[Atom] = []):
-        self.atoms: List[Atom] = deepcopy(atoms)
+        self._atomicNumbers: np.ndarray = np.array(
+            [currentAtom.element.atomicNumber() for currentAtom in atoms], dtype=int
+        )
+        self._coordinates: np.ndarray = np.array(
+            [currentAtom.coordinates for currentAtom in atoms], dtype=float
+        ).reshape((len(atoms), 3))
+        # Bond graph together with the tolerance it has been computed for
+        self._connectivity: Optional[Tuple[float, csr_matrix]] = None
+        # Fingerprints for the (tolerance, permutationInvariant) settings they have been computed for
+        self._fingerprints: Dict[Tuple[float, bool], str] = {}
+
+    @classmethod
+    def fromArrays(cls, atomicNumbers: ArrayLike, coordinates: ArrayLike) -> "Molecule":
+        """Creates a molecule directly from an array of atomic numbers and an (nAtoms, 3) array
+        of coordinates without going through individual Atom objects"""
+        atomicNumbers = np.array(atomicNumbers, dtype=int).reshape(-1)
+        coordinates = np.array(coordinates, dtype=float)
+
+        assert coordinates.shape == (len(atomicNumbers), 3)
+
+        molecule = cls()
+        molecule._atomicNumbers = atomicNumbers
+        molecule._coordinates = coordinates
+        molecule._invalidateCaches()
+
+        return molecule
+
+    @property
+    def atoms(self) -> "AtomList":
+        """The atoms of this molecule as a mutable list view: changes to the list or to the element and
+        coordinates of its Atom objects are written back into the molecule's arrays. Modifying the coordinates
+        in-place (e.g. atoms[0].coordinates[1] = 0.) bypasses the invalidation of cached data like the
+        connectivity"""
+        return AtomList(self)
+
+    @atoms.setter
+    def atoms(self, atoms: Iterable[Atom]) -> None:
+        self._setAtoms(list(atoms))
+
+    def _setAtoms(self, atoms: List[Atom]) -> None:
+        """Replaces all atoms of this molecule"""
+        other = Molecule(atoms)
+        self._atomicNumbers = other._atomicNumbers
+        self._coordinates = other._coordinates
+        self._invalidateCaches()
 
     def nAtoms(self) -> int:
         """Return number of atoms"""
-        return len(self.atoms)
+        return len(self._atomicNumbers)
+
+    def atomicNumbers(self) -> np.ndarray:
+        """Return atomic numbers of all atoms"""
+        return self._atomicNumbers.copy()
 
     def coordinates(self) -> np.ndarray:
         """Return coordinates as array"""
-        coord = []
-        for currentAtom in self.atoms:
-            coord.append(currentAtom.coordinates)
-        return np.array(coord)
+        return self._coordinates.copy()
 
     def masses(self) -> np.ndarray:
         """Return masses of all atoms"""
-        mass = []
-        for currentAtom in self.atoms:
-            mass.append(currentAtom.element.mass())
-        return np.array(mass)
+        return ElementMassTable[self._atomicNumbers]
 
     def massVec(self) -> np.ndarray:
         """Return masses of all atoms as mass vector (same mass for x,y,z)"""
-        massV = []
-        for currentAtom in self.atoms:
-            mass = currentAtom.element.mass()
-            massV.append([mass,mass,mass])
-        return np.array(massV)
+        return np.repeat(self.masses()[:, np.newaxis], 3, axis=1)
 
     def addAtom(self, atom: Atom) -> None:
         """Add one atom to the current molecule"""
-        self.atoms.append(atom)
+        self.addAtomList([atom])
 
     def addAtomList(self, atoms: List[Atom]) -> None:
         """Add a list of atoms to the current molecule"""
-        self.atoms.extend(atoms)
+        other = Molecule(atoms)
+        self._atomicNumbers = np.concatenate((self._atomicNumbers, other._atomicNumbers))
+        self._coordinates = np.concatenate((self._coordinates, other._coordinates))
+        self._invalidateCaches()
 
     def setCoordinates(self, coord: np.ndarray) -> None:
         """Put (externally modified) coordinates into object, number of atoms must not change"""
-        assert coord.shape[0] == len(self.atoms)
+        assert coord.shape[0] == self.nAtoms()
         assert coord.shape[1] == 3
-        nAtoms = len(self.atoms)
-        for idx in range(nAtoms):
-            self.atoms[idx].coordinates = coord[idx]
+        self._coordinates = np.array(coord, dtype=float)
+        self._invalidateCaches()
 
     def translate(self, delta: ArrayLike) -> None:
         """Translates the entire molecule by the given delta"""
-        for currentAtom in self.atoms:
-            currentAtom.coordinates += delta
+        self._coordinates += np.asarray(delta, dtype=float)
 
     def transform(self, transformation: np.ndarray) -> None:
         """Applies the given transformation to this molecule"""
-        for currentAtom in self.atoms:
-            currentAtom.coordinates = np.matmul(transformation, currentAtom.coordinates)
+        transformation = np.asarray(transformation)
+        self._coordinates = np.matmul(self._coordinates, transformation.T)
 
-    def centerOfMass(self) -> np.ndarray:
-        """Computes the center of mass of this molecule"""
-        center = np.zeros(3)
+        # Rotations and reflections don't change any distances
+        if not np.allclose(np.matmul(transformation.T, transformation), np.identity(3)):
+            self._invalidateCaches()
+
+    def _invalidateCaches(self) -> None:
+        """Discards all cached data that depends on the coordinates. Rigid translations and rotations
+        don't need to call this"""
+        self._connectivity = None
+        self._fingerprints = {}
+
+    def connectivity(self, tolerance: float = defaultBondTolerance) -> csr_matrix:
+        """Returns the bond graph of this molecule as sparse, symmetric adjacency matrix storing the bond
+        lengths. Two atoms are bonded, if their distance is below tolerance times the sum of their covalent
+        radii. The result is cached until the coordinates are changed"""
+        if self._connectivity is None or self._connectivity[0] != tolerance:
+            bonds, lengths = findBonds(self._atomicNumbers, self._coordinates, tolerance)
+            self._connectivity = (tolerance, bondGraph(bonds, lengths, self.nAtoms()))
+
+        return self._connectivity[1]
 
-        totalMass: float = 0
+    def bonds(self, tolerance: float = defaultBondTolerance) -> np.ndarray:
+        """Returns all bonds as (nBonds, 2) array of atom indices (see connectivity)"""
+        upper = triu(self.connectivity(tolerance), k=1).tocoo()
+        bonds = np.stack((upper.row, upper.col), axis=1)
 
-        for currentAtom in self.atoms:
-            totalMass += currentAtom.element.mass()
-            center += currentAtom.coordinates * currentAtom.element.mass()
+        return bonds[np.lexsort((bonds[:, 1], bonds[:, 0]))]
 
-        center *= 1 / totalMass
+    def fragments(self, tolerance: float = defaultBondTolerance) -> np.ndarray:
+        """Returns for every atom the index of the (covalently bonded) fragment it belongs to"""
+        _, labels = findFragments(self.connectivity(tolerance))
 
-        return center
+        return labels
+
+    def centerOfMass(self) -> np.ndarray:
+        """Computes the center of mass of this molecule"""
+        masses = self.masses()
+
+        return np.matmul(masses, self._coordinates) / np.sum(masses)
 
     def inertiaTensor(self) -> np.ndarray:
         """Computes the inertia tensor for this molecule"""
-        tensor = np.zeros(shape=(3, 3))
-
-        center = self.centerOfMass()
+        masses = self.masses()
+        relCoordinates = self._coordinates - self.centerOfMass()
 
         # T_{ij} = sum_k m_k * (|r_k|^2 * delta_{ij} - r_k[i] * r_k[j])
         # where m_k is the k-th element's mass, r_k its position and r_k[i] is the i-th coordinate of that position
         # See also https://en.wikipedia.org/wiki/Moment_of_inertia#Inertia_tensor
-        for i in range(3):
-            for j in range(3):
-                for currentAtom in self.atoms:
-                    relCoordinates = currentAtom.coordinates - center
+        weighted = relCoordinates * masses[:, np.newaxis]
+        tensor = np.sum(weighted * relCoordinates) * np.identity(3)
+        tensor -= np.matmul(weighted.T, relCoordinates)
 
-                    if i == j:
-                        tensor[i, j] += (
-                            currentAtom.element.mass()
-                            * np.linalg.norm(relCoordinates) ** 2
-                        )
+        return tensor
 
+    def fingerprint(self, tolerance: float = 1e-3, permutationInvariant: bool = False) -> str:
+        """Returns a hash of this geometry that is invariant under translations, rotations and reflections.
+        It is built from the interatomic distances rounded to multiples of tolerance, such that geometries
+        that only differ by noise well below tolerance share the same fingerprint (geometries
+        with distances close to a rounding boundary may still differ). If permutationInvariant is set,
+        the fingerprint doesn't depend on the order of the atoms either"""
+        key = (tolerance, permutationInvariant)
 
-                    tensor[i, j] -= (
-                        currentAtom.element.mass()
-                        * relCoordinates[i]
-                        * relCoordinates[j]
-                    )
+        if key not in self._fingerprints:
+            # pdist returns the upper triangle of the distance matrix in row-major order
+            rows, cols = np.triu_indices(self.nAtoms(), k=1)
+            rounded = np.round(pdist(self._coordinates) / tolerance).astype(np.int64)
 
-        return tensor
+            if permutationInvariant:
+                # Sorted multiset of (Z_i, Z_j, d_ij) triples with Z_i <= Z_j
+                Zi = np.minimum(self._atomicNumbers[rows], self._atomicNumbers[cols])
+                Zj = np.maximum(self._atomicNumbers[rows], self._atomicNumbers[cols])
+                order = np.lexsort((rounded, Zj, Zi))
+                data = [np.sort(self._atomicNumbers), Zi[order], Zj[order], rounded[order]]
+            else:
+                data = [self._atomicNumbers, rounded]
+
+            digest = hashlib.sha1()
+            for array in data:
+                digest.update(np.ascontiguousarray(array, dtype=np.int64).tobytes())
+
+            self._fingerprints[key] = digest.hexdigest()
+
+        return self._fingerprints[key]
 
     def bringToStandardOrientation(self) -> None:
         """Translates the molecule such that its center of mass is located at (0,0,0) and rotates it
@@ -127,3 +210,102 @@ class Molecule:
 
         # Rotate the molecule to its principle axes
         self.transform(np.linalg.inv(eigvectors))
+
+
+class MoleculeAtom(Atom):
+    """The atom at a given position of a molecule (as handed out by Molecule.atoms). Its element and
+    coordinates are read from and written to the molecule's arrays"""
+
+    def __init__(self, molecule: Molecule, index: int):
+        self._molecule = molecule
+        self._index = index
+
+    @property
+    def element(self) -> Element:
+        return Element(self._molecule._atomicNumbers[self._index])
+
+    @element.setter
+    def element(self, element: Element) -> None:  # type: ignore
+        self._molecule._atomicNumbers[self._index] = element.atomicNumber()
+        self._molecule._invalidateCaches()
+
+    @property
+    def coordinates(self) -> np.ndarray:
+        return self._molecule._coordinates[self._index]
+
+    @coordinates.setter
+    def coordinates(self, coordinates: ArrayLike) -> None:  # type: ignore
+        self._molecule._coordinates[self._index] = np.asarray(coordinates, dtype=float)
+        self._molecule._invalidateCaches()
+
+
+class AtomList(MutableSequence[Atom]):
+    """Mutable list view of the atoms of a molecule (see Molecule.atoms)"""
+
+    def __init__(self, molecule: Molecule):
+        self._molecule = molecule
+
+    def __len__(self) -> int:
+        return self._molecule.nAtoms()
+
+    def _index(self, index: int) -> int:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("atom index out of range")
+        return index
+
+    def _copies(self) -> List[Atom]:
+        return [Atom(element=Element(Z), coordinates=coord.copy()) for Z, coord in
+                zip(self._molecule._atomicNumbers, self._molecule._coordinates)]
+
+    @overload
+    def __getitem__(self, index: int) -> Atom: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[Atom]: ...
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Atom, List[Atom]]:
+        if isinstance(index, slice):
+            return [MoleculeAtom(self._molecule, i) for i in range(*index.indices(len(self)))]
+
+        return MoleculeAtom(self._molecule, self._index(index))
+
+    @overload
+    def __setitem__(self, index: int, value: Atom) -> None: ...
+
+    @overload
+    def __setitem__(self, index: slice, value: Iterable[Atom]) -> None: ...
+
+    def __setitem__(self, index: Union[int, slice], value: Union[Atom, Iterable[Atom]]) -> None:
+        if isinstance(index, slice):
+            assert not isinstance(value, Atom)
+            atoms = self._copies()
+            atoms[index] = list(value)
+            self._molecule._setAtoms(atoms)
+            return
+
+        assert isinstance(value, Atom)
+        index = self._index(index)
+        # read both before writing, value might be an atom of this molecule
+        Z, coord = value.element.atomicNumber(), np.array(value.coordinates, dtype=float)
+        self._molecule._atomicNumbers[index] = Z
+        self._molecule._coordinates[index] = coord
+        self._molecule._invalidateCaches()
+
+    def __delitem__(self, index: Union[int, slice]) -> None:
+        if not isinstance(index, slice):
+            index = self._index(index)
+        self._molecule._atomicNumbers = np.delete(self._molecule._atomicNumbers, index)
+        self._molecule._coordinates = np.delete(self._molecule._coordinates, index, axis=0)
+        self._molecule._invalidateCaches()
+
+    def insert(self, index: int, value: Atom) -> None:
+        # list.insert semantics: out-of-range positions insert at the beginning or the end
+        nAtoms = len(self)
+        index = min(max(index + nAtoms if index < 0 else index, 0), nAtoms)
+        self._molecule._atomicNumbers = np.insert(self._molecule._atomicNumbers, index,
+                                                  value.element.atomicNumber())
+        self._molecule._coordinates = np.insert(self._molecule._coordinates, index,
+                                                np.asarray(value.coordinates, dtype=float), axis=0)
+        self._molecule._invalidateCaches()
@@ -0,0 +1,363 @@
+from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass
+from itertools import combinations
+
+from .Molecule import Molecule
+
+import numpy as np
+from numpy.typing import ArrayLike
+from scipy.spatial import KDTree
+
+""" Tolerance-based detection of the point-group symmetry operations of a molecule and helpers to
+    exploit them for finite-difference (displacement) calculations """
+
+# Highest order of proper and improper rotation axes that is searched for
+maxAxisOrder = 8
+
+# Largest number of operations of a finite point group (Ih). Closing a set of operations beyond this
+# means that tolerance is too loose
+maxGroupOrder = 120
+
+
+@dataclass
+class SymmetryOperation:
+    """A point-group operation given as orthogonal 3x3 matrix acting on coordinates relative to the
+    center of mass and the permutation of atoms it induces: matrix @ r_i = r_{permutation[i]}"""
+
+    matrix: np.ndarray
+    permutation: np.ndarray
+
+    def transformDisplacement(self, displacement: ArrayLike) -> np.ndarray:
+        """Maps an (nAtoms, 3) displacement of the reference geometry onto its symmetry image"""
+        displacement = np.asarray(displacement)
+        transformed = np.empty_like(displacement)
+        transformed[self.permutation] = np.matmul(displacement, self.matrix.T)
+
+        return transformed
+
+    def transformTensor(self, tensor: ArrayLike) -> np.ndarray:
+        """Transforms a Cartesian tensor of arbitrary rank (e.g. a g- or D-tensor) with this operation"""
+        tensor = np.asarray(tensor)
+        for axis in range(tensor.ndim):
+            tensor = np.moveaxis(np.tensordot(self.matrix, tensor, axes=([1], [axis])), 0, axis)
+
+        return tensor
+
+
+def _rotationMatrix(axis: np.ndarray, angle: float) -> np.ndarray:
+    # Rodrigues' formula
+    K = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+    return np.identity(3) + np.sin(angle) * K + (1 - np.cos(angle)) * np.matmul(K, K)
+
+
+def _reflectionMatrix(normal: np.ndarray) -> np.ndarray:
+    return np.identity(3) - 2 * np.outer(normal, normal)
+
+
+def _matchAtoms(
+    tree: KDTree, atomicNumbers: np.ndarray, transformed: np.ndarray, tolerance: float
+) -> Optional[np.ndarray]:
+    """Returns the permutation mapping the transformed atoms onto the original ones (or None)"""
+    distances, indices = tree.query(transformed, distance_upper_bound=tolerance)
+    permutation = np.asarray(indices)
+
+    if np.any(np.isinf(distances)):
+        return None
+    if np.any(atomicNumbers[permutation] != atomicNumbers):
+        return None
+    if len(np.unique(permutation)) != len(permutation):
+        return None
+
+    return permutation
+
+
+def _candidateDirections(
+    coordinates: np.ndarray, atomicNumbers: np.ndarray, masses: np.ndarray, tolerance: float
+) -> np.ndarray:
+    """Collects the directions that might be symmetry axes or plane normals"""
+    # Cartesian axes and principal axes of inertia
+    secondMoments = np.einsum("i,ij,ik->jk", masses, coordinates, coordinates)
+    directions = [np.identity(3), np.linalg.eigh(secondMoments)[1].T]
+
+    # Every symmetry element maps the smallest set of atoms that share element and distance to the
+    # center onto itself, so candidates can be derived from this set only
+    radii = np.linalg.norm(coordinates, axis=1)
+    offCenter = radii > tolerance
+    keys = np.stack((atomicNumbers, np.round(radii / tolerance)), axis=1)[offCenter]
+    if len(keys) > 0:
+        _, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+        shell = coordinates[offCenter][inverse.reshape(-1) == np.argmin(counts)]
+
+        directions.append(shell)
+        pairs = np.array(list(combinations(range(len(shell)), 2)), dtype=int).reshape((-1, 2))
+        directions.append(shell[pairs[:, 0]] + shell[pairs[:, 1]])
+        directions.append(shell[pairs[:, 0]] - shell[pairs[:, 1]])
+        directions.append(np.cross(shell[pairs[:, 0]], shell[pairs[:, 1]]))
+
+    directions = np.concatenate(directions)
+    norms = np.linalg.norm(directions, axis=1)
+    directions = directions[norms > tolerance] / norms[norms > tolerance, np.newaxis]
+
+    # Remove (anti)parallel duplicates
+    unique: List[np.ndarray] = []
+    for direction in directions:
+        if not any(abs(np.dot(direction, other)) > 1 - 1e-6 for other in unique):
+            unique.append(direction)
+
+    return np.array(unique)
+
+
+def _linearAxis(coordinates: np.ndarray, tolerance: float) -> Optional[np.ndarray]:
+    """Returns the molecular axis if all atoms lie on a line through the origin (None otherwise)"""
+    radii = np.linalg.norm(coordinates, axis=1)
+    if np.max(radii, initial=0.0) <= tolerance:
+        return np.array([0.0, 0.0, 1.0])
+
+    axis = coordinates[np.argmax(radii)] / np.max(radii)
+    perpendicular = coordinates - np.outer(np.matmul(coordinates, axis), axis)
+    if np.max(np.linalg.norm(perpendicular, axis=1)) > tolerance:
+        return None
+
+    return axis
+
+
+def findSymmetryOperations(
+    molecule: Molecule, tolerance: float = 1e-2
+) -> List[SymmetryOperation]:
+    """Determines the point-group operations of the given molecule. Atoms are considered equivalent, if
+    they are of the same element and their positions agree to within tolerance (same unit as the
+    coordinates). The operations refer to the molecule's center of mass as origin. The identity is
+    always returned first.
+    Linear molecules (C_inf_v and D_inf_h) have infinitely many operations; for them only the subgroup
+    C2v or D2h with the molecular axis as C2 axis is returned"""
+    masses = molecule.masses()
+    atomicNumbers = molecule.atomicNumbers()
+    coordinates = molecule.coordinates() - molecule.centerOfMass()
+
+    tree = KDTree(coordinates)
+
+    operations = [SymmetryOperation(np.identity(3), np.arange(molecule.nAtoms()))]
+
+    def tryAdd(matrix: np.ndarray) -> None:
+        if any(np.allclose(matrix, op.matrix, atol=1e-6) for op in operations):
+            return
+        permutation = _matchAtoms(tree, atomicNumbers, np.matmul(coordinates, matrix.T), tolerance)
+        if permutation is not None:
+            operations.append(SymmetryOperation(matrix, permutation))
+
+    tryAdd(-np.identity(3))
+
+    linearAxis = _linearAxis(coordinates, tolerance)
+    if linearAxis is not None:
+        # Every rotation about the axis is a symmetry, so only C2 about it and the mirror planes and C2
+        # axes along two perpendicular directions are used
+        first = np.cross(linearAxis, np.identity(3)[np.argmin(np.abs(linearAxis))])
+        first /= np.linalg.norm(first)
+        second = np.cross(linearAxis, first)
+        for axis in [linearAxis, first, second]:
+            tryAdd(_rotationMatrix(axis, np.pi))
+            tryAdd(_reflectionMatrix(axis))
+    else:
+        for axis in _candidateDirections(coordinates, atomicNumbers, masses, tolerance):
+            tryAdd(_reflectionMatrix(axis))
+            for order in range(2, maxAxisOrder + 1):
+                rotation = _rotationMatrix(axis, 2 * np.pi / order)
+                tryAdd(rotation)
+                tryAdd(np.matmul(_reflectionMatrix(axis), rotation))
+
+    # Complete the group (higher powers and products of the found operations)
+    nKnown = 0
+    while nKnown != len(operations):
+        nKnown = len(operations)
+        for lhs, rhs in [(a, b) for a in operations[:nKnown] for b in operations[:nKnown]]:
+            tryAdd(np.matmul(lhs.matrix, rhs.matrix))
+            if len(operations) > maxGroupOrder:
+                raise RuntimeError(
+                    "More than %d symmetry operations found, the tolerance (%g) is too loose"
+                    % (maxGroupOrder, tolerance)
+                )
+
+    return operations
+
+
+def symmetryUniqueAtoms(
+    operations: List[SymmetryOperation],
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Partitions the atoms into sets of symmetry-equivalent atoms. Returns the indices of one
+    representative atom per set and, for every atom, the index of an operation that maps the
+    respective representative onto it"""
+    nAtoms = len(operations[0].permutation)
+
+    generator = -np.ones(nAtoms, dtype=int)
+    representatives = []
+
+    for atom in range(nAtoms):
+        if generator[atom] >= 0:
+            continue
+        representatives.append(atom)
+        for opIdx, op in enumerate(operations):
+            image = op.permutation[atom]
+            if generator[image] < 0:
+                generator[image] = opIdx
+
+    return np.array(representatives, dtype=int), generator
+
+
+def expandCartesianDerivatives(
+    derivatives: Dict[int, np.ndarray], operations: List[SymmetryOperation]
+) -> Dict[int, np.ndarray]:
+    """Reconstructs the derivatives of a Cartesian tensor property w.r.t. the displacements of all atoms
+    from the ones of the symmetry-unique atoms. derivatives maps the atom index to an array of shape
+    (3, ...) holding the derivatives along x, y and z. It has to contain (at least) the representatives
+    as returned by symmetryUniqueAtoms. Derivatives are given in the same (laboratory) frame as the
+    geometry from which the operations have been determined"""
+    nAtoms = len(operations[0].permutation)
+    expanded = dict(derivatives)
+
+    for atom in range(nAtoms):
+        if atom in expanded:
+            continue
+
+        for op in operations:
+            source = int(np.nonzero(op.permutation == atom)[0][0])
+            if source not in derivatives:
+                continue
+
+            # Displacing atom `source` along e_c is mapped onto displacing `atom` along R e_c. Since R is
+            # orthogonal, the derivative along e_c' is sum_c R[c', c] * R dT/dx_{source, c} R^T
+            transformed = np.array([op.transformTensor(d) for d in derivatives[source]])
+            expanded[atom] = np.tensordot(op.matrix, transformed, axes=([1], [0]))
+            break
+        else:
+            raise RuntimeError("No derivative available that is equivalent to atom %d" % atom)
+
+    return expanded
+
+
+def findEquivalentDisplacement(
+    displacement: ArrayLike,
+    references: List[np.ndarray],
+    operations: List[SymmetryOperation],
+    tolerance: float = 1e-6,
+) -> Optional[Tuple[int, int]]:
+    """Checks whether the given (nAtoms, 3) displacement of the reference geometry is the symmetry image of
+    one of the given reference displacements. Returns the tuple (index of reference, index of operation
+    mapping the reference onto the given displacement) or None if the displacement is symmetry-unique"""
+    displacement = np.asarray(displacement)
+
+    for refIdx, reference in enumerate(references):
+        for opIdx, op in enumerate(operations):
+            if np.max(np.abs(op.transformDisplacement(reference) - displacement)) < tolerance:
+                return refIdx, opIdx
+
+    return None
+
+
+class UniqueDisplacements:
+    """Collects symmetry-unique (nAtoms, 3) displacements of a reference geometry. Every displacement is
+    mapped onto a canonical key, the lexicographically smallest of its symmetry images rounded to multiples
+    of tolerance, such that equivalent displacements are found by a dictionary lookup instead of comparing
+    against all previous displacements (see findEquivalentDisplacement). Equivalent displacements whose
+    images happen to fall on different sides of a rounding boundary are not recognized and are treated as
+    unique; this only costs an additional calculation.
+
+    Usage:
+        unique = UniqueDisplacements(findSymmetryOperations(molecule))
+        equivalent = unique.add(displacement)
+        if equivalent is None:
+            # new displacement, to be computed
+        else:
+            refIdx, opIdx = equivalent
+    """
+
+    def __init__(self, operations: List[SymmetryOperation], tolerance: float = 1e-6):
+        self.operations = operations
+        self.tolerance = tolerance
+        self.displacements: List[np.ndarray] = []
+
+        self._matrices = np.array([op.matrix for op in operations])
+        # image[permutation[i]] = R d[i], i.e. image = (R d)[inverse permutation]
+        self._inversePermutations = np.argsort([op.permutation for op in operations], axis=1)
+        # index of the operation used for the canonical key of every stored displacement
+        self._keys: Dict[bytes, Tuple[int, int]] = {}
+
+    def _canonicalKey(self, displacement: np.ndarray) -> Tuple[bytes, int]:
+        """Returns the canonical key of the given displacement and the index of the operation producing it"""
+        transformed = np.einsum("gij,nj->gni", self._matrices, displacement)
+        images = np.take_along_axis(transformed, self._inversePermutations[:, :, np.newaxis], axis=1)
+        rounded = np.round(images.reshape((len(self.operations), -1)) / self.tolerance).astype(np.int64)
+
+        # np.lexsort sorts by the last key first
+        opIdx = int(np.lexsort(rounded.T[::-1])[0])
+
+        return rounded[opIdx].tobytes(), opIdx
+
+    def _findOperation(self, matrix: np.ndarray) -> int:
+        for opIdx, op in enumerate(self.operations):
+            if np.allclose(op.matrix, matrix, atol=1e-6):
+                return opIdx
+
+        raise RuntimeError("The symmetry operations don't form a group")
+
+    def add(self, displacement: ArrayLike) -> Optional[Tuple[int, int]]:
+        """Adds the given displacement if it is not equivalent to one added before. Returns None for new
+        displacements and otherwise the tuple (index of the equivalent displacement, index of the operation
+        mapping it onto the given one) like findEquivalentDisplacement"""
+        displacement = np.asarray(displacement, dtype=float)
+        key, opIdx = self._canonicalKey(displacement)
+
+        if key not in self._keys:
+            self._keys[key] = (len(self.displacements), opIdx)
+            self.displacements.append(displacement)
+            return None
+
+        # G_new d_new = G_ref d_ref (= canonical image), hence d_new = G_new^T G_ref d_ref
+        refIdx, refOpIdx = self._keys[key]
+        matrix = np.matmul(self.operations[opIdx].matrix.T, self.operations[refOpIdx].matrix)
+
+        return refIdx, self._findOperation(matrix)
+
+
+def writeDisplacementEquivalences(path: str, equivalences: List[Tuple[str, str, np.ndarray]]) -> None:
+    """Writes the equivalences (name of the skipped displacement, name of the equivalent computed
+    displacement, 3x3 operation matrix R mapping the computed onto the skipped displacement) of a set of
+    displaced geometries to a file (see readDisplacementEquivalences)"""
+    with open(path, "w") as outputFile:
+        outputFile.write("# skipped geometry, equivalent computed geometry, R (row-wise)\n")
+        outputFile.write("# tensor properties are obtained as T(skipped) = R T(computed) R^T\n")
+        for skipped, computed, matrix in equivalences:
+            outputFile.write(
+                f"{skipped} {computed} " + " ".join(f"{x: .10f}" for x in np.reshape(matrix, -1)) + "\n"
+            )
+
+
+def readDisplacementEquivalences(path: str) -> List[Tuple[str, str, np.ndarray]]:
+    """Reads a file written by writeDisplacementEquivalences (e.g. the *_equivalences file of the
+    generate_displacements script)"""
+    equivalences = []
+    with open(path, "r") as inputFile:
+        for line in inputFile:
+            if not line.strip() or line.startswith("#"):
+                continue
+            parts = line.split()
+            if len(parts) != 11:
+                raise RuntimeError("Invalid line in displacement equivalences file '%s': %s" % (path, line))
+            equivalences.append((parts[0], parts[1], np.array(parts[2:], dtype=float).reshape((3, 3))))
+
+    return equivalences
+
+
+def expandDisplacementProperties(
+    properties: Dict[str, np.ndarray], equivalences: List[Tuple[str, str, np.ndarray]]
+) -> Dict[str, np.ndarray]:
+    """Reconstructs a Cartesian tensor property of the molecule (e.g. the g- or D-tensor) for the skipped
+    displaced geometries from the equivalent computed ones: T(skipped) = R T(computed) R^T (generalized
+    to tensors of any rank). properties maps the names of the computed geometries to their property"""
+    expanded = dict(properties)
+
+    for skipped, computed, matrix in equivalences:
+        if computed not in properties:
+            raise RuntimeError("No property available for displaced geometry '%s'" % computed)
+        expanded[skipped] = SymmetryOperation(matrix, np.empty(0, dtype=int)).transformTensor(properties[computed])
+
+    return expanded
@@ -1,5 +1,56 @@
-from .Element import Element
+from .Element import (
+    Element,
+    BlockCodes,
+    ElementSymbolTable,
+    ElementMassTable,
+    ElementGroupTable,
+    ElementPeriodTable,
+    ElementBlockTable,
+    ElementCovalentRadiusTable,
+    atomicNumberFromLabel,
+    symbolsToAtomicNumbers,
+)
 from .Molecule import Molecule
 from .Atom import Atom
-from .IO import readMolecule, writeMolecule
+from .IO import (
+    readMolecule,
+    writeMolecule,
+    readTrajectory,
+    writeTrajectory,
+    FileFormat,
+    guessFileFormat,
+)
+from .GeometryArchive import GeometryArchive
+from .Connectivity import findBonds, bondGraph, findFragments
+from .InternalCoordinates import (
+    bondLengths,
+    bondAngles,
+    dihedralAngles,
+    bondLengthDerivatives,
+    bondAngleDerivatives,
+    dihedralAngleDerivatives,
+    internalCoordinates,
+    internalCoordinateIndices,
+    wilsonBMatrix,
+)
+from .Symmetry import (
+    SymmetryOperation,
+    findSymmetryOperations,
+    symmetryUniqueAtoms,
+    expandCartesianDerivatives,
+    findEquivalentDisplacement,
+    UniqueDisplacements,
+    writeDisplacementEquivalences,
+    readDisplacementEquivalences,
+    expandDisplacementProperties,
+)
+from .Deduplication import findDuplicateGeometries
+from .Comparison import (
+    distanceMatrix,
+    rmsd,
+    maxDeviation,
+    pairwiseRMSD,
+    pairwiseMaxDeviation,
+    sameGeometry,
+)
 from .Eckart import Eckart_alignment, check_Eckart
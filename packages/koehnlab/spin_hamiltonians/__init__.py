@@ -1,7 +1,24 @@
 from .phys_const import au2K, au2rcm, au2K, muBcm, kBcm, cCGS, ChiCGS, ChiVVCGS
 from .phys_utils import getBoltzmannFactors, CGauss, CLorentz
 from .properties import getChiVV
-from .spin_utils import spinMat, unit, tprod, diagonalizeSpinHamiltonian,A_to_g,getMagneticAxes, spin_mat
+from .spin_utils import spinMat, spinOperators, spinLadderOperators, spinSquared, spinQuadraticOperators, unit, tprod, diagonalizeSpinHamiltonian, diagonalizeFieldSweep, fieldSweepLevels, diagonalizeLowField, resolveDegeneracies, A_to_g,getMagneticAxes, getMagneticAxesBatched, gerlochMcMeekingTensor, kramersDoubletMoments, spin_mat
 from .spin_systems import Spin, SpinSystem, SpinType
 from .g_tensor import compute_magnetic_moment_matrix, compute_A_matrix, compute_g_tensor
 from .coordinate import Coordinate2D, Coordinate3D
+from .coupled_basis import KambeBasis, clebsch_gordan, wigner_6j
+from .parametric import ParametricHamiltonian
+from .fitting import SpinHamiltonianFit
+from .spectra import broaden_sticks
+from .thermodynamics import thermodynamics, ThermodynamicProperties
+from .adaptive_sweep import adaptive_sweep, adaptive_field_sweep, adaptive_orientation_sweep, follow_levels
+from .epr import EigenfieldSolver, FieldSweepSolver, resonance_intensities, EPRObservable, epr_spectrum, line_shape, frequency_to_rcm
+from .powder import (
+    orientation_grid,
+    lebedev_grid,
+    zcw_grid,
+    spherical_design,
+    reduce_by_inversion,
+    powder_average,
+    powder_magnetization,
+    MagnetizationObservable,
+)
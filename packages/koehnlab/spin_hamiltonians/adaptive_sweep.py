@@ -0,0 +1,156 @@
+from collections import deque
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from .phys_const import muBcm
+from .spin_utils import resolveDegeneracies
+
+""" Adaptive sweeps of the magnetic field along a path B(s), s in [0, 1] (field strength at fixed
+    direction or direction at fixed strength). Starting from a coarse uniform grid, intervals are
+    bisected as long as the energies or magnetic moments at the midpoint deviate from the linear
+    interpolation between the end points, or as long as the eigenvectors change too quickly (levels
+    cross or avoid each other) - so points are concentrated near level crossings. The levels are
+    followed across the sweep by maximum eigenvector overlap. """
+
+
+def _solve(Hmat, Mmat, Bfield, degThr):
+    """ as diagonalizeSpinHamiltonian, but degenerate levels (closer than degThr) are resolved by
+        their moment along the field; the default threshold there would mix quasi-degenerate levels
+        close to a crossing, which must stay eigenvectors to be followed """
+    # H_Zeeman = - M B
+    En, U = np.linalg.eigh(Hmat-muBcm*np.tensordot(Bfield, Mmat, axes=1))
+
+    norm = np.linalg.norm(Bfield)
+    if norm > 0.:
+        Mdir = np.tensordot(np.asarray(Bfield)/norm, Mmat, axes=1)
+        U = resolveDegeneracies(En, U, np.matmul(np.conj(U.T), np.matmul(Mdir, U)), degThr)
+    Mu = np.einsum("ki,ckl,li->ci", np.conj(U), Mmat, U).real
+
+    return En, U, Mu
+
+
+def _assignment(Ua, Ub):
+    """ permutation perm (levels of b in the order of a) maximizing the eigenvector overlaps """
+    overlap = np.abs(np.matmul(np.conj(Ua.T), Ub))**2
+    _, perm = linear_sum_assignment(-overlap)
+    return perm
+
+
+def _blocks(En, thr):
+    """ index of the (quasi-)degenerate block of every level (ascending energies) """
+    return np.concatenate(([0], np.cumsum(np.diff(En) >= thr)))
+
+
+def _continuity(Ea, Ua, Eb, Ub, degThr):
+    """ smallest overlap between the spaces of corresponding (same position in energy) levels of two
+        points; degenerate levels are treated as one space, such that their arbitrary mixing does not
+        matter; a small value signals a level crossing or rapid mixing """
+    overlap = np.abs(np.matmul(np.conj(Ua.T), Ub))**2
+    blocks_a = _blocks(Ea, degThr)
+    blocks_b = _blocks(Eb, degThr)
+    same_a = blocks_a[:, np.newaxis] == blocks_a[np.newaxis, :]
+    same_b = blocks_b[:, np.newaxis] == blocks_b[np.newaxis, :]
+    # for level k: overlap of the space of its block at a with the space of its block at b
+    size = np.minimum(np.sum(same_a, axis=1), np.sum(same_b, axis=1))
+    shared = np.einsum("ki,ij,kj->k", same_a, overlap, same_b)
+    return np.min(shared/size)
+
+
+def follow_levels(U):
+    """ permutations perm[n,dim] that order the eigenvectors U[n,dim,dim] of successive points such that
+        column k of U[i][:, perm[i]] continues column k of the previous point (level following) """
+    perm = np.zeros((len(U), U.shape[2]), dtype=int)
+    perm[0] = np.arange(U.shape[2])
+    for ii in range(1, len(U)):
+        perm[ii] = _assignment(U[ii-1][:, perm[ii-1]], U[ii])
+    return perm
+
+
+def adaptive_sweep(Hmat, Mmat, path, npoints=11, tolE=1e-2, tolM=1e-2, overlapThr=0.9, minStep=1e-4,
+                   maxPoints=2000, follow=True, degThr=1e-6):
+    """ adaptive sweep along the field path (callable s -> Bfield (x,y,z) in Tesla, s in [0, 1])
+        Hmat in cm-1, Mmat[3,dim,dim] in Bohr magnetons; starts with npoints equidistant points
+        an interval is bisected if, at its midpoint, any energy deviates by more than tolE (cm-1) or any
+        moment by more than tolM (Bohr magnetons) from the linear interpolation, or if the eigenvectors
+        of neighboring points cannot be matched with overlaps above overlapThr (rapid mixing or a
+        level crossing; levels closer than degThr are matched as one space); intervals shorter than
+        minStep are not bisected and at most maxPoints points are computed
+        returns s[n], the fields B[n,3], En[n,dim], Mu[n,3,dim] and U[n,dim,dim]; with follow set,
+        the levels are reordered such that every column follows one level continuously (otherwise
+        the energies are in ascending order) """
+    Hmat = np.asarray(Hmat)
+    Mmat = np.asarray(Mmat)
+
+    points = {}
+    for s in np.linspace(0., 1., npoints):
+        points[s] = _solve(Hmat, Mmat, path(s), degThr)
+
+    svals = sorted(points)
+    todo = deque(zip(svals[:-1], svals[1:]))
+    while todo and len(points) < maxPoints:
+        sa, sb = todo.popleft()
+        if sb-sa < 2*minStep:
+            continue
+        sm = 0.5*(sa+sb)
+        points[sm] = _solve(Hmat, Mmat, path(sm), degThr)
+
+        (Ea, Ua, Ma), (Em, Um, Mm), (Eb, Ub, Mb) = points[sa], points[sm], points[sb]
+        refine = np.max(np.abs(Em-0.5*(Ea+Eb))) > tolE or np.max(np.abs(Mm-0.5*(Ma+Mb))) > tolM
+        if not refine:
+            # levels must keep their character (and order) on both halves
+            worst = min(_continuity(Ea, Ua, Em, Um, degThr), _continuity(Em, Um, Eb, Ub, degThr))
+            refine = worst < overlapThr
+        if refine:
+            todo.append((sa, sm))
+            todo.append((sm, sb))
+
+    svals = np.array(sorted(points))
+    En = np.array([points[s][0] for s in svals])
+    U = np.array([points[s][1] for s in svals])
+    Mu = np.array([points[s][2] for s in svals])
+    fields = np.array([path(s) for s in svals])
+
+    if follow:
+        perm = follow_levels(U)
+        En = np.take_along_axis(En, perm, axis=1)
+        Mu = np.take_along_axis(Mu, perm[:, np.newaxis, :], axis=2)
+        U = np.take_along_axis(U, perm[:, np.newaxis, :], axis=2)
+
+    return svals, fields, En, Mu, U
+
+
+def adaptive_field_sweep(Hmat, Mmat, Bmin, Bmax, Bdirection=None, **kwargs):
+    """ adaptive sweep of the field strength from Bmin to Bmax (Tesla) along Bdirection (default: z);
+        see adaptive_sweep for the options; returns the field strengths instead of s """
+    if Bdirection is None:
+        Bdirection = [0., 0., 1.]
+    Bdirection = np.asarray(Bdirection, dtype=float)
+    Bdirection = Bdirection/np.linalg.norm(Bdirection)
+
+    svals, fields, En, Mu, U = adaptive_sweep(Hmat, Mmat, lambda s: (Bmin+s*(Bmax-Bmin))*Bdirection, **kwargs)
+
+    return Bmin+svals*(Bmax-Bmin), En, Mu, U
+
+
+def adaptive_orientation_sweep(Hmat, Mmat, Bvalue, direction1, direction2, **kwargs):
+    """ adaptive sweep of the field direction (at field strength Bvalue in Tesla) along the great circle
+        from direction1 to direction2 (not antiparallel); see adaptive_sweep for the options;
+        returns the rotation angles (rad), the field directions, En, Mu and U """
+    n1 = np.asarray(direction1, dtype=float)
+    n1 = n1/np.linalg.norm(n1)
+    n2 = np.asarray(direction2, dtype=float)
+    n2 = n2/np.linalg.norm(n2)
+    angle = np.arccos(np.clip(np.dot(n1, n2), -1., 1.))
+    if angle < 1e-12:
+        raise Exception("The directions of an orientation sweep must differ")
+    # unit vector perpendicular to n1 in the plane of rotation
+    perp = n2-np.dot(n1, n2)*n1
+    perp /= np.linalg.norm(perp)
+
+    def path(s):
+        return Bvalue*(np.cos(s*angle)*n1+np.sin(s*angle)*perp)
+
+    svals, fields, En, Mu, U = adaptive_sweep(Hmat, Mmat, path, **kwargs)
+
+    return svals*angle, fields/Bvalue, En, Mu, U
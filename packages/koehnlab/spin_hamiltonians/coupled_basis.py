@@ -0,0 +1,319 @@
+from functools import lru_cache
+from math import factorial, sqrt
+
+import numpy as np
+import scipy.sparse as sps
+
+from .spin_systems import SpinSystem, numThr
+
+""" Coupled total-spin basis (Kambe approach) for exchange-coupled clusters: the spins are coupled
+    successively, (((s1 s2) S12 s3) S123 ...) S, and isotropic exchange is evaluated with irreducible
+    tensor methods, such that the Hamiltonian is obtained directly in (S, M) blocks """
+
+
+def _twice(j):
+    tj = int(round(2*j))
+    assert abs(tj - 2*j) < 1e-8, "Only integer and half-integer quantum numbers are allowed"
+    return tj
+
+
+def _triangle(a, b, c):
+    """ check triangle condition and integer perimeter (all arguments given as twice the value) """
+    return abs(a-b) <= c <= a+b and (a+b+c) % 2 == 0
+
+
+def _delta(a, b, c):
+    # arguments given as twice the value
+    return sqrt(factorial((a+b-c)//2)*factorial((a-b+c)//2)*factorial((-a+b+c)//2)/factorial((a+b+c)//2+1))
+
+
+@lru_cache(maxsize=None)
+def _cg(j1, m1, j2, m2, J, M):
+    # arguments given as twice the value
+    if m1+m2 != M or not _triangle(j1, j2, J):
+        return 0.
+    if abs(m1) > j1 or abs(m2) > j2 or abs(M) > J:
+        return 0.
+
+    pref = sqrt((J+1)*factorial((J+j1-j2)//2)*factorial((J-j1+j2)//2)*factorial((j1+j2-J)//2)
+                / factorial((j1+j2+J)//2+1))
+    pref *= sqrt(factorial((J+M)//2)*factorial((J-M)//2)*factorial((j1-m1)//2)*factorial((j1+m1)//2)
+                 * factorial((j2-m2)//2)*factorial((j2+m2)//2))
+
+    total = 0.
+    for k in range(0, (j1+j2-J)//2+1):
+        args = [(j1+j2-J)//2-k, (j1-m1)//2-k, (j2+m2)//2-k, (J-j2+m1)//2+k, (J-j1-m2)//2+k]
+        if min(args) < 0:
+            continue
+        denom = factorial(k)
+        for arg in args:
+            denom *= factorial(arg)
+        total += (-1)**k/denom
+
+    return pref*total
+
+
+def clebsch_gordan(j1, m1, j2, m2, J, M):
+    """ Clebsch-Gordan coefficient <j1 m1 j2 m2|J M> (Condon-Shortley phase convention);
+        results are cached """
+    return _cg(_twice(j1), _twice(m1), _twice(j2), _twice(m2), _twice(J), _twice(M))
+
+
+@lru_cache(maxsize=None)
+def _6j(a, b, c, d, e, f):
+    # arguments given as twice the value
+    if not (_triangle(a, b, c) and _triangle(a, e, f) and _triangle(d, b, f) and _triangle(d, e, c)):
+        return 0.
+
+    pref = _delta(a, b, c)*_delta(a, e, f)*_delta(d, b, f)*_delta(d, e, c)
+
+    tmin = max(a+b+c, a+e+f, d+b+f, d+e+c)//2
+    tmax = min(a+b+d+e, b+c+e+f, c+a+f+d)//2
+    total = 0.
+    for t in range(tmin, tmax+1):
+        denom = (factorial(t-(a+b+c)//2)*factorial(t-(a+e+f)//2)*factorial(t-(d+b+f)//2)
+                 * factorial(t-(d+e+c)//2)*factorial((a+b+d+e)//2-t)*factorial((b+c+e+f)//2-t)
+                 * factorial((c+a+f+d)//2-t))
+        total += (-1)**t*factorial(t+1)/denom
+
+    return pref*total
+
+
+def wigner_6j(j1, j2, j3, j4, j5, j6):
+    """ Wigner 6j symbol {j1 j2 j3; j4 j5 j6}; results are cached """
+    return _6j(_twice(j1), _twice(j2), _twice(j3), _twice(j4), _twice(j5), _twice(j6))
+
+
+class KambeBasis:
+    """ Successively coupled total-spin basis of a SpinSystem (coupling in the order of the system)
+        Usage:
+            basis = KambeBasis(sp_sys)
+            En, Svals, coeffs = basis.diagonalize()
+        Only the isotropic part of the interactions (Jiso) enters the block-diagonal Hamiltonian;
+        zero-field terms, anisotropic exchange and Zeeman terms can be included afterwards within
+        a truncated set of low-lying multiplets via diagonalize_truncated """
+
+    def __init__(self, spin_system: SpinSystem):
+        self.spin_system = spin_system
+        self.order = list(spin_system.order)
+        self.spin_qns = [spin_system.spins[label].S for label in self.order]
+
+        # every state is characterized by its coupling path (s1, S12, S123, ..., S);
+        # reduced matrix elements <path'||S_i||path> are kept as sparse matrices
+        paths = [(self.spin_qns[0],)]
+        s = self.spin_qns[0]
+        reduced = [sps.csr_matrix([[sqrt(s*(s+1)*(2*s+1))]])]
+
+        for s in self.spin_qns[1:]:
+            paths, reduced = self._couple(paths, reduced, s)
+
+        self.paths = paths
+        self.S = np.array([path[-1] for path in paths])
+        self.reduced = reduced
+
+
+    @staticmethod
+    def _couple(paths, reduced, s):
+        """ couple one more spin s to all given paths and transform the reduced matrix elements """
+
+        Sp_old = np.array([path[-1] for path in paths])
+        count = (np.minimum(Sp_old, s)*2+1).round().astype(int)
+        start = np.concatenate(([0], np.cumsum(count)[:-1]))
+
+        # the children of every path are stored contiguously, with ascending J
+        parents = np.repeat(np.arange(len(paths)), count)
+        offsets = np.arange(len(parents))-start[parents]
+        Sp = Sp_old[parents]
+        J = np.abs(Sp-s)+offsets
+        new_paths = [paths[idx]+(float(j),) for idx, j in zip(parents, J)]
+        nnew = len(new_paths)
+
+        def transformed(r, c, vals, part1):
+            # expand all (parent row, parent col) pairs into all pairs of children
+            rows, cols, data = [], [], []
+            for a in range(int(count.max())):
+                for b in range(int(count.max())):
+                    valid = (a < count[r]) & (b < count[c])
+                    rn = start[r[valid]]+a
+                    cn = start[c[valid]]+b
+                    close = np.abs(J[rn]-J[cn]) <= 1.
+                    rows.append(rn[close])
+                    cols.append(cn[close])
+                    data.append(vals[valid][close])
+            rn = np.concatenate(rows)
+            cn = np.concatenate(cols)
+            data = np.concatenate(data)
+
+            if part1:
+                # <Sp' s J'||T(1)||Sp s J> = (-1)^(Sp'+s+J+1) [(2J+1)(2J'+1)]^1/2 {Sp' J' s; J Sp 1} <Sp'||T||Sp>
+                keys = np.stack((Sp[rn], J[rn], J[cn], Sp[cn]), axis=1)
+                phase_exp = Sp[rn]+s+J[cn]+1
+            else:
+                # <Sp s J'||T(2)||Sp s J> = (-1)^(Sp+s+J'+1) [(2J+1)(2J'+1)]^1/2 {s J' Sp; J s 1} <s||T||s>
+                keys = np.stack((J[rn], J[cn], Sp[rn]), axis=1)
+                phase_exp = Sp[rn]+s+J[rn]+1
+
+            # evaluate the 6j symbols only once for every distinct combination of quantum numbers
+            # (encoded as a single integer built from twice the values)
+            twice_keys = np.round(2*keys).astype(np.int64)
+            base = int(twice_keys.max())+1
+            codes = np.zeros(len(twice_keys), dtype=np.int64)
+            for col in range(twice_keys.shape[1]):
+                codes = codes*base+twice_keys[:, col]
+            _, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+            unique = keys[first]
+            if part1:
+                sixj = np.array([wigner_6j(k[0], k[1], s, k[2], k[3], 1) for k in unique])
+            else:
+                sixj = np.array([wigner_6j(s, k[0], k[2], k[1], s, 1) for k in unique])
+            sixj = sixj[inverse.reshape(-1)]
+
+            phase = np.where(np.round(phase_exp) % 2 == 0, 1., -1.)
+            data = data*phase*np.sqrt((2*J[cn]+1)*(2*J[rn]+1))*sixj
+            keep = np.abs(sixj) > numThr
+
+            return sps.csr_matrix((data[keep], (rn[keep], cn[keep])), shape=(nnew, nnew))
+
+        new_reduced = []
+        # operators acting on the already coupled part
+        for red in reduced:
+            red = red.tocoo()
+            new_reduced.append(transformed(red.row, red.col, red.data, True))
+
+        # the newly added spin
+        diag = np.arange(len(paths))
+        new_reduced.append(transformed(diag, diag, np.full(len(paths), sqrt(s*(s+1)*(2*s+1))), False))
+
+        return new_paths, new_reduced
+
+
+    def get_scalar_product(self, idx1, idx2):
+        """ matrix of S_i.S_j (positions idx1, idx2 in the coupling order) in the coupled basis;
+            the operator is diagonal in S and independent of M """
+
+        # <a S||T.U||b S> / (2S+1) = sum_c (-1)^(S-S_c) <a S||T||c S_c><c S_c||U||b S> / (2S+1)
+        red1 = self.reduced[idx1].tocoo()
+        phase = np.where(np.round(self.S[red1.row]-self.S[red1.col]) % 2 == 0, 1., -1.)
+        red1 = sps.csr_matrix((red1.data*phase, (red1.row, red1.col)), shape=red1.shape)
+
+        prod = (red1 @ self.reduced[idx2]).tocoo()
+        keep = np.abs(self.S[prod.row]-self.S[prod.col]) < 1e-8
+        rows = prod.row[keep]
+        cols = prod.col[keep]
+
+        return sps.csr_matrix((prod.data[keep]/(2*self.S[rows]+1), (rows, cols)), shape=prod.shape)
+
+
+    def get_exchange_mat(self):
+        """ isotropic exchange Hamiltonian sum_ij Jiso_ij S_i.S_j in the coupled basis (sparse); unit is cm-1 """
+
+        Hmat = sps.csr_matrix((len(self.paths), len(self.paths)))
+        for label1, label2, Jmat in self.spin_system.interaction:
+            Jiso = np.trace(Jmat)/3.
+            if abs(Jiso) < numThr:
+                continue
+            Hmat = Hmat + Jiso*self.get_scalar_product(self.order.index(label1), self.order.index(label2))
+
+        return Hmat.tocsr()
+
+
+    def diagonalize(self, nstates=None):
+        """ diagonalize the isotropic exchange Hamiltonian block by block (one block per total S)
+            returns the multiplet energies (ascending; each (2S+1)-fold degenerate), the total
+            spins and the eigenvectors of the nstates lowest multiplets (all if not given) as
+            columns of a sparse matrix in the coupled basis """
+
+        Hmat = self.get_exchange_mat()
+
+        En = []
+        Svals = []
+        blocks = []
+        for S in np.unique(self.S):
+            block = np.nonzero(np.abs(self.S-S) < 1e-8)[0]
+            Eblk, Ublk = np.linalg.eigh(Hmat[block][:, block].toarray())
+            En.append(Eblk)
+            Svals.append(np.full(len(block), S))
+            blocks.append((block, Ublk))
+
+        En = np.concatenate(En)
+        Svals = np.concatenate(Svals)
+        # position of each multiplet within its block
+        owner = np.concatenate([np.full(len(block), idx) for idx, (block, _) in enumerate(blocks)])
+        local = np.concatenate([np.arange(len(block)) for block, _ in blocks])
+
+        order = np.argsort(En, kind="stable")
+        if nstates is not None:
+            order = order[:nstates]
+
+        rows, cols, vals = [], [], []
+        for col, idx in enumerate(order):
+            block, Ublk = blocks[owner[idx]]
+            rows.append(block)
+            cols.append(np.full(len(block), col))
+            vals.append(Ublk[:, local[idx]])
+        coeffs = sps.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                                shape=(len(self.paths), len(order)))
+
+        return En[order], Svals[order], coeffs
+
+
+    def get_product_vectors(self, coeffs, S):
+        """ expand the coupled-basis state with coefficients coeffs (all paths with total spin S)
+            into the product basis of the spin system; returns the vectors for M = S, S-1, ..., -S
+            as columns of a (dimension, 2S+1) array """
+
+        dims = [_twice(s)+1 for s in self.spin_qns]
+        cache = {}
+
+        def vector(path, M):
+            # product-basis vector of |s1 S12 ... path[-1] M> for the first len(path) spins
+            key = (path, M)
+            if key in cache:
+                return cache[key]
+            n = len(path)
+            if n == 1:
+                vec = np.zeros(dims[0])
+                vec[int(round(path[0]-M))] = 1.
+            else:
+                s = self.spin_qns[n-1]
+                vec = np.zeros(int(np.prod(dims[:n])))
+                for m2 in np.arange(-s, s+0.5):
+                    m1 = M-m2
+                    if abs(m1) > path[-2]+1e-8:
+                        continue
+                    cg = clebsch_gordan(path[-2], m1, s, m2, path[-1], M)
+                    if abs(cg) < numThr:
+                        continue
+                    unit = np.zeros(dims[n-1])
+                    unit[int(round(s-m2))] = 1.
+                    vec += cg*np.kron(vector(path[:-1], m1), unit)
+            cache[key] = vec
+            return vec
+
+        coeffs = np.asarray(coeffs).reshape(-1)
+        vectors = np.zeros((self.spin_system.dimension, _twice(S)+1))
+        for idx in np.nonzero(np.abs(coeffs) > numThr)[0]:
+            path = self.paths[idx]
+            assert abs(path[-1]-S) < 1e-8
+            for k, M in enumerate(np.arange(S, -S-0.5, -1)):
+                vectors[:, k] += coeffs[idx]*vector(path, float(M))
+
+        return vectors
+
+
+    def diagonalize_truncated(self, nmultiplets, Bfield=None):
+        """ diagonalize the full Hamiltonian of the spin system (including zero-field terms, anisotropic
+            exchange and the Zeeman term for Bfield (x,y,z) in Tesla) within the space spanned by the
+            nmultiplets lowest multiplets of the isotropic exchange Hamiltonian
+            returns the energies (cm-1) and the eigenvectors (columns) in the product basis """
+
+        En, Svals, coeffs = self.diagonalize(nmultiplets)
+
+        V = np.concatenate([self.get_product_vectors(coeffs[:, idx].toarray(), Svals[idx])
+                            for idx in range(nmultiplets)], axis=1)
+
+        HV = self.spin_system.get_H_operator(Bfield).matmat(V.astype(complex))
+        Hsub = np.matmul(V.T, HV)
+        Esub, Usub = np.linalg.eigh(0.5*(Hsub+np.conj(Hsub.T)))
+
+        return Esub, np.matmul(V, Usub)
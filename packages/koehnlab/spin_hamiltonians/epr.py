@@ -0,0 +1,344 @@
+import numpy as np
+import scipy.linalg
+
+from .phys_const import muBcm, kBcm, cCGS
+from .powder import orientation_grid, powder_average
+from .spectra import broaden_sticks
+from .spin_utils import fieldSweepLevels
+
+""" Field-swept EPR spectra by the eigenfield method: for H(B) = F + B G with G = -muB n.M, the
+    resonance fields at fixed microwave frequency are the eigenvalues B of the generalized eigenvalue
+    problem in Liouville space
+        (hv - [F, .]) X = B [G, .] X,
+    whose eigenvectors are the transition operators X = |u><v| with E_u(B) - E_v(B) = hv
+    (G. G. Belford, R. L. Belford, J. F. Burkhalter; J. Magn. Reson. 11, 251 (1973)).
+    No field grid has to be searched; the spectrum is built from the resulting stick spectrum.
+    The price is a dense generalized eigenvalue problem of dimension dim^2 per orientation, i.e.
+    O(dim^6) operations and O(dim^4) memory, so the method is limited to small spin systems
+    (dim <= 20). Beyond that, FieldSweepSolver locates the resonances on a field grid with
+    O(dim^3) cost per field; measured per orientation (up to 1.5 T at 9.5 GHz):
+        dim         6       12      16      20      36      72
+        eigenfield  2 ms    37 ms   0.19 s  0.7 s   -       -
+        field sweep 4 ms    20 ms   0.04 s  0.08 s  0.5 s   13 s
+    Fields are given in Tesla, frequencies in GHz. """
+
+# largest Liouville space dimension (dim^2) handled by the dense generalized eigensolver
+maxLiouvilleDim = 400
+
+# largest dimension for which EPRObservable uses the eigenfield method by default (field sweep beyond)
+autoEigenfieldDim = 8
+
+
+def frequency_to_rcm(freq):
+    """ convert a microwave frequency in GHz to cm-1 """
+    return freq*1e9/cCGS
+
+
+def _commutator_superop(A):
+    """ matrix of X -> [A, X] acting on row-major vectorized X """
+    unit = np.identity(A.shape[0])
+    return np.kron(A, unit)-np.kron(unit, A.T)
+
+
+def _perpendicular(direction):
+    """ two unit vectors orthogonal to direction (and to each other) """
+    trial = np.array([1., 0., 0.]) if abs(direction[0]) < 0.9 else np.array([0., 1., 0.])
+    e1 = np.cross(direction, trial)
+    e1 /= np.linalg.norm(e1)
+    return e1, np.cross(direction, e1)
+
+
+class EigenfieldSolver:
+    """ resonance fields and transition intensities of a spin Hamiltonian (Hmat in cm-1, magnetic
+        moments Mmat[3,dim,dim] in Bohr magnetons) for arbitrary field directions; the Liouville space
+        superoperators are set up once on first use (and not pickled, such that only the matrices
+        are sent to worker processes)
+        Usage:
+            solver = EigenfieldSolver(sp_sys.get_H_mat(), sp_sys.get_M_mat())
+            fields, intensities = solver.transitions([0., 0., 1.], 9.5, Temp=5.) """
+
+    def __init__(self, Hmat, Mmat):
+        self.Hmat = np.asarray(Hmat)
+        self.Mmat = np.asarray(Mmat)
+        self.dimension = self.Hmat.shape[0]
+        if self.dimension**2 > maxLiouvilleDim:
+            raise Exception(f"Liouville space too large for the eigenfield method: {self.dimension**2} "
+                            "(use FieldSweepSolver instead)")
+
+        self._superops = None
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_superops"] = None
+        return state
+
+
+    def superoperators(self):
+        """ the commutator superoperators of the Hamiltonian and of the three magnetic moments """
+        if self._superops is None:
+            HL = _commutator_superop(self.Hmat)
+            ML = np.array([_commutator_superop(Mc) for Mc in self.Mmat])
+            self._superops = (HL, ML)
+        return self._superops
+
+
+    def fields(self, direction, freq, Bmax=None, thr=1e-8):
+        """ resonance fields (sorted, Tesla) for the field along direction at the microwave frequency
+            freq (GHz); only fields in (0, Bmax] are returned """
+        direction = np.asarray(direction, dtype=float)
+        direction = direction/np.linalg.norm(direction)
+
+        HL, ML = self.superoperators()
+        lhs = frequency_to_rcm(freq)*np.identity(self.dimension**2)-HL
+        # H_Zeeman = - M B
+        rhs = -muBcm*np.tensordot(direction, ML, axes=1)
+        alpha, beta = np.asarray(scipy.linalg.eigvals(lhs, rhs, homogeneous_eigvals=True, check_finite=False))
+
+        # infinite eigenvalues (beta = 0) stem from the kernel of [G, .]
+        finite = np.abs(beta) > thr*np.maximum(np.abs(alpha), 1.)
+        fields = alpha[finite]/beta[finite]
+        fields = fields[np.abs(fields.imag) < 1e-6*np.maximum(np.abs(fields.real), 1.)].real
+        fields = fields[fields > 0.]
+        if Bmax is not None:
+            fields = fields[fields <= Bmax]
+
+        return np.sort(fields)
+
+
+    def transitions(self, direction, freq, Temp=None, Bmax=None, mode="perpendicular", fieldThr=1e-6):
+        """ stick spectrum for the field along direction: resonance fields (Tesla) and intensities
+            (see resonance_intensities) """
+        fields = self.fields(direction, freq, Bmax)
+        return resonance_intensities(self.Hmat, self.Mmat, direction, freq, fields, Temp, mode, fieldThr)
+
+
+class FieldSweepSolver:
+    """ resonance fields and transition intensities like EigenfieldSolver, but found by a field sweep:
+        the levels are computed on nfields equidistant fields in [0, Bmax] (see fieldSweepLevels), the
+        resonances are bracketed by the sign changes of E_u - E_v - hv and refined by Newton steps with
+        the Hellmann-Feynman slopes (bisection where these leave the bracket). Pairs of resonances
+        within one grid step (looping transitions) are found from the sign change of the slope. The
+        cost is O((nfields + refinements) dim^3) per orientation, so any dimension can be treated
+        Usage:
+            solver = FieldSweepSolver(sp_sys.get_H_mat(), sp_sys.get_M_mat())
+            fields, intensities = solver.transitions([0., 0., 1.], 9.5, Temp=5., Bmax=1.) """
+
+    def __init__(self, Hmat, Mmat, nfields=256):
+        self.Hmat = np.asarray(Hmat)
+        self.Mmat = np.asarray(Mmat)
+        self.dimension = self.Hmat.shape[0]
+        self.nfields = nfields
+
+
+    def _levels(self, Bvalues, direction):
+        """ energies [nB,dim] and slopes dE/dB [nB,dim] (cm-1/T) for the fields Bvalues along direction """
+        En, Mu = fieldSweepLevels(self.Hmat, self.Mmat, Bvalues, direction)
+        # dE/dB = -muB <M_n>
+        return En[0], -muBcm*np.einsum("c,bcd->bd", direction, Mu[0])
+
+
+    def fields(self, direction, freq, Bmax, tol=1e-9, maxiter=50):
+        """ resonance fields (sorted, Tesla) in (0, Bmax] for the field along direction at the microwave
+            frequency freq (GHz); tol is the relative accuracy of the resonance condition """
+        if Bmax is None:
+            raise Exception("The field sweep requires the largest field Bmax")
+        direction = np.asarray(direction, dtype=float)
+        direction = direction/np.linalg.norm(direction)
+        hv = frequency_to_rcm(freq)
+
+        # detuning E_u - E_v - hv and its slope for the pairs u > v of (ascending) levels
+        Bvalues = np.linspace(0., Bmax, self.nfields)
+        En, dEn = self._levels(Bvalues, direction)
+        upper, lower = np.tril_indices(self.dimension, k=-1)
+        detuning = En[:, upper]-En[:, lower]-hv
+        slope = dEn[:, upper]-dEn[:, lower]
+
+        positive = detuning > 0.
+        step, pair = np.nonzero(positive[:-1] != positive[1:])
+        lo, hi, flo, fhi = Bvalues[step], Bvalues[step+1], detuning[step, pair], detuning[step+1, pair]
+
+        # the detuning turns towards zero within a step: if it changes sign at the turning point, both
+        # halves contain a resonance (looping transition); the turning point is located by regula falsi
+        # on the slope until the sign change is found or zero is out of reach with the bracketing slopes
+        reach = np.maximum(np.abs(slope[:-1]), np.abs(slope[1:]))*(Bvalues[1]-Bvalues[0])
+        turning = (positive[:-1] == positive[1:]) & (slope[:-1]*slope[1:] < 0.) & \
+            (positive[:-1] == (slope[:-1] < 0.)) & (np.minimum(np.abs(detuning[:-1]), np.abs(detuning[1:])) < reach)
+        tstep, tpair = np.nonzero(turning)
+        a, b = Bvalues[tstep], Bvalues[tstep+1]
+        sa, sb = slope[tstep, tpair], slope[tstep+1, tpair]
+        todo = np.arange(len(tstep))
+        for _ in range(maxiter):
+            if len(todo) == 0:
+                break
+            Bturn = a[todo]+sa[todo]/(sa[todo]-sb[todo])*(b[todo]-a[todo])
+            Eturn, dEturn = self._levels(Bturn, direction)
+            rows = np.arange(len(todo))
+            fturn = Eturn[rows, upper[tpair[todo]]]-Eturn[rows, lower[tpair[todo]]]-hv
+            sturn = dEturn[rows, upper[tpair[todo]]]-dEturn[rows, lower[tpair[todo]]]
+
+            split = (fturn > 0.) != positive[tstep[todo], tpair[todo]]
+            new = todo[split]
+            step, pair = np.concatenate((step, tstep[new], tstep[new])), np.concatenate((pair, tpair[new], tpair[new]))
+            lo = np.concatenate((lo, Bvalues[tstep[new]], Bturn[split]))
+            hi = np.concatenate((hi, Bturn[split], Bvalues[tstep[new]+1]))
+            flo = np.concatenate((flo, detuning[tstep[new], tpair[new]], fturn[split]))
+            fhi = np.concatenate((fhi, fturn[split], detuning[tstep[new]+1, tpair[new]]))
+
+            left = (sturn > 0.) == (sa[todo] > 0.)
+            a[todo], sa[todo] = np.where(left, Bturn, a[todo]), np.where(left, sturn, sa[todo])
+            b[todo], sb[todo] = np.where(left, b[todo], Bturn), np.where(left, sb[todo], sturn)
+            reach = np.maximum(np.abs(sa[todo]), np.abs(sb[todo]))*(b[todo]-a[todo])
+            todo = todo[~split & (np.abs(fturn) < reach) & (b[todo]-a[todo] > tol*Bmax) & (sa[todo] != sb[todo])]
+        if len(step) == 0:
+            return np.zeros(0)
+
+        upper, lower = upper[pair], lower[pair]
+        fields = lo-flo*(hi-lo)/(fhi-flo)
+        active = np.arange(len(fields))
+        for _ in range(maxiter):
+            En, dEn = self._levels(fields[active], direction)
+            rows = np.arange(len(active))
+            f = En[rows, upper[active]]-En[rows, lower[active]]-hv
+            df = dEn[rows, upper[active]]-dEn[rows, lower[active]]
+
+            # shrink the brackets (f has the sign of flo on the lower side of the root)
+            below = (f > 0.) == (flo[active] > 0.)
+            lo[active] = np.where(below, fields[active], lo[active])
+            flo[active] = np.where(below, f, flo[active])
+            hi[active] = np.where(below, hi[active], fields[active])
+            with np.errstate(divide="ignore", invalid="ignore"):
+                newton = fields[active]-f/df
+            inside = np.isfinite(newton) & (newton > lo[active]) & (newton < hi[active])
+            # the resonance condition has to hold and the field has to be accurate (flat detunings)
+            converged = (np.abs(f) < tol*hv) & ((np.abs(f) < tol*Bmax*np.abs(df)) | (hi[active]-lo[active] < tol*Bmax))
+            fields[active] = np.where(converged, fields[active], np.where(inside, newton, 0.5*(lo[active]+hi[active])))
+
+            active = active[~converged]
+            if len(active) == 0:
+                break
+
+        return np.sort(fields[fields > 0.])
+
+
+    def transitions(self, direction, freq, Temp=None, Bmax=None, mode="perpendicular", fieldThr=1e-6):
+        """ stick spectrum for the field along direction: resonance fields (Tesla) and intensities
+            (see resonance_intensities) """
+        fields = self.fields(direction, freq, Bmax)
+        return resonance_intensities(self.Hmat, self.Mmat, direction, freq, fields, Temp, mode, fieldThr)
+
+
+def resonance_intensities(Hmat, Mmat, direction, freq, fields, Temp=None, mode="perpendicular", fieldThr=1e-6):
+    """ stick spectrum at the given resonance fields (Tesla) for the field along direction: the fields
+        (coinciding ones merged) and intensities
+        intensity = <|<u|b1.M|v>|^2> * (population difference) / |d(E_u - E_v)/dB| (in units of muB)
+        with the microwave field b1 perpendicular (averaged over the plane) or parallel (mode) to
+        the static field; the population difference is omitted if no temperature Temp (K) is given """
+    Hmat = np.asarray(Hmat)
+    Mmat = np.asarray(Mmat)
+    direction = np.asarray(direction, dtype=float)
+    direction = direction/np.linalg.norm(direction)
+    hv = frequency_to_rcm(freq)
+
+    fields = np.sort(np.asarray(fields, dtype=float))
+    if len(fields) == 0:
+        return fields, np.zeros(0)
+
+    if mode == "perpendicular":
+        b1dirs = _perpendicular(direction)
+    elif mode == "parallel":
+        b1dirs = (direction,)
+    else:
+        raise Exception(f"Unknown EPR mode: {mode}")
+
+    # coinciding resonances (e.g. degenerate transitions) are found several times; all transitions
+    # of such a group are identified below, so only one field is kept per group
+    groups = np.split(fields, np.nonzero(np.diff(fields) > fieldThr)[0]+1)
+    fields = np.array([np.mean(group) for group in groups])
+
+    Mdir = np.tensordot(direction, Mmat, axes=1)
+    En, U = np.linalg.eigh(Hmat[np.newaxis]-muBcm*fields[:, np.newaxis, np.newaxis]*Mdir)
+    Uh = np.conj(np.swapaxes(U, 1, 2))
+
+    # transitions u <- v with E_u - E_v = hv
+    resonant = np.abs(En[:, :, np.newaxis]-En[:, np.newaxis, :]-hv) < 1e-5*hv
+
+    # d(E_u - E_v)/dB = -muB (<u|M_n|u> - <v|M_n|v>)
+    mvals = np.einsum("fij,jk,fki->fi", Uh, Mdir, U).real
+    slope = np.abs(mvals[:, :, np.newaxis]-mvals[:, np.newaxis, :])
+
+    prob = np.zeros(resonant.shape)
+    for b1 in b1dirs:
+        Mb1 = np.matmul(Uh, np.matmul(np.tensordot(b1, Mmat, axes=1), U))
+        prob += np.abs(Mb1)**2/len(b1dirs)
+
+    if Temp is not None:
+        fBoltz = np.exp(-(En-En[:, :1])/(kBcm*Temp))
+        fBoltz /= np.sum(fBoltz, axis=1)[:, np.newaxis]
+        prob *= fBoltz[:, np.newaxis, :]-fBoltz[:, :, np.newaxis]
+
+    intensities = np.sum(np.where(resonant, prob/np.maximum(slope, 1e-12), 0.), axis=(1, 2))
+
+    return fields, intensities
+
+
+def line_shape(Bgrid, centers, width, shape="gauss"):
+    """ normalized absorption line shapes [ncenters,ngrid] with full width at half maximum width
+        (direct evaluation, e.g. for non-uniform grids; see spectra.broaden_sticks otherwise) """
+    x = np.asarray(Bgrid)[np.newaxis, :]-np.asarray(centers)[:, np.newaxis]
+    if shape == "gauss":
+        sig = width/np.sqrt(8.*np.log(2.))
+        return np.exp(-0.5*(x/sig)**2)/(sig*np.sqrt(2.*np.pi))
+    if shape == "lorentz":
+        gamma = 0.5*width
+        return gamma/(np.pi*(x*x+gamma*gamma))
+    raise Exception(f"Unknown line shape: {shape}")
+
+
+class EPRObservable:
+    """ broadened EPR absorption spectrum (or its first derivative) on the uniform field grid Bgrid
+        (Tesla) as a function of the field direction (see spectra.broaden_sticks); instances can be
+        passed to powder_average
+        method: "eigenfield" (EigenfieldSolver), "sweep" (FieldSweepSolver) or "auto" (eigenfield up to
+            dimension autoEigenfieldDim, where it is the faster one, field sweep beyond) """
+
+    def __init__(self, spin_system, freq, Bgrid, width, shape="gauss", Temp=None, mode="perpendicular",
+                 derivative=False, method="auto"):
+        Hmat, Mmat = spin_system.get_H_mat(), spin_system.get_M_mat()
+        if method == "auto":
+            method = "eigenfield" if Hmat.shape[0] <= autoEigenfieldDim else "sweep"
+        if method == "eigenfield":
+            self.solver = EigenfieldSolver(Hmat, Mmat)
+        elif method == "sweep":
+            self.solver = FieldSweepSolver(Hmat, Mmat)
+        else:
+            raise Exception(f"Unknown EPR method: {method}")
+        self.freq = freq
+        self.Bgrid = np.asarray(Bgrid, dtype=float)
+        self.width = width
+        self.shape = shape
+        self.Temp = Temp
+        self.mode = mode
+        self.derivative = derivative
+
+    def __call__(self, direction):
+        fields, intensities = self.solver.transitions(direction, self.freq, self.Temp,
+                                                      Bmax=np.max(self.Bgrid)+5*self.width, mode=self.mode)
+        return broaden_sticks(self.Bgrid, fields, intensities, self.width, self.shape,
+                              derivative=self.derivative)
+
+
+def epr_spectrum(spin_system, freq, Bgrid, width, shape="gauss", Temp=None, directions=None, weights=None,
+                 mode="perpendicular", derivative=False, nworkers=1, method="auto"):
+    """ powder EPR spectrum of the spin system at the microwave frequency freq (GHz) on the uniform
+        field grid Bgrid (Tesla) with lines of full width at half maximum width (Tesla); uses a ZCW grid on the
+        hemisphere with 610 orientations if no grid is given; with derivative set, the first-derivative
+        (CW) spectrum is returned (evaluated analytically in the time domain of the convolution)
+        method selects the resonance solver (see EPRObservable); the cost is that of one orientation
+        times the number of orientations divided by nworkers, e.g. about 1 s (dim 6), 25 s (dim 16)
+        or 5 min (dim 36) for the default grid on a single core (see the table at the top of the module) """
+    if directions is None:
+        directions, weights = orientation_grid("zcw", 12)
+
+    observable = EPRObservable(spin_system, freq, Bgrid, width, shape, Temp, mode, derivative, method)
+    return np.asarray(powder_average(observable, directions, weights, nworkers))
@@ -0,0 +1,255 @@
+import numpy as np
+from scipy.optimize import least_squares
+
+from .parametric import ParametricHamiltonian
+from .phys_const import kBcm, muBcm, ChiVVCGS
+
+""" Least-squares fitting of spin Hamiltonian parameters to susceptibility (chi*T) and magnetization
+    data with analytic gradients. The Hamiltonian is taken from a ParametricHamiltonian, such that
+    dH/dp_k and dM/dp_k are the precomputed operators; eigenvalue gradients follow from the
+    Hellmann-Feynman theorem and eigenvector gradients from first-order perturbation theory (with
+    degenerate levels treated blockwise). Every evaluation of residuals and Jacobian therefore costs
+    one diagonalization for all chi*T points and one per field (and direction) for the magnetization. """
+
+# energy differences (cm-1) below which two levels are treated as degenerate (as in getChiVV)
+degeneracyThr = 1e-3
+
+
+def _divided_difference(En, fBoltz, beta):
+    """ first divided difference of exp(-beta E): (f_i - f_j)/(E_i - E_j), or -beta f_i for
+        degenerate levels; also returns the mask of degenerate pairs """
+    denom = En[:, np.newaxis]-En[np.newaxis, :]
+    deg = np.abs(denom) < degeneracyThr
+    diff = fBoltz[:, np.newaxis]-fBoltz[np.newaxis, :]
+    F1 = np.where(deg, -0.5*beta*(fBoltz[:, np.newaxis]+fBoltz[np.newaxis, :]),
+                  diff/np.where(deg, 1., denom))
+    return F1, deg, denom
+
+
+def chiT_gradient(En, U, Mmat, Hops, Mops, Temps):
+    """ isotropic chi*T (cm3 K / mol) for the zero-field eigenpairs (En, U) of the Hamiltonian with
+        magnetic moments Mmat[3,dim,dim] (primitive basis) at the temperatures Temps, together with
+        its derivatives with respect to the parameters entering H with dH/dp = Hops[nH,dim,dim] and
+        those entering M with dM/dp = Mops[nM,3,dim,dim]; returns (chiT[nT], gradH[nT,nH], gradM[nT,nM]) """
+    Temps = np.atleast_1d(np.asarray(Temps, dtype=float))
+    En = En-np.min(En)
+    Uh = np.conj(U.T)
+
+    MmatT = np.matmul(Uh, np.matmul(Mmat, U))
+    Oprime = np.matmul(Uh, np.matmul(Hops, U))
+    Qprime = np.matmul(Uh, np.matmul(Mops, U))
+    # isotropic average of |M_ij|^2
+    A = np.sum(np.abs(MmatT)**2, axis=0)/3.
+
+    chiT = np.zeros(len(Temps))
+    gradH = np.zeros((len(Temps), len(Hops)))
+    gradM = np.zeros((len(Temps), len(Mops)))
+    for it, T in enumerate(Temps):
+        beta = 1./(kBcm*T)
+        fBoltz = np.exp(-beta*En)
+        Q = np.sum(fBoltz)
+
+        # Kubo: chi*T ~ kT sum_ij K_ij |M_ij|^2 / Q with K = -(divided difference of exp(-beta E))
+        F1, deg, denom = _divided_difference(En, fBoltz, beta)
+        K = -F1
+        S = np.sum(K*A)
+
+        # dK_ij/dE_i (symmetric counterpart for E_j); -beta^2 f/2 in the degenerate limit
+        safe = np.where(deg, 1., denom)
+        G = np.where(deg, -0.25*beta*beta*(fBoltz[:, np.newaxis]+fBoltz[np.newaxis, :]),
+                     (beta*fBoltz[:, np.newaxis]-K)/safe)
+        # Hellmann-Feynman part; within degenerate blocks the full block of dH enters
+        X = np.sum(np.matmul(MmatT, G.T*MmatT), axis=0)/3.
+        dS = 2.*np.einsum("kab,ab->k", Oprime, deg*X.T).real
+
+        # eigenvector relaxation: dU = U Gamma with Gamma_mj = dH_mj/(E_j - E_m) for non-degenerate pairs
+        R = np.where(deg, 0., -1./safe)
+        Z = np.zeros(A.shape, dtype=complex)
+        for c in range(3):
+            Y = K*np.conj(MmatT[c])
+            Z += np.matmul(MmatT[c].T, Y)-np.matmul(Y, MmatT[c].T)
+        dS += (2./3.)*np.einsum("kmj,mj->k", Oprime, R*Z).real
+
+        # explicit dependence of the magnetic moments (g values)
+        dSM = (2./3.)*np.einsum("kcij,cij->k", Qprime, K*np.conj(MmatT)).real
+
+        dQ = -beta*np.einsum("i,kii->k", fBoltz, Oprime).real
+
+        pref = ChiVVCGS*kBcm*T
+        chiT[it] = pref*S/Q
+        gradH[it] = pref*(dS/Q-S*dQ/(Q*Q))
+        gradM[it] = pref*dSM/Q
+
+    return chiT, gradH, gradM
+
+
+def magnetization_gradient(En, U, Mdir, B, Hops, Qdir, Temps):
+    """ magnetization <M_n> (Bohr magnetons) for the eigenpairs (En, U) of the Hamiltonian at the field
+        strength B along n with the moment along the field Mdir[dim,dim], together with its derivatives
+        with respect to the parameters entering H with dH/dp = Hops[nH,dim,dim] and those entering M
+        with dM_n/dp = Qdir[nM,dim,dim] (and thus dH/dp = -muB B Qdir through the Zeeman term)
+        returns (Mag[nT], gradH[nT,nH], gradM[nT,nM]) """
+    Temps = np.atleast_1d(np.asarray(Temps, dtype=float))
+    En = En-np.min(En)
+    Uh = np.conj(U.T)
+
+    Mprime = np.matmul(Uh, np.matmul(Mdir, U))
+    Oprime = np.matmul(Uh, np.matmul(Hops, U))
+    Qprime = np.matmul(Uh, np.matmul(Qdir, U))
+    mvals = np.real(np.diagonal(Mprime))
+
+    Mag = np.zeros(len(Temps))
+    gradH = np.zeros((len(Temps), len(Hops)))
+    gradM = np.zeros((len(Temps), len(Qdir)))
+    for it, T in enumerate(Temps):
+        beta = 1./(kBcm*T)
+        fBoltz = np.exp(-beta*En)
+        Q = np.sum(fBoltz)
+        W = np.sum(fBoltz*mvals)
+
+        # d Tr[f(H) M] = sum_ij f[1]_ij dH_ij M_ji + Tr[f(H) dM] (Daleckii-Krein)
+        F1, _, _ = _divided_difference(En, fBoltz, beta)
+        FM = F1*Mprime.T
+        dW = np.einsum("kij,ij->k", Oprime, FM).real
+        dQ = -beta*np.einsum("i,kii->k", fBoltz, Oprime).real
+        # H_Zeeman = - B M_n
+        dWM = -muBcm*B*np.einsum("kij,ij->k", Qprime, FM).real+np.einsum("kii,i->k", Qprime, fBoltz).real
+        dQM = beta*muBcm*B*np.einsum("i,kii->k", fBoltz, Qprime).real
+
+        Mag[it] = W/Q
+        gradH[it] = dW/Q-W*dQ/(Q*Q)
+        gradM[it] = dWM/Q-W*dQM/(Q*Q)
+
+    return Mag, gradH, gradM
+
+
+class SpinHamiltonianFit:
+    """ Fit the parameters of a ParametricHamiltonian (all of its parameters are varied; select a
+        subset when constructing it) to chi*T and/or magnetization data
+        Usage:
+            par = ParametricHamiltonian(sp_sys, ["J(1,2)", "D(1)", "gz(1)"])
+            fit = SpinHamiltonianFit(par, chiT=(Temps, chiT_exp), magnetization=(Bvalues, Temps_M, M_exp))
+            result = fit.fit()
+        chiT: temperatures (K) and isotropic chi*T values (cm3 K / mol)
+        magnetization: field strengths (T), temperatures (K) and the magnetization M[nT,nB] (Bohr
+            magnetons); averaged over directions with weights (default: field along z, which suffices
+            for isotropic systems; use e.g. powder.orientation_grid otherwise); the weights are
+            normalized to sum 1, and directions without weights are weighted equally
+        The residuals of each data set are divided by the root-mean-square of the data and multiplied
+        by chi_weight and mag_weight, respectively """
+
+    def __init__(self, parametric: ParametricHamiltonian, chiT=None, magnetization=None,
+                 directions=None, weights=None, chi_weight=1., mag_weight=1.):
+        if chiT is None and magnetization is None:
+            raise Exception("No data to fit")
+        self.parametric = parametric
+
+        self.chiT_data = None
+        if chiT is not None:
+            Temps, values = chiT
+            self.chiT_data = (np.atleast_1d(np.asarray(Temps, dtype=float)),
+                              np.atleast_1d(np.asarray(values, dtype=float)))
+            self.chi_scale = chi_weight/np.sqrt(np.sum(self.chiT_data[1]**2))
+
+        self.mag_data = None
+        if magnetization is not None:
+            Bvalues, Temps, values = magnetization
+            Bvalues = np.atleast_1d(np.asarray(Bvalues, dtype=float))
+            Temps = np.atleast_1d(np.asarray(Temps, dtype=float))
+            values = np.asarray(values, dtype=float).reshape((len(Temps), len(Bvalues)))
+            self.mag_data = (Bvalues, Temps, values)
+            self.mag_scale = mag_weight/np.sqrt(np.sum(values**2))
+
+        if directions is None:
+            directions, weights = np.array([[0., 0., 1.]]), np.array([1.])
+        directions = np.atleast_2d(np.asarray(directions, dtype=float))
+        if weights is None:
+            weights = np.ones(len(directions))
+        weights = np.atleast_1d(np.asarray(weights, dtype=float))
+        if weights.shape != (len(directions),):
+            raise Exception(f"Number of weights ({len(weights)}) does not match the number of directions ({len(directions)})")
+        self.directions = directions/np.linalg.norm(directions, axis=1)[:, np.newaxis]
+        self.weights = weights/np.sum(weights)
+
+        self._last = None
+
+
+    def chiT(self, params):
+        """ model chi*T and its gradient [nT,nparam] for the parameter vector params """
+        if self.chiT_data is None:
+            raise Exception("No chi*T data given")
+        par = self.parametric
+        En, U = np.linalg.eigh(par.get_H(params))
+        chiT, gradH, gradM = chiT_gradient(En, U, par.get_M(params), par.Hops, par.Mops, self.chiT_data[0])
+
+        grad = np.zeros((len(chiT), len(par.names)))
+        grad[:, par.Hidx] = gradH
+        grad[:, par.Midx] = gradM
+        return chiT, grad
+
+
+    def magnetization(self, params):
+        """ model magnetization [nT,nB] and its gradient [nT,nB,nparam] for the parameter vector params """
+        if self.mag_data is None:
+            raise Exception("No magnetization data given")
+        par = self.parametric
+        Bvalues, Temps, _ = self.mag_data
+        Hmat = par.get_H(params)
+        Mmat = par.get_M(params)
+
+        Mag = np.zeros((len(Temps), len(Bvalues)))
+        grad = np.zeros((len(Temps), len(Bvalues), len(par.names)))
+        for direction, weight in zip(self.directions, self.weights):
+            Mdir = np.tensordot(direction, Mmat, axes=1)
+            Qdir = np.tensordot(par.Mops, direction, axes=([1], [0]))
+            # all fields of one direction in one batched diagonalization
+            En, U = np.linalg.eigh(Hmat[np.newaxis]-muBcm*Bvalues[:, np.newaxis, np.newaxis]*Mdir)
+            for ib, B in enumerate(Bvalues):
+                value, gradH, gradM = magnetization_gradient(En[ib], U[ib], Mdir, B, par.Hops, Qdir, Temps)
+                Mag[:, ib] += weight*value
+                grad[:, ib, par.Hidx] += weight*gradH
+                grad[:, ib, par.Midx] += weight*gradM
+
+        return Mag, grad
+
+
+    def _evaluate(self, params):
+        """ residuals and Jacobian (cached for the last parameter vector) """
+        params = np.asarray(params, dtype=float)
+        if self._last is not None and np.array_equal(self._last[0], params):
+            return self._last[1], self._last[2]
+
+        residuals = []
+        jacobian = []
+        if self.chiT_data is not None:
+            model, grad = self.chiT(params)
+            residuals.append(self.chi_scale*(model-self.chiT_data[1]))
+            jacobian.append(self.chi_scale*grad)
+        if self.mag_data is not None:
+            model, grad = self.magnetization(params)
+            residuals.append(self.mag_scale*(model-self.mag_data[2]).reshape(-1))
+            jacobian.append(self.mag_scale*grad.reshape((-1, len(params))))
+
+        self._last = (params.copy(), np.concatenate(residuals), np.concatenate(jacobian))
+        return self._last[1], self._last[2]
+
+
+    def residuals(self, params):
+        return self._evaluate(params)[0]
+
+
+    def jacobian(self, params):
+        return self._evaluate(params)[1]
+
+
+    def fit(self, p0=None, bounds=(-np.inf, np.inf), **kwargs):
+        """ run scipy.optimize.least_squares with the analytic Jacobian (unless jac is passed on), starting
+            from p0 (the current values of the parametric Hamiltonian if not given); on return, the values of the parametric
+            Hamiltonian are updated and the result object of least_squares is returned """
+        if p0 is None:
+            p0 = self.parametric.values
+        kwargs.setdefault("jac", self.jacobian)
+        result = least_squares(self.residuals, p0, bounds=bounds, **kwargs)
+        self.parametric.values = result.x
+
+        return result
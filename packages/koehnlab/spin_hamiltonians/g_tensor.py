@@ -4,6 +4,7 @@ import numpy as np
 from numpy.typing import NDArray
 
 from .phys_const import muBcm, ge
+from .spin_utils import gerlochMcMeekingTensor
 
 
 def compute_magnetic_moment_matrix(
@@ -47,18 +48,9 @@ def compute_A_matrix(mu_x, mu_y, mu_z, num_states: int) -> NDArray[np.float64]:
     mu_y_n = mu_y[:num_states, :num_states]
     mu_z_n = mu_z[:num_states, :num_states]
 
-    mu = [mu_x_n, mu_y_n, mu_z_n]
+    mu = np.array([mu_x_n, mu_y_n, mu_z_n])
 
-    Amat = np.zeros((3, 3))
-
-    for alpha in range(3):
-        for beta in range(3):
-            prod = np.matmul(mu[alpha], mu[beta])
-            trace = np.matrix.trace(prod)
-            assert np.abs(trace.imag) < 1e-6
-            Amat[alpha, beta] = 0.5 * trace.real
-
-    return Amat
+    return gerlochMcMeekingTensor(mu, imagThr=1e-6)
 
 
 def compute_g_tensor(
@@ -0,0 +1,212 @@
+import numpy as np
+
+from .phys_const import muBcm
+from .spin_systems import SpinSystem, numThr
+
+""" Compiled (linear) parametrization of the spin Hamiltonian of a SpinSystem,
+        H(p) = H0 + sum_k p_k O_k,   M(p) = M0 + sum_k p_k Q_k
+    with one operator per exchange constant, zero-field parameter and principal g value; all axes
+    (magnetic axes, zero-field axes, relative orientation of the centers) are held fixed. Evaluating
+    the Hamiltonian for many parameter vectors amounts to a single tensordot. """
+
+# Upper bound for the number of (complex) elements of the Hamiltonian batches formed in scans
+maxBatchElements = 2**24
+
+# traceless unit tensors for the axial and rhombic parts (in the principal axes)
+_axial = np.diag([-1./3., -1./3., 2./3.])
+_rhombic = np.diag([1., -1., 0.])
+
+
+class ParametricHamiltonian:
+    """ Usage:
+            par = ParametricHamiltonian(sp_sys)
+            H = par.get_H(par.values)
+            grid = par.make_grid({"J(1,2)": np.linspace(-10., 10., 21), "D(1)": [1., 2., 5.]})
+            En = par.scan(grid, Bfield=[0., 0., 1.])
+        The parameters are named
+            "J(a,b)", "Jax(a,b)", "Jrh(a,b)"   isotropic, axial and rhombic exchange between a and b
+            "D(a)", "E(a)"                     zero-field splitting of center a (only for S >= 1)
+            "gx(a)", "gy(a)", "gz(a)"          principal g values of center a (along its axes)
+        with the conventions of SpinSystem.set_interaction, Spin.set_ZF and Spin.set_g; the initial
+        values are taken from the spin system. If a list of parameter names is given, only those are
+        varied and all others are frozen into H0 and M0 """
+
+    def __init__(self, spin_system: SpinSystem, parameters=None):
+        self.spin_system = spin_system
+        self.dimension = spin_system.dimension
+
+        names = []
+        value_list = []
+        # operators of the parameters entering H (exchange, zero-field) and M (g values), respectively
+        H_terms = {}
+        M_terms = {}
+
+        def add(name, value, terms, op):
+            if name in names:
+                # several interactions between the same pair of centers share their parameters
+                value_list[names.index(name)] += value
+                return
+            terms[len(names)] = op
+            names.append(name)
+            value_list.append(value)
+
+        for label1, label2, Jmat in spin_system.interaction:
+            pair = f"({label1},{label2})"
+            a, b, c = np.diag(Jmat)
+            for prefix, value, ten in [("J", (a+b+c)/3., np.identity(3)), ("Jax", c-0.5*(a+b), _axial),
+                                       ("Jrh", 0.5*(a-b), _rhombic)]:
+                add(prefix+pair, value, H_terms, spin_system.get_exchange_mat(label1, label2, ten))
+
+        for label in spin_system.order:
+            spin = spin_system.spins[label]
+            if spin.S >= 1.:
+                for prefix, value, ten in [("D", spin.ZFaxial, _axial), ("E", spin.ZFrhombic, _rhombic)]:
+                    ten = np.matmul(spin.ZFaxes, np.matmul(ten, spin.ZFaxes.T))
+                    add(f"{prefix}({label})", value, H_terms,
+                        spin_system.get_site_mat(label, spin.get_quadratic_mat(ten)))
+
+            # principal g values with respect to the axes of the center
+            gdiag = np.diag(np.matmul(spin.axes.T, np.matmul(spin.g, spin.axes)))
+            Smat = spin.get_spin_mat()
+            for k, comp in enumerate("xyz"):
+                proj = np.outer(spin.axes[:, k], spin.axes[:, k])
+                # M = -g S, as in Spin.get_M_mat
+                MMat = -np.tensordot(proj, Smat, axes=1)
+                Mop = np.array([spin_system.get_site_mat(label, MMat[c]) for c in range(3)])
+                add(f"g{comp}({label})", gdiag[k], M_terms, Mop)
+
+        values = np.array(value_list, dtype=float)
+        Hidx = np.array(list(H_terms), dtype=int)
+        Midx = np.array(list(M_terms), dtype=int)
+        Hops = np.array(list(H_terms.values()), dtype=complex).reshape((-1, self.dimension, self.dimension))
+        Mops = np.array(list(M_terms.values()), dtype=complex).reshape((-1, 3, self.dimension, self.dimension))
+
+        # everything not captured by the parameters (e.g. off-diagonal g elements)
+        H0 = spin_system.get_H_mat()-np.tensordot(values[Hidx], Hops, axes=1)
+        M0 = spin_system.get_M_mat()-np.tensordot(values[Midx], Mops, axes=1)
+
+        if parameters is not None:
+            unknown = [name for name in parameters if name not in names]
+            if len(unknown) > 0:
+                raise Exception(f"Unknown parameters: {unknown} (available: {names})")
+            keep = np.array([name in parameters for name in names])
+            keepH = keep[Hidx]
+            keepM = keep[Midx]
+            H0 += np.tensordot(values[Hidx[~keepH]], Hops[~keepH], axes=1)
+            M0 += np.tensordot(values[Midx[~keepM]], Mops[~keepM], axes=1)
+            # positions in the reduced parameter vector
+            position = np.cumsum(keep)-1
+            Hidx, Hops = position[Hidx[keepH]], Hops[keepH]
+            Midx, Mops = position[Midx[keepM]], Mops[keepM]
+            names = [name for name in names if name in parameters]
+            values = values[keep]
+
+        self.names = names
+        self.values = values
+        self.H0 = H0
+        self.M0 = M0
+        # dH/dp = Hops[k] for the parameter Hidx[k] and dM/dp = Mops[k] for the parameter Midx[k];
+        # every parameter enters either H or M
+        self.Hidx = Hidx
+        self.Hops = Hops
+        self.Midx = Midx
+        self.Mops = Mops
+
+
+    def index(self, name):
+        """ position of the parameter name in the parameter vector """
+        if name not in self.names:
+            raise Exception(f"Unknown parameter: {name}")
+        return self.names.index(name)
+
+
+    def _operators(self, Bfield):
+        """ constant part of the Hamiltonian including the Zeeman term, the positions of the parameters
+            entering it and their operators """
+        if Bfield is None:
+            return self.H0, self.Hidx, self.Hops
+
+        # H_Zeeman = - M B
+        Bfield = np.asarray(Bfield, dtype=float)
+        H0 = self.H0-muBcm*np.tensordot(Bfield, self.M0, axes=1)
+        Zops = -muBcm*np.tensordot(self.Mops, Bfield, axes=([1], [0]))
+
+        return H0, np.concatenate((self.Hidx, self.Midx)), np.concatenate((self.Hops, Zops))
+
+
+    def get_H(self, params=None, Bfield=None):
+        """ Hamiltonian (cm-1) for the parameter vector params (current values if not given) and the
+            field Bfield (x,y,z) in Tesla; params may be a stack [...,nparam], yielding H[...,dim,dim] """
+        if params is None:
+            params = self.values
+        H0, idx, ops = self._operators(Bfield)
+
+        return H0+np.tensordot(np.asarray(params)[..., idx], ops, axes=1)
+
+
+    def get_M(self, params=None):
+        """ magnetic moment matrices [...,3,dim,dim] (Bohr magnetons) for the parameter vector(s) params """
+        if params is None:
+            params = self.values
+
+        return self.M0+np.tensordot(np.asarray(params)[..., self.Midx], self.Mops, axes=1)
+
+
+    def make_grid(self, ranges):
+        """ parameter vectors [npoints,nparam] for the tensor product grid of the values given in
+            ranges (dict: parameter name -> list of values); other parameters keep their current values """
+        names = list(ranges)
+        idx = [self.index(name) for name in names]
+        mesh = np.meshgrid(*[np.asarray(ranges[name], dtype=float) for name in names], indexing="ij")
+
+        grid = np.tile(self.values, (mesh[0].size, 1))
+        for k, values in zip(idx, mesh):
+            grid[:, k] = values.reshape(-1)
+
+        return grid
+
+
+    def _batches(self, param_grid, Bfield, batch_size):
+        """ the Hamiltonians for all parameter vectors param_grid[npoints,nparam], formed in batches of
+            batch_size parameter vectors (chosen such that a batch holds at most maxBatchElements
+            elements if not given); yields the range of parameter vectors and their Hamiltonians """
+        if param_grid.shape[1] != len(self.names):
+            raise Exception(f"Parameter vectors of length {len(self.names)} expected")
+
+        npoints = param_grid.shape[0]
+        dim = self.dimension
+        if batch_size is None:
+            batch_size = max(1, maxBatchElements//(dim*dim))
+
+        H0, idx, ops = self._operators(Bfield)
+        # the Hamiltonians of real parameter sets are often real
+        if np.all(np.abs(np.imag(H0)) < numThr) and np.all(np.abs(np.imag(ops)) < numThr):
+            H0, ops = np.real(H0), np.real(ops)
+
+        for first in range(0, npoints, batch_size):
+            last = min(first+batch_size, npoints)
+            yield first, last, H0+np.tensordot(param_grid[first:last][:, idx], ops, axes=1)
+
+
+    def scan(self, param_grid, Bfield=None, batch_size=None):
+        """ diagonalize the Hamiltonian for all parameter vectors param_grid[npoints,nparam] (in batches,
+            see _batches); returns the energies En[npoints,dim] """
+        param_grid = np.atleast_2d(np.asarray(param_grid, dtype=float))
+
+        En = np.empty((param_grid.shape[0], self.dimension))
+        for first, last, H in self._batches(param_grid, Bfield, batch_size):
+            En[first:last] = np.linalg.eigvalsh(H)
+
+        return En
+
+
+    def scan_states(self, param_grid, Bfield=None, batch_size=None):
+        """ like scan, but also returns the eigenvectors U[npoints,dim,dim] """
+        param_grid = np.atleast_2d(np.asarray(param_grid, dtype=float))
+
+        En = np.empty((param_grid.shape[0], self.dimension))
+        U = np.empty((param_grid.shape[0], self.dimension, self.dimension), dtype=complex)
+        for first, last, H in self._batches(param_grid, Bfield, batch_size):
+            En[first:last], U[first:last] = np.linalg.eigh(H)
+
+        return En, U
@@ -0,0 +1,232 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import permutations, product
+
+import numpy as np
+
+from .phys_utils import getBoltzmannFactors
+from .spin_utils import fieldSweepLevels
+
+""" Orientation grids on the unit sphere and powder averaging of orientation-dependent observables.
+    All grids are returned as (directions[n,3], weights[n]) with weights summing to one. """
+
+
+def _symmetric_points(v):
+    """ all distinct points generated from v by permutations and sign changes of the components """
+    points = set()
+    for perm in permutations(v):
+        for signs in product([1., -1.], repeat=3):
+            points.add(tuple(np.round(np.array(perm)*signs, 15)))
+    return np.array(sorted(points))
+
+
+def _a1():
+    return _symmetric_points((1., 0., 0.))
+
+
+def _a2():
+    r = np.sqrt(0.5)
+    return _symmetric_points((r, r, 0.))
+
+
+def _a3():
+    r = np.sqrt(1./3.)
+    return _symmetric_points((r, r, r))
+
+
+def _b(l):
+    return _symmetric_points((l, l, np.sqrt(1.-2.*l*l)))
+
+
+def _c(p):
+    return _symmetric_points((p, np.sqrt(1.-p*p), 0.))
+
+
+# Lebedev grids as lists of (generator, weight); the key is the number of points
+# (exact for spherical harmonics up to degree 3, 5, 7, 9, 11, 15 and 17, respectively)
+_lebedev_rules = {
+    6: [(_a1, (), 1/6)],
+    14: [(_a1, (), 1/15), (_a3, (), 3/40)],
+    26: [(_a1, (), 1/21), (_a2, (), 4/105), (_a3, (), 27/840)],
+    38: [(_a1, (), 1/105), (_a3, (), 9/280), (_c, (0.4597008433809831,), 1/35)],
+    50: [(_a1, (), 4/315), (_a2, (), 64/2835), (_a3, (), 27/1280), (_b, (0.3015113445777636,), 14641/725760)],
+    86: [(_a1, (), 0.01154401154401154), (_a3, (), 0.01194390908585628),
+         (_b, (0.3696028464541502,), 0.01111055571060340), (_b, (0.6943540066026664,), 0.01187650129453714),
+         (_c, (0.3742430390903412,), 0.01181230374690448)],
+    110: [(_a1, (), 0.003828270494937162), (_a3, (), 0.009793737512487512),
+          (_b, (0.1851156353447362,), 0.008211737283191111), (_b, (0.6904210483822922,), 0.009942814891178103),
+          (_b, (0.3956894730559419,), 0.009595471336070963), (_c, (0.4783690288121502,), 0.009694996361663028)],
+}
+
+
+def lebedev_grid(npoints):
+    """ Lebedev quadrature grid with the given number of points (6, 14, 26, 38, 50, 86 or 110) """
+    if npoints not in _lebedev_rules:
+        raise Exception(f"No Lebedev grid with {npoints} points available (choose from {list(_lebedev_rules)})")
+
+    directions = []
+    weights = []
+    for generator, args, weight in _lebedev_rules[npoints]:
+        points = generator(*args)
+        directions.append(points)
+        weights.append(np.full(len(points), weight))
+
+    return np.concatenate(directions), np.concatenate(weights)
+
+
+def _fibonacci(m):
+    f = [1, 1]
+    while len(f) < m+1:
+        f.append(f[-1]+f[-2])
+    return f[m]
+
+
+def zcw_grid(m, hemisphere=False):
+    """ Zaremba-Conroy-Wolfsberg grid with F(m+2) points (F: Fibonacci numbers) and equal weights,
+        see M. Eden, M. H. Levitt; J. Magn. Reson. 132, 220 (1998) """
+    N = _fibonacci(m+2)
+    g = _fibonacci(m)
+
+    j = np.arange(N)
+    if hemisphere:
+        cosb = 1.-np.mod(j/N, 1.)
+    else:
+        cosb = 2.*np.mod(j/N, 1.)-1.
+    alpha = 2*np.pi*np.mod(j*g/N, 1.)
+    sinb = np.sqrt(1.-cosb*cosb)
+
+    directions = np.stack((sinb*np.cos(alpha), sinb*np.sin(alpha), cosb), axis=1)
+
+    return directions, np.full(N, 1./N)
+
+
+def spherical_design(npoints):
+    """ spherical designs with equal weights: tetrahedron (4 points, exact up to degree 2),
+        octahedron (6 points, degree 3) and icosahedron (12 points, degree 5) """
+    if npoints == 4:
+        directions = np.array([[1., 1., 1.], [1., -1., -1.], [-1., 1., -1.], [-1., -1., 1.]])/np.sqrt(3.)
+    elif npoints == 6:
+        directions = _a1()
+    elif npoints == 12:
+        phi = 0.5*(1.+np.sqrt(5.))
+        directions = np.array([v for p in range(3)
+                               for v in np.roll(np.array([[0., s1, s2*phi] for s1 in [1., -1.] for s2 in [1., -1.]]), p, axis=1)])
+        directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+    else:
+        raise Exception(f"No spherical design with {npoints} points available (choose from 4, 6, 12)")
+
+    return directions, np.full(npoints, 1./npoints)
+
+
+def orientation_grid(kind="lebedev", npoints=110, reduce_inversion=True):
+    """ get an orientation grid of the given kind ("lebedev", "zcw" or "design"); for "zcw", npoints is
+        the Fibonacci index m; if reduce_inversion is set, only one direction of each pair (n, -n) is
+        kept (with doubled weight), which is exact for observables that are invariant under inversion
+        of the field (like energies and the magnetization along the field) """
+    if kind == "lebedev":
+        directions, weights = lebedev_grid(npoints)
+    elif kind == "zcw":
+        if reduce_inversion:
+            return zcw_grid(npoints, hemisphere=True)
+        directions, weights = zcw_grid(npoints)
+    elif kind == "design":
+        directions, weights = spherical_design(npoints)
+    else:
+        raise Exception(f"Unknown orientation grid: {kind}")
+
+    if reduce_inversion:
+        directions, weights = reduce_by_inversion(directions, weights)
+
+    return directions, weights
+
+
+def reduce_by_inversion(directions, weights, thr=1e-10):
+    """ merge directions related by inversion (n, -n), adding up their weights """
+    directions = np.asarray(directions)
+    weights = np.array(weights, dtype=float)
+
+    keep = np.ones(len(directions), dtype=bool)
+    for ii in range(len(directions)):
+        if not keep[ii]:
+            continue
+        partners = np.nonzero(keep & (np.linalg.norm(directions+directions[ii], axis=1) < thr))[0]
+        partners = partners[partners != ii]
+        if len(partners) > 0:
+            weights[ii] += np.sum(weights[partners])
+            keep[partners] = False
+
+    return directions[keep], weights[keep]
+
+
+def _evaluate_chunk(observable, directions, weights):
+    """ weighted sum of the observable over the given directions (executed in the worker processes) """
+    total = 0.
+    for direction, weight in zip(directions, weights):
+        total = total+weight*np.asarray(observable(direction))
+    return total
+
+
+def powder_average(observable, directions, weights=None, nworkers=1, chunk_size=None):
+    """ compute sum_i w_i observable(n_i) for an observable (a picklable callable taking a direction and
+        returning a scalar or array); with nworkers > 1, chunks of directions are distributed across
+        worker processes and the results are accumulated as they arrive; without weights, all
+        directions are weighted equally """
+    directions = np.atleast_2d(np.asarray(directions, dtype=float))
+    if len(directions) == 0:
+        raise Exception("No orientations given")
+    if weights is None:
+        weights = np.full(len(directions), 1./len(directions))
+    weights = np.asarray(weights)
+    if len(weights) != len(directions):
+        raise Exception(f"Number of weights ({len(weights)}) does not match the number of orientations ({len(directions)})")
+
+    if nworkers <= 1:
+        return _evaluate_chunk(observable, directions, weights)
+
+    if chunk_size is None:
+        chunk_size = max(1, len(directions)//(4*nworkers))
+
+    total = 0.
+    with ProcessPoolExecutor(max_workers=nworkers) as executor:
+        futures = [executor.submit(_evaluate_chunk, observable, directions[first:first+chunk_size],
+                                   weights[first:first+chunk_size])
+                   for first in range(0, len(directions), chunk_size)]
+        for future in as_completed(futures):
+            total = total+future.result()
+
+    return total
+
+
+class MagnetizationObservable:
+    """ magnetization along the field (in Bohr magnetons) of a spin system for the field strengths
+        Bvalues (Tesla) and temperatures Temps (K) as a function of the field direction; returns
+        an array [nT,nB]; instances can be passed to powder_average """
+
+    def __init__(self, spin_system, Bvalues, Temps):
+        self.Hmat = spin_system.get_H_mat()
+        self.Mmat = spin_system.get_M_mat()
+        self.Bvalues = np.atleast_1d(np.asarray(Bvalues, dtype=float))
+        self.Temps = np.atleast_1d(np.asarray(Temps, dtype=float))
+
+    def __call__(self, direction):
+        direction = np.asarray(direction)/np.linalg.norm(direction)
+        En, Mu = fieldSweepLevels(self.Hmat, self.Mmat, self.Bvalues, direction)
+        # projection of the moments onto the field direction, [nB,dim]
+        Mpar = np.einsum("c,bci->bi", direction, Mu[0])
+        En = En[0]-np.min(En[0], axis=1)[:, np.newaxis]
+
+        Mag = np.zeros((len(self.Temps), len(self.Bvalues)))
+        for it, T in enumerate(self.Temps):
+            fBoltz = getBoltzmannFactors(En, T)
+            Mag[it] = np.sum(fBoltz*Mpar, axis=1)/np.sum(fBoltz, axis=1)
+
+        return Mag
+
+
+def powder_magnetization(spin_system, Bvalues, Temps, directions=None, weights=None, nworkers=1):
+    """ powder-averaged magnetization (Bohr magnetons) of the spin system, returns an array [nT,nB];
+        uses a Lebedev grid with 110 points (reduced by inversion) if no grid is given; directions
+        without weights are weighted equally """
+    if directions is None:
+        directions, weights = orientation_grid("lebedev", 110)
+
+    return powder_average(MagnetizationObservable(spin_system, Bvalues, Temps), directions, weights, nworkers)
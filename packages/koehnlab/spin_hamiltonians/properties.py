@@ -1,47 +1,50 @@
 import numpy as np
 
 from .phys_const import kBcm, ChiVVCGS
+from .phys_utils import getBoltzmannFactors
 
 
 def getChiVV(En, MmatT, fBoltz, T):
     """compute chi*T by the van Vleck equation"""
     """ the chi() subroutine of Chibutaru and Ungur (SINGLE_ANISO) is acknowledged
-        for inspiration and debugging of prefactors """
+        for inspiration and debugging of prefactors
+        En are the energies (cm-1) and MmatT[3,dim,dim] the magnetic moment matrix (Bohr magnetons)
+        in the eigenbasis; T is either a single temperature (K) with fBoltz[dim] the corresponding
+        Boltzmann factors, which yields ChiT[3,3], or an array of temperatures with fBoltz[nT,dim]
+        or None (computed from En), which yields ChiT[nT,3,3] """
 
+    En = np.asarray(En)
     ndim = En.shape[0]
     if ndim != MmatT.shape[1]:
-        print("ChiVV: Error - conflicting dimensions for En and MmatT")
-        exit(200)
-    if ndim != fBoltz.shape[0]:
-        print("ChiVV: Error - conflicting dimensions for En and fBoltz")
-        exit(201)
-
-    # print('start new ChiT(VV) computation:')
-
-    ChiT = np.zeros((3, 3))
-
-    for ii in range(ndim):
-        if fBoltz[ii] > 1e-12:
-            # print('state ',ii,' has sufficient occupation:',fBoltz[ii])
-
-            for jj in range(ndim):
-                denom = En[ii] - En[jj]
-                if np.abs(denom) < 0.001:  # treat this as first-order contribution
-                    # print('state ',jj,' considered as first order')
-                    fac = fBoltz[ii]
-                else:  # and the rest as second-oder contributions
-                    # print('state ',jj,' considered as second order')
-                    fac = -2.0 * fBoltz[ii] * kBcm * T / denom
-
-                # print(' ic     jc       Mi        Mj')
-                for ic in range(3):
-                    for jc in range(3):
-                        # print(ic,jc,MmatT[ic,ii,jj],MmatT[jc,jj,ii])
-                        ChiT[ic, jc] += (
-                            fac * (MmatT[ic, ii, jj] * MmatT[jc, jj, ii]).real
-                        )
-
-    Q = np.sum(fBoltz)
-    ChiT *= 1.0 / Q * ChiVVCGS
-
-    return ChiT
+        raise Exception("ChiVV: Error - conflicting dimensions for En and MmatT")
+
+    single = np.ndim(T) == 0
+    T = np.atleast_1d(np.asarray(T, dtype=float))
+    if fBoltz is None:
+        fBoltz = getBoltzmannFactors(En[np.newaxis] - np.min(En), T[:, np.newaxis])
+    fBoltz = np.asarray(fBoltz).reshape((len(T), -1))
+    if ndim != fBoltz.shape[1]:
+        raise Exception("ChiVV: Error - conflicting dimensions for En and fBoltz")
+
+    # products Re(M_c,ij M_d,ji) for all pairs of states
+    MM = np.einsum("cij,dji->cdij", MmatT, MmatT).real
+
+    denom = En[:, np.newaxis] - En[np.newaxis, :]
+    # treat quasi-degenerate pairs as first-order contribution and the rest as second-order contributions
+    first = np.abs(denom) < 0.001
+    inv_denom = np.divide(1.0, denom, out=np.zeros_like(denom), where=~first)
+
+    # sums over j do not depend on the temperature
+    MM1 = np.einsum("cdij,ij->cdi", MM, first)
+    MM2 = np.einsum("cdij,ij->cdi", MM, inv_denom)
+
+    # states with negligible occupation are skipped
+    occ = np.where(fBoltz > 1e-12, fBoltz, 0.0)
+
+    ChiT = np.einsum("ti,cdi->tcd", occ, MM1)
+    ChiT -= 2.0 * kBcm * T[:, np.newaxis, np.newaxis] * np.einsum("ti,cdi->tcd", occ, MM2)
+
+    Q = np.sum(fBoltz, axis=1)
+    ChiT *= (1.0 / Q * ChiVVCGS)[:, np.newaxis, np.newaxis]
+
+    return ChiT[0] if single else ChiT
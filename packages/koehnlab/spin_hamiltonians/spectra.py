@@ -0,0 +1,94 @@
+import numpy as np
+from scipy.fft import next_fast_len
+
+from .phys_utils import CGauss, CLorentz
+
+""" Broadening of stick spectra (positions and intensities from any of the spin Hamiltonian tools)
+    on a uniform grid: the sticks are distributed onto the grid and convolved with the line shape by
+    multiplication with the correlation functions CLorentz/CGauss in the time domain via FFT, which
+    costs O(n log n) instead of O(nsticks * ngrid) for direct summation (see epr.line_shape).
+    Widths are full widths at half maximum; the integral of every line equals its intensity. """
+
+
+def _kernel(t, width, shape):
+    """ Fourier transform of the normalized line shape, i.e. the correlation function scaled to one at t = 0 """
+    if shape == "lorentz":
+        # exp(-gamma |t|) <-> Lorentzian with half width gamma
+        return CLorentz(np.abs(t), 0.5*width)/CLorentz(0., 0.5*width)
+    if shape == "gauss":
+        # exp(-sigma^2 t^2 / 2) <-> Gaussian with standard deviation sigma
+        sig = width/np.sqrt(8.*np.log(2.))
+        return CGauss(t, sig)/CGauss(0., sig)
+    raise Exception(f"Unknown line shape: {shape}")
+
+
+def _width_classes(widths, width_tol):
+    """ group widths [nsticks,nw] into classes of relative spread width_tol; returns the class
+        index of every stick and the mean widths of the classes """
+    keys = np.round(np.log(widths)/np.log1p(width_tol)).astype(np.int64)
+    _, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    means = np.array([np.bincount(inverse, weights=widths[:, k])/counts for k in range(widths.shape[1])]).T
+
+    return inverse, means
+
+
+def broaden_sticks(grid, positions, intensities, widths, shape="lorentz", width_tol=0.02, derivative=False,
+                   margin=10.):
+    """ broadened spectrum on the uniform grid for sticks at positions with the given intensities
+        shape: "lorentz", "gauss" or "voigt" (convolution of both; widths[...,0] Lorentzian and
+            widths[...,1] Gaussian full widths)
+        widths: a single width (pair for "voigt") or one per stick; sticks whose widths agree within
+            the relative tolerance width_tol share one convolution with their mean width
+        derivative: return the first derivative of the spectrum (evaluated in the time domain)
+        margin: the grid is padded by margin times the largest width on both sides to suppress the
+            wrap-around of the (circular) FFT convolution; sticks outside the padded grid are skipped """
+    grid = np.asarray(grid, dtype=float)
+    positions = np.atleast_1d(np.asarray(positions, dtype=float))
+    intensities = np.broadcast_to(np.asarray(intensities, dtype=float), positions.shape)
+
+    nw = 2 if shape == "voigt" else 1
+    widths = np.asarray(widths, dtype=float).reshape((-1, nw))
+    widths = np.broadcast_to(widths, (len(positions), nw))
+    if np.any(widths <= 0.):
+        raise Exception("Line widths must be positive")
+
+    ngrid = len(grid)
+    delta = (grid[-1]-grid[0])/(ngrid-1)
+    if np.any(np.abs(np.diff(grid)-delta) > 1e-6*abs(delta)):
+        raise Exception("broaden_sticks requires a uniform grid")
+
+    npad = int(np.ceil(margin*np.max(np.sum(widths, axis=1))/abs(delta))) if len(positions) > 0 else 0
+    nfft = int(next_fast_len(ngrid+2*npad, real=True) or ngrid+2*npad)
+    t = 2.*np.pi*np.fft.rfftfreq(nfft, delta)
+
+    # distribute every stick linearly onto its two neighboring points (conserves area and center)
+    index = (positions-grid[0])/delta+npad
+    lower = np.floor(index).astype(int)
+    frac = index-lower
+    inside = (lower >= 0) & (lower < nfft-1)
+
+    classes, class_widths = _width_classes(widths, width_tol)
+
+    spectrum_t = np.zeros(len(t), dtype=complex)
+    for ic, cwidths in enumerate(class_widths):
+        sel = inside & (classes == ic)
+        if not np.any(sel):
+            continue
+        hist = np.bincount(lower[sel], weights=(1.-frac[sel])*intensities[sel], minlength=nfft)
+        hist += np.bincount(lower[sel]+1, weights=frac[sel]*intensities[sel], minlength=nfft)
+
+        if shape == "voigt":
+            kernel = _kernel(t, cwidths[0], "lorentz")*_kernel(t, cwidths[1], "gauss")
+        else:
+            kernel = _kernel(t, cwidths[0], shape)
+        spectrum_t += np.fft.rfft(hist[:nfft])*kernel
+
+    if derivative:
+        # d/dx corresponds to multiplication by i t
+        spectrum_t *= 1j*t
+
+    # the sticks are normalized per grid point, so descending grids must not flip the sign
+    spectrum = np.fft.irfft(spectrum_t, nfft)/abs(delta)
+
+    return spectrum[npad:npad+ngrid]
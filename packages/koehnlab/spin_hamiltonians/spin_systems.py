@@ -1,9 +1,13 @@
 from enum import Enum
 
 import numpy as np 
+import scipy.sparse as sps
+from scipy.sparse.linalg import LinearOperator, eigsh
 
-from .phys_const import ge, muNbohr
-from .spin_utils import spinMat
+from .phys_const import ge, muNbohr, muBcm
+from .spin_utils import spinOperators, spinQuadraticOperators, resolveDegeneracies
+
+from math import gcd
 
 class SpinType(Enum):
     Electronic = 1
@@ -13,7 +17,10 @@ class SpinType(Enum):
     Nuc = 2
 
 numThr = 1e-8
+# default limits for the dimension of the dense and sparse matrices of a SpinSystem
+# (can be changed per object via the max_dim and max_sparse_dim attributes)
 maxDim = 1000 
+maxSparseDim = 100000
 
 class Spin:
     """ This class defines a spin object  
@@ -87,16 +94,9 @@ class Spin:
     def get_spin_mat(self):
         """ return spin matrix elements 
             <i|S_c|j>  c=x,y,z
-        x,y,z are the reference basis """
-
-        dim = int(2*self.S)+1
-        Mat = np.zeros((3,dim,dim),dtype=complex)
+        x,y,z are the reference basis; the returned array is cached and read-only """
 
-        Mat[0] += spinMat(self.S,'x')
-        Mat[1] += spinMat(self.S,'y')
-        Mat[2] += spinMat(self.S,'z')
-       
-        return Mat
+        return spinOperators(self.S)
 
 
     def get_M_mat(self):
@@ -105,40 +105,53 @@ class Spin:
             <i|M_c|j> = -g <i|S_c|j>  c=x,y,z
         x,y,z are the reference basis; unit is Bohr magnetons """
 
-        dim = int(2*self.S)+1
-        Mat = np.zeros((3,dim,dim),dtype=complex)
-
         # g is already in the correct basis
         # it also contains the (possible) sign reversal for nuclear spins
-
-        k = -1
-        for comp in ['x','y','z']:
-            k += 1
-            tmpMat = spinMat(self.S,comp)
-            Mat[0] -= self.g[0,k]*tmpMat
-            Mat[1] -= self.g[1,k]*tmpMat
-            Mat[2] -= self.g[2,k]*tmpMat
-
-        return Mat
+        return -np.tensordot(self.g,spinOperators(self.S),axes=1)
 
 
     def get_ZF_mat(self):
         """ get the zero-field contributions from this center; unit is cm-1 """
 
-        dim = int(2*self.S)+1
-        Mat = np.zeros((dim,dim),dtype=complex)
+        return self.get_quadratic_mat(self.ZFten)
+
+
+    def get_quadratic_mat(self,ZFten):
+        """ get the matrix of S.ZFten.S for a symmetric tensor ZFten given like self.ZFten """
 
         # transform to magnetic axes
-        ZFtenT = np.matmul(self.axes,np.matmul(self.ZFten,self.axes.T))
+        ZFtenT = np.matmul(self.axes,np.matmul(ZFten,self.axes.T))
 
-        Smat = np.array([spinMat(self.S,'x'),spinMat(self.S,'y'),spinMat(self.S,'z')])
+        # sum_k>l ZF_kl (S_k S_l + S_l S_k) + sum_k ZF_kk S_k S_k
+        weights = np.tril(ZFtenT,-1) + 0.5*np.diag(np.diag(ZFtenT))
 
-        for k in range(3):
-            for l in range(k):
-                Mat += ZFtenT[k,l]*(np.matmul(Smat[k],Smat[l])+np.matmul(Smat[l],Smat[k]))
-            Mat += ZFtenT[k,k]*np.matmul(Smat[k],Smat[k])
+        return np.tensordot(weights,spinQuadraticOperators(self.S),axes=2)
 
-        return Mat
+
+def _apply_site(op,psi,idx):
+    """ apply the one-center operator op to axis idx of the state tensor psi """
+    return np.moveaxis(np.tensordot(op,psi,axes=([1],[idx])),0,idx)
+
+
+class _HermitianOperator(LinearOperator):
+    """ Hermitian (complex) scipy LinearOperator of dimension dim, defined by the function matmat
+        that applies it to a block of vectors (columns) """
+
+    def __init__(self,dim,matmat):
+        super().__init__(complex,(dim,dim))
+        self._apply = matmat
+
+    def _matmat(self,X):
+        return self._apply(np.asarray(X))
+
+    def _matvec(self,x):
+        return self._apply(np.reshape(x,(-1,1)))
+
+    def _rmatmat(self,X):
+        return self._matmat(X)
+
+    def _rmatvec(self,x):
+        return self._matvec(x)
 
 
 class SpinSystem:
@@ -153,6 +166,8 @@ class SpinSystem:
         self.order = []
         self.interaction = []
         self.dimension = 0
+        self.max_dim = maxDim
+        self.max_sparse_dim = maxSparseDim
 
 
     def add(self,label,spin):
@@ -187,179 +202,418 @@ class SpinSystem:
             raise Exception(f"Undefined label: {label1}")
         if label2 not in self.spins.keys():
             raise Exception(f"Undefined label: {label2}")
-        Jmat = np.diag([Jiso-Jax/3.+Jrh,Jiso-Jax/3.+Jrh,Jiso+2*Jax/3.])
+        Jmat = np.diag([Jiso-Jax/3.+Jrh,Jiso-Jax/3.-Jrh,Jiso+2*Jax/3.])
         # set the actual matrices later to avoid mismatches due to changed axes
         # JmatT = np.matmul(spin1.axes,np.matmul(Jmat,spin2.axes))
         
         self.interaction.append([label1,label2,Jmat])
 
 
+    def _check_dimension(self,sparse):
+        """ make sure the matrices of the total system can be set up """
+        if sparse:
+            if self.dimension > self.max_sparse_dim:
+                raise Exception(f"Dimension too large for sparse matrices: {self.dimension}")
+        elif self.dimension > self.max_dim:
+            raise Exception(f"Dimension too large: {self.dimension} (consider the sparse matrices)")
+
+
+    def _embed_factors(self,ops):
+        """ get the factors of the tensor product of the operators in ops (dict: position in self.order
+            -> matrix) with unit matrices for all other centers; consecutive unit matrices are merged
+            into one and given by their dimension """
+        factors = []
+        dim_unit = 1
+        for idx,label in enumerate(self.order):
+            if idx not in ops:
+                dim_unit *= int(2*self.spins[label].S)+1
+                continue
+            if dim_unit > 1:
+                factors.append(dim_unit)
+                dim_unit = 1
+            factors.append(ops[idx])
+        if dim_unit > 1:
+            factors.append(dim_unit)
+        return factors
+
+
+    def _embed(self,ops):
+        """ form the tensor product of the operators in ops with unit matrices (see _embed_factors) """
+        Mat = np.ones((1,1),dtype=complex)
+        for factor in self._embed_factors(ops):
+            if isinstance(factor,int):
+                factor = np.identity(factor,dtype=complex)
+            Mat = np.kron(Mat,factor)
+        return Mat
+
+
+    def _embed_sparse(self,ops):
+        """ like _embed, but the tensor product is formed as scipy.sparse CSR matrix without dense
+            intermediates """
+        Mat = sps.csr_matrix(np.ones((1,1),dtype=complex))
+        for factor in self._embed_factors(ops):
+            if isinstance(factor,int):
+                factor = sps.identity(factor,dtype="complex",format="csr")
+            Mat = sps.csr_matrix(sps.kron(Mat,sps.csr_matrix(factor),format="csr"))
+        return Mat
+
+
+    def _sparse_sum(self,terms):
+        """ sum up scipy.sparse matrices of the dimension of the total system into a CSR matrix """
+        Mat = sps.csr_matrix((self.dimension,self.dimension),dtype=complex)
+        for term in terms:
+            Mat = sps.csr_matrix(Mat+term)
+        return Mat
+
+
+    def _exchange_terms(self,label1,label2,Jmat):
+        """ decompose the interaction S1.Jmat.S2 into three operator pairs (S1_k, sum_l J_kl S2_l)
+            returns the positions of both centers (in ascending order) and the list of pairs """
+
+        idx1 = self.order.index(label1)
+        idx2 = self.order.index(label2)
+        if idx2 < idx1:
+            idx1,idx2 = idx2,idx1
+            label1,label2 = label2,label1
+
+        spin1 = self.spins[label1]
+        spin2 = self.spins[label2]
+
+        Smat1 = spin1.get_spin_mat()
+        Smat2 = spin2.get_spin_mat()
+
+        # relative rotation:
+        relaxes = np.matmul(spin1.axes,spin2.axes.T)
+
+        # OK as long as Jmat is symmetric:
+        JmatT = np.matmul(relaxes,np.matmul(Jmat,relaxes))
+
+        # contract the second center first: sum_l J_kl S2_l, such that only three
+        # tensor products of full dimension are needed per interaction
+        terms = []
+        for k in range(3):
+            if np.all(np.abs(JmatT[k]) < numThr):
+                continue
+            JS2 = np.zeros(Smat2.shape[1:],dtype=complex)
+            for l in range(3):
+                if np.abs(JmatT[k,l]) < numThr:
+                    continue
+                JS2 += JmatT[k,l]*Smat2[l]
+            terms.append((Smat1[k],JS2))
+
+        return idx1,idx2,terms
+
+
+    def get_exchange_mat(self,label1,label2,Jmat):
+        """ get the matrix of the interaction S1.Jmat.S2 between the centers label1 and label2
+            (Jmat as stored by set_interaction) in the basis of the total system """
+
+        self._check_dimension(False)
+
+        Mat = np.zeros((self.dimension,self.dimension),dtype=complex)
+        idx1,idx2,terms = self._exchange_terms(label1,label2,Jmat)
+        for op1,op2 in terms:
+            Mat += self._embed({idx1: op1, idx2: op2})
+
+        return Mat
+
+
+    def get_site_mat(self,label,op):
+        """ get the matrix of the one-center operator op acting on center label in the basis of
+            the total system """
+
+        self._check_dimension(False)
+
+        return self._embed({self.order.index(label): op})
+
+
     def get_spin_mat(self):
         """ get the (pseudo) spin matrix of the total system """
 
-        dim_before=1
-        dim_after=self.dimension
-
-        if self.dimension > maxDim:
-            raise Exception(f"Dimension too large: {self.dimension}")
+        self._check_dimension(False)
 
         Mat = np.zeros((3,self.dimension,self.dimension),dtype=complex)
 
-        for label in self.order:
+        for idx,label in enumerate(self.order):
             SMat = self.spins[label].get_spin_mat()
-            cdim = SMat.shape[1]
-
-            dim_after //= cdim
-            if dim_before == 1 and dim_after == 1:
-                Mat += SMat
-            elif dim_before == 1:
-                Mat[0] += np.kron(SMat[0],np.identity(dim_after,dtype=complex))
-                Mat[1] += np.kron(SMat[1],np.identity(dim_after,dtype=complex))
-                Mat[2] += np.kron(SMat[2],np.identity(dim_after,dtype=complex))
-            elif dim_after == 1:
-                Mat[0] += np.kron(np.identity(dim_before,dtype=complex),SMat[0])
-                Mat[1] += np.kron(np.identity(dim_before,dtype=complex),SMat[1])
-                Mat[2] += np.kron(np.identity(dim_before,dtype=complex),SMat[2])
-            else:
-                Mat[0] += np.kron(np.identity(dim_before,dtype=complex),np.kron(SMat[0],np.identity(dim_after,dtype=complex)))
-                Mat[1] += np.kron(np.identity(dim_before,dtype=complex),np.kron(SMat[1],np.identity(dim_after,dtype=complex)))
-                Mat[2] += np.kron(np.identity(dim_before,dtype=complex),np.kron(SMat[2],np.identity(dim_after,dtype=complex)))
-
-            dim_before *= cdim
+            for k in range(3):
+                Mat[k] += self._embed({idx: SMat[k]})
 
         return Mat
 
 
+    def get_sparse_spin_mat(self):
+        """ get the (pseudo) spin matrix of the total system as a list of three scipy.sparse
+            CSR matrices (x,y,z) """
+
+        self._check_dimension(True)
+
+        SMats = [self.spins[label].get_spin_mat() for label in self.order]
+
+        return [self._sparse_sum(self._embed_sparse({idx: SMat[k]}) for idx,SMat in enumerate(SMats))
+                for k in range(3)]
+
+
     def get_M_mat(self):
         """ get the magnetic moment matrix elements of the total system """
 
-        dim_before=1
-        dim_after=self.dimension
-
-        if self.dimension > maxDim:
-            raise Exception(f"Dimension too large: {self.dimension}")
+        self._check_dimension(False)
 
         Mat = np.zeros((3,self.dimension,self.dimension),dtype=complex)
 
-        for label in self.order:
+        for idx,label in enumerate(self.order):
             MMat = self.spins[label].get_M_mat()
-            cdim = MMat.shape[1]
-
-            dim_after //= cdim
-            if dim_before == 1 and dim_after == 1:
-                Mat += MMat
-            elif dim_before == 1:
-                Mat[0] += np.kron(MMat[0],np.identity(dim_after,dtype=complex))
-                Mat[1] += np.kron(MMat[1],np.identity(dim_after,dtype=complex))
-                Mat[2] += np.kron(MMat[2],np.identity(dim_after,dtype=complex))
-            elif dim_after == 1:
-                Mat[0] += np.kron(np.identity(dim_before,dtype=complex),MMat[0])
-                Mat[1] += np.kron(np.identity(dim_before,dtype=complex),MMat[1])
-                Mat[2] += np.kron(np.identity(dim_before,dtype=complex),MMat[2])
-            else:
-                Mat[0] += np.kron(np.identity(dim_before,dtype=complex),np.kron(MMat[0],np.identity(dim_after,dtype=complex)))
-                Mat[1] += np.kron(np.identity(dim_before,dtype=complex),np.kron(MMat[1],np.identity(dim_after,dtype=complex)))
-                Mat[2] += np.kron(np.identity(dim_before,dtype=complex),np.kron(MMat[2],np.identity(dim_after,dtype=complex)))
-
-            dim_before *= cdim
+            for k in range(3):
+                Mat[k] += self._embed({idx: MMat[k]})
 
         return Mat
 
 
-    def get_H_mat(self):
-        """ get the (B field free) Hamiltonian matrix of the system """
-        
-        dim_before=1
-        dim_after=self.dimension
+    def get_sparse_M_mat(self):
+        """ get the magnetic moment matrix elements of the total system as a list of three
+            scipy.sparse CSR matrices (x,y,z) """
 
-        if self.dimension > maxDim:
-            raise Exception(f"Dimension too large: {self.dimension}")
+        self._check_dimension(True)
 
-        Mat = np.zeros((self.dimension,self.dimension),dtype=complex)
+        MMats = [self.spins[label].get_M_mat() for label in self.order]
+
+        return [self._sparse_sum(self._embed_sparse({idx: MMat[k]}) for idx,MMat in enumerate(MMats))
+                for k in range(3)]
+
+
+    def _H_terms(self,embed):
+        """ generate the one-center zero-field terms and the exchange terms of the Hamiltonian,
+            each formed in the basis of the total system by embed (_embed or _embed_sparse) """
 
         # start with one-center terms:
-        # collect dimensions:
-        dims = []
-        for label in self.order:
+        for idx,label in enumerate(self.order):
             MMat = self.spins[label].get_ZF_mat()
-            cdim = MMat.shape[1]
-
-            dims.append(cdim)
 
             # skip over zero contribution
             if np.vdot(MMat,MMat) < numThr*numThr:
                 continue
 
-            dim_after //= cdim
-            if dim_before == 1 and dim_after == 1:
-                Mat += MMat
-            elif dim_before == 1:
-                Mat += np.kron(MMat,np.identity(dim_after,dtype=complex))
-            elif dim_after == 1:
-                Mat += np.kron(np.identity(dim_before,dtype=complex),MMat)
-            else:
-                Mat += np.kron(np.identity(dim_before,dtype=complex),np.kron(MMat,np.identity(dim_after,dtype=complex)))
+            yield embed({idx: MMat})
 
-            dim_before *= cdim
+        for label1,label2,Jmat in self.interaction:
+            idx1,idx2,terms = self._exchange_terms(label1,label2,Jmat)
+            for op1,op2 in terms:
+                yield embed({idx1: op1, idx2: op2})
 
-        
 
-        for interact in self.interaction:
-            label1 = interact[0]
-            label2 = interact[1]
-            Jmat = interact[2]
-            dim_before = 1
-            idx = -1
-            switch = False
-            for label in self.order:
-                idx += 1
-                if label1 == label:
-                    break
-                if label2 == label:
-                    switch = True
-                    break
-                dim_before *= dims[idx]
-
-            dim_between = 1
-            jdx = idx
-            for label in self.order[idx+1:]:
-                jdx += 1
-                if label1 == label or label2 == label:
-                    break
-                dim_between *= dims[jdx]
-
-            dim_after = 1
-            for kdx in range(jdx+1,len(dims)):
-                dim_after *= dims[kdx]
-
-            if not switch:
-                spin1 = self.spins[label1]
-                spin2 = self.spins[label2]
-            else:
-                spin1 = self.spins[label2]
-                spin2 = self.spins[label1]
+    def get_H_mat(self):
+        """ get the (B field free) Hamiltonian matrix of the system """
+
+        self._check_dimension(False)
+
+        Mat = np.zeros((self.dimension,self.dimension),dtype=complex)
+        for term in self._H_terms(self._embed):
+            Mat += term
 
-            Smat1 = spin1.get_spin_mat()
-            Smat2 = spin2.get_spin_mat()
+        return Mat
 
-            # relative rotation:
-            relaxes = np.matmul(spin1.axes,spin2.axes.T)
 
-            # OK as long as Jmat is symmetric:
-            JmatT = np.matmul(relaxes,np.matmul(Jmat,relaxes))
+    def get_sparse_H_mat(self):
+        """ get the (B field free) Hamiltonian matrix of the system as scipy.sparse CSR matrix """
 
-            for k in range(3):
-                for l in range(3):
-                    if np.abs(JmatT[k,l]) < numThr:
-                        continue
-                    Mat += JmatT[k,l]*np.kron(np.kron(np.kron(np.kron(
-                                              np.identity(dim_before,dtype=complex),
-                                              Smat1[k]),
-                                              np.identity(dim_between,dtype=complex)),
-                                              Smat2[l]),
-                                              np.identity(dim_after,dtype=complex)
-                                              )
+        self._check_dimension(True)
 
-        return Mat
+        return self._sparse_sum(self._H_terms(self._embed_sparse))
+
+
+    def _get_dims(self):
+        return [int(2*self.spins[label].S)+1 for label in self.order]
+
+
+    def _get_operator_terms(self,Bfield=None):
+        """ collect the one-center operators (zero-field and Zeeman terms combined) and the
+            two-center operator pairs that make up the Hamiltonian """
+
+        one_center = []
+        for idx,label in enumerate(self.order):
+            spin = self.spins[label]
+            op = spin.get_ZF_mat()
+            if Bfield is not None:
+                MMat = spin.get_M_mat()
+                for c in range(3):
+                    # H_Zeeman = - M B
+                    op -= Bfield[c]*MMat[c]*muBcm
+            if np.vdot(op,op) >= numThr*numThr:
+                one_center.append((idx,op))
+
+        two_center = []
+        for label1,label2,Jmat in self.interaction:
+            idx1,idx2,terms = self._exchange_terms(label1,label2,Jmat)
+            two_center += [(idx1,op1,idx2,op2) for op1,op2 in terms]
+
+        return one_center,two_center
+
+
+    def get_H_operator(self,Bfield=None):
+        """ get the Hamiltonian (including the Zeeman term for Bfield (x,y,z) in Tesla, if given)
+            as scipy LinearOperator; the matrix is never formed, instead each term is applied to the
+            state vector reshaped into a tensor with one axis per center; unit is cm-1 """
+
+        dims = self._get_dims()
+        one_center,two_center = self._get_operator_terms(Bfield)
 
+        def matmat(X):
+            nvec = X.shape[1]
+            psi = X.reshape(dims+[nvec])
+            sigma = np.zeros(psi.shape,dtype=complex)
+            for idx,op in one_center:
+                sigma += _apply_site(op,psi,idx)
+            for idx1,op1,idx2,op2 in two_center:
+                sigma += _apply_site(op1,_apply_site(op2,psi,idx2),idx1)
+            return sigma.reshape((self.dimension,nvec))
 
+        return _HermitianOperator(self.dimension,matmat)
+
+
+    def get_M_operator(self):
+        """ get the three components of the magnetic moment operator as scipy LinearOperators """
+
+        dims = self._get_dims()
+        MMats = [self.spins[label].get_M_mat() for label in self.order]
+
+        def make(c):
+            def matmat(X):
+                nvec = X.shape[1]
+                psi = X.reshape(dims+[nvec])
+                sigma = np.zeros(psi.shape,dtype=complex)
+                for idx,MMat in enumerate(MMats):
+                    sigma += _apply_site(MMat[c],psi,idx)
+                return sigma.reshape((self.dimension,nvec))
+            return _HermitianOperator(self.dimension,matmat)
+
+        return [make(c) for c in range(3)]
+
+
+    def get_lowest_states(self,nstates,Bfield=None,tol=0,ncv=None,v0=None,deg_thr=1e-3):
+        """ compute the nstates lowest eigenstates of the Hamiltonian (with Zeeman term for Bfield in Tesla)
+            iteratively (Lanczos, scipy.sparse.linalg.eigsh) using the matrix-free operator
+            returns the energies (cm-1), the eigenvectors (columns) and the magnetic moment matrix
+            in the basis of these states (3,n,n; Bohr magnetons), whose diagonal holds the expectation
+            values; degenerate states (energies within deg_thr) are resolved by their Mz values as in
+            diagonalizeSpinHamiltonian
+            if the nstates-th state belongs to a degenerate level, further states are computed until
+            the level is complete, so n may be larger than nstates; otherwise the returned states would
+            be an arbitrary part of the level """
+
+        Hop = self.get_H_operator(Bfield)
+
+        nroots = nstates
+        while True:
+            # one extra root tells whether the last level continues beyond the returned states
+            if nroots + 1 >= self.dimension - 1:
+                raise Exception(f"Too many states requested ({nroots}) for dimension {self.dimension}; use dense diagonalization")
+
+            En,U = eigsh(Hop,k=nroots+1,which="SA",tol=tol,ncv=ncv,v0=v0)
+
+            order = np.argsort(En)
+            En = En[order]
+            U = U[:,order]
+
+            # first state of the last level (grouped like in resolveDegeneracies)
+            start = 0
+            for idx in range(1,nroots):
+                if En[idx]-En[start] >= deg_thr:
+                    start = idx
+            if En[nroots]-En[start] >= deg_thr:
+                break
+            nroots += nroots-start+1
+
+        # for complex matrices, ARPACK does not keep the eigenvectors of a degenerate level orthogonal,
+        # so they are replaced by those of the Hamiltonian projected onto the orthonormalized subspace
+        Q,_ = np.linalg.qr(U[:,:nroots])
+        En,W = np.linalg.eigh(np.matmul(np.conj(Q.T),Hop.matmat(Q)))
+        U = np.ascontiguousarray(np.matmul(Q,W))
+
+        Mop = self.get_M_operator()
+        MU = np.array([Mop[c].matmat(U) for c in range(3)])
+        U = resolveDegeneracies(En,U,np.matmul(np.conj(U.T),MU[2]),deg_thr)
+
+        MU = np.array([Mop[c].matmat(U) for c in range(3)])
+        Mmat = np.matmul(np.conj(U.T)[np.newaxis],MU)
+
+        return En,U,Mmat
+
+
+    def get_twoM(self):
+        """ get 2*M_S (as integers) of all product basis states, with M_S the total spin projection """
+        twoM = np.zeros(1,dtype=int)
+        for label in self.order:
+            S2 = int(2*self.spins[label].S)
+            twoM = np.add.outer(twoM,np.arange(S2,-S2-1,-2)).reshape(-1)
+        return twoM
+
+
+    def get_conserved_blocks(self,Bfield=None):
+        """ detect whether M_S (or M_S modulo some integer, e.g. for rhombic terms with a common axis)
+            is conserved by the Hamiltonian (with Zeeman term for Bfield) and return the index arrays of
+            the product basis states in each block; if nothing is conserved, a single block is returned """
+
+        twoM_site = [np.arange(dim-1,-dim,-2) for dim in self._get_dims()]
+        one_center,two_center = self._get_operator_terms(Bfield)
+
+        # collect the changes of 2*M_S caused by any of the terms
+        step = 0
+        for idx,op in one_center:
+            delta = np.subtract.outer(twoM_site[idx],twoM_site[idx])
+            for d in np.unique(delta[np.abs(op) > numThr]):
+                step = gcd(step,int(d))
+        pairs = {}
+        for idx1,op1,idx2,op2 in two_center:
+            pairs[(idx1,idx2)] = pairs.get((idx1,idx2),0) + np.kron(op1,op2)
+        for (idx1,idx2),op in pairs.items():
+            twoM_pair = np.add.outer(twoM_site[idx1],twoM_site[idx2]).reshape(-1)
+            delta = np.subtract.outer(twoM_pair,twoM_pair)
+            for d in np.unique(delta[np.abs(op) > numThr]):
+                step = gcd(step,int(d))
+
+        twoM = self.get_twoM()
+        if step == 2:
+            # M_S changes by all integer values: nothing to exploit
+            return [np.arange(self.dimension)]
+        elif step > 2:
+            twoM = np.mod(twoM,step)
+
+        return [np.nonzero(twoM == key)[0] for key in np.unique(twoM)]
+
+
+    def diagonalize(self,Bfield=None,use_symmetry=True):
+        """ diagonalize the Hamiltonian (with Zeeman term for Bfield (x,y,z) in Tesla) like
+            diagonalizeSpinHamiltonian; if use_symmetry is set, conserved M_S (see get_conserved_blocks)
+            is exploited and each block is set up and diagonalized separately
+            returns the energies and eigenvectors (columns) in the product basis """
+
+        self._check_dimension(False)
+
+        Hmat = self.get_sparse_H_mat()
+        Mmat = self.get_sparse_M_mat()
+        if Bfield is not None:
+            for c in range(3):
+                # H_Zeeman = - M B
+                Hmat = Hmat - Bfield[c]*muBcm*Mmat[c]
+        Hmat = Hmat.tocsr()
+
+        blocks = self.get_conserved_blocks(Bfield) if use_symmetry else [np.arange(self.dimension)]
+
+        En = np.zeros(self.dimension)
+        U = np.zeros((self.dimension,self.dimension),dtype=complex)
+        offset = 0
+        for block in blocks:
+            nblk = len(block)
+            Eblk,Ublk = np.linalg.eigh(Hmat[block][:,block].toarray())
+            En[offset:offset+nblk] = Eblk
+            U[block,offset:offset+nblk] = Ublk
+            offset += nblk
+
+        order = np.argsort(En,kind="stable")
+        En = En[order]
+        U = U[:,order]
+
+        Mtraf = np.matmul(np.conj(U.T),Mmat[2] @ U)
+        U = resolveDegeneracies(En,U,Mtraf)
+
+        return En,U
@@ -1,4 +1,5 @@
 from collections.abc import Iterable
+from functools import lru_cache
 
 import numpy as np
 
@@ -7,6 +8,74 @@ from .coordinate import Coordinate3D
 
 """ A set of routines for setting up spin Hamiltonians  """
 
+# Upper bound for the number of complex elements alive at once while diagonalizing a field sweep (256 MB)
+maxSweepElements = 2**24
+
+# (dim, dim) complex stacks alive per field at the peak of _diagonalizeFields: Hamiltonian, eigenvectors
+# and eigh workspace, Mz in the eigenbasis, degeneracy resolution and one moment component (measured)
+_sweepStacksPerField = 9
+
+def _readOnly(mat):
+    mat.flags.writeable = False
+    return mat
+
+
+@lru_cache(maxsize=None)
+def _spinOperatorCache(twoS: int):
+    """ build all cached operators for spin quantum number S = twoS/2 at once """
+    S = 0.5 * twoS
+    multiplicity = twoS + 1
+
+    # ladder operators: S_+ |S, Ms-1> = sqrt(S(S+1) - Ms(Ms-1)) |S, Ms>, basis ordered by descending Ms
+    Ms = S - np.arange(multiplicity - 1)
+    vals = np.sqrt(S * (S + 1) - Ms * (Ms - 1))
+    Splus = np.diag(vals, k=1).astype(complex)
+    Sminus = np.diag(vals, k=-1).astype(complex)
+
+    # S_x = 0.5 * (S_+ + S_-), S_y = -i/2 * (S_+ - S_-), S_z contains the Ms values (descending)
+    ops = np.array([
+        0.5 * (Splus + Sminus),
+        -0.5j * (Splus - Sminus),
+        np.diag(np.linspace(start=+S, stop=-S, num=multiplicity)).astype(complex),
+    ])
+
+    # symmetrized products S_k S_l + S_l S_k
+    prod = np.matmul(ops[:, np.newaxis], ops[np.newaxis, :])
+    quadratic = prod + np.swapaxes(prod, 0, 1)
+
+    return {
+        "ops": _readOnly(ops),
+        "ladder": _readOnly(np.array([Splus, Sminus])),
+        "squared": _readOnly(S * (S + 1) * np.identity(multiplicity, dtype=complex)),
+        "quadratic": _readOnly(quadratic),
+    }
+
+
+def _twoS(S: float) -> int:
+    assert S - int(S) in [0, 0.5], "Spin can only take on half-integer numbers"
+    return int(2 * S)
+
+
+def spinOperators(S: float):
+    """Return the (cached, read-only) matrices of S_x, S_y and S_z as array [3,dim,dim]"""
+    return _spinOperatorCache(_twoS(S))["ops"]
+
+
+def spinLadderOperators(S: float):
+    """Return the (cached, read-only) matrices of S_+ and S_- as array [2,dim,dim]"""
+    return _spinOperatorCache(_twoS(S))["ladder"]
+
+
+def spinSquared(S: float):
+    """Return the (cached, read-only) matrix of S^2"""
+    return _spinOperatorCache(_twoS(S))["squared"]
+
+
+def spinQuadraticOperators(S: float):
+    """Return the (cached, read-only) symmetrized products S_k S_l + S_l S_k as array [3,3,dim,dim]"""
+    return _spinOperatorCache(_twoS(S))["quadratic"]
+
+
 def spinMat(S: float, cmp: Coordinate3D | str):
     """Return matrix elements of operator S_i (with i == cmp) for spin quantum number S
     (in multiples of hbar)"""
@@ -16,42 +85,12 @@ def spinMat(S: float, cmp: Coordinate3D | str):
 
     assert type(cmp) is Coordinate3D
 
-    multiplicity = int(2 * S + 1)
-
-    assert S - int(S) in [0, 0.5], "Spin can only take on half-integer numbers"
+    mat = spinOperators(S)[cmp.value]
 
+    # return a private copy (S_z as real matrix, as always)
     if cmp == Coordinate3D.Z:
-        # The S_z matrix is a diagonal matrix that contains the possible Ms values
-        # on its diagonal (in descending order)
-        return np.diag(np.linspace(start=+S, stop=-S, num=multiplicity))
-    elif cmp == Coordinate3D.X:
-        # S_x is expressed in terms of ladder operators:
-        # S_x = 0.5 * (S_+ + S_-)
-        # Because of the ladder operators, the entries appear on the off-diagonal
-        Smat = np.zeros((multiplicity, multiplicity), dtype=complex)
-        Ms = S
-        SS1 = S * (S + 1)
-        for ii in range(multiplicity - 1):  # we run over column
-            val = 0.5 * np.sqrt(SS1 - Ms * (Ms - 1))
-            Smat[ii + 1, ii] = val
-            Smat[ii, ii + 1] = val
-            Ms -= 1.0
-
-        return Smat
-    elif cmp == Coordinate3D.Y:
-        # S_y is expressed in terms of ladder operators:
-        # S_y = -i/2 * (S_+ - S_-)
-        # Because of the ladder operators, the entries appear on the off-diagonal
-        Smat = np.zeros((multiplicity, multiplicity), dtype=complex)
-        Ms = S
-        SS1 = S * (S + 1)
-        for ii in range(multiplicity - 1):  # we run over column
-            val = np.sqrt(SS1 - Ms * (Ms - 1))
-            Smat[ii + 1, ii] = 0.5j * val
-            Smat[ii, ii + 1] = -0.5j * val
-            Ms -= 1.0
-
-        return Smat
+        return mat.real.copy()
+    return mat.copy()
 
 def spin_mat(spin_qns: float | Iterable[float], component: Coordinate3D):
     """Computes the combined spin matrix for the given spin quantum numbers (block-diagonal)"""
@@ -118,33 +157,267 @@ def diagonalizeSpinHamiltonian(Hmat, Mmat=None, Bfield=None):
     En, U = np.linalg.eigh(HmatD)
 
     if Mmat is not None:
-        # loop across energies; for degenerate tuples diagonalize Mmat[2] expectation values in that block
-        idxst = 0
-        idxnd = 0
         Mtraf = np.matmul(np.conj(U.T),np.matmul(Mmat[2],U))
-        ndim = En.shape[0]
-        while idxst < ndim:
-            ndim_block = 0
-            while (
-                idxst + ndim_block < ndim
-                and np.abs(En[idxst + ndim_block] - En[idxst]) < 1e-3
-            ):
-                ndim_block += 1
-            idxnd = idxst + ndim_block
-            # print("current block: ",idxst,idxnd-1)
-            # use negative submat to get positive Mu first
-            submat = -np.array(Mtraf[idxst:idxnd, idxst:idxnd])
-            # printMatC(submat)
-            # print()
-            # diagonalize submatrix
-            _, Usub = np.linalg.eigh(submat)
-            # apply this to total eigenvectors: transform and insert
-            Unew = np.matmul(U[0:ndim, idxst:idxnd], Usub)
-            U[0:ndim, idxst:idxnd] = Unew
-            idxst = idxnd
+        U = resolveDegeneracies(En, U, Mtraf)
 
     return En, U
 
+
+def resolveDegeneracies(En, U, Mtraf, thr=1e-3):
+    """ for degenerate tuples of eigenvectors U (columns) with energies En, diagonalize the
+        Mz expectation values in that block; Mtraf is Mz in the basis of U
+        returns the transformed eigenvectors (U is modified in place) """
+
+    # loop across energies
+    idxst = 0
+    idxnd = 0
+    ndim = En.shape[0]
+    nrow = U.shape[0]
+    while idxst < ndim:
+        ndim_block = 0
+        while (
+            idxst + ndim_block < ndim
+            and np.abs(En[idxst + ndim_block] - En[idxst]) < thr
+        ):
+            ndim_block += 1
+        idxnd = idxst + ndim_block
+        # print("current block: ",idxst,idxnd-1)
+        # use negative submat to get positive Mu first
+        submat = -np.array(Mtraf[idxst:idxnd, idxst:idxnd])
+        # printMatC(submat)
+        # print()
+        # diagonalize submatrix
+        _, Usub = np.linalg.eigh(submat)
+        # apply this to total eigenvectors: transform and insert
+        Unew = np.matmul(U[0:nrow, idxst:idxnd], Usub)
+        U[0:nrow, idxst:idxnd] = Unew
+        idxst = idxnd
+
+    return U
+
+def resolveDegeneraciesBatched(En, U, Mtraf, thr=1e-3):
+    """ vectorized version of resolveDegeneracies for stacks En[F,dim], U[F,dim,dim], Mtraf[F,dim,dim] """
+
+    # group consecutive (ascending) energies that are closer than thr to the first of their group;
+    # like in resolveDegeneracies, a new group starts once the distance to the group start reaches thr
+    nF, ndim = En.shape
+    group = np.zeros((nF, ndim), dtype=int)
+    start = En[:, 0].copy()
+    for ii in range(1, ndim):
+        new = np.abs(En[:, ii] - start) >= thr
+        group[:, ii] = group[:, ii - 1] + new
+        start = np.where(new, En[:, ii], start)
+
+    # only stacks with degenerate levels need to be treated
+    todo = np.nonzero(group[:, -1] < ndim - 1)[0]
+    if len(todo) == 0:
+        return U
+    group = group[todo]
+
+    # block-diagonal -Mz (positive Mu first) with the groups shifted apart, such that a single
+    # diagonalization yields the eigenvectors of all blocks in their original order
+    same = group[:, :, np.newaxis] == group[:, np.newaxis, :]
+    submat = np.where(same, -Mtraf[todo], 0.)
+    shift = 2.0 * np.max(np.abs(Mtraf[todo])) * ndim + 1.0
+    submat[:, np.arange(ndim), np.arange(ndim)] += shift * group
+    _, W = np.linalg.eigh(submat)
+
+    U = np.array(U)
+    U[todo] = np.matmul(U[todo], W)
+
+    return U
+
+
+def _sweepFields(Bvalues, Bdirections):
+    """ the fields (nO*nB,3) in Tesla of a field sweep (see diagonalizeFieldSweep) and the shape (nO,nB) """
+    Bvalues = np.atleast_1d(np.asarray(Bvalues, dtype=float))
+    if Bdirections is None:
+        Bdirections = [0., 0., 1.]
+    Bdirections = np.atleast_2d(np.asarray(Bdirections, dtype=float))
+    Bdirections = Bdirections / np.linalg.norm(Bdirections, axis=1)[:, np.newaxis]
+
+    fields = (Bdirections[:, np.newaxis, :] * Bvalues[np.newaxis, :, np.newaxis]).reshape((-1, 3))
+    return fields, (Bdirections.shape[0], Bvalues.shape[0])
+
+
+def _diagonalizeFields(Hmat, Mmat, fields, chunkSize):
+    """ diagonalize the Spin Hamiltonian for all fields (nF,3), chunkSize fields at a time
+        yields the range of fields (first,last) of each chunk with its energies, magnetic moment
+        expectation values and eigenvectors """
+    nF = fields.shape[0]
+    ndim = Hmat.shape[0]
+
+    if chunkSize is None:
+        chunkSize = max(1, maxSweepElements // (_sweepStacksPerField * ndim * ndim))
+
+    for first in range(0, nF, chunkSize):
+        last = min(first + chunkSize, nF)
+        # H_Zeeman = - M B
+        HmatD = Hmat[np.newaxis] - muBcm * np.tensordot(fields[first:last], Mmat, axes=1)
+        Eblk, Ublk = np.linalg.eigh(HmatD)
+
+        Mtraf = np.matmul(np.conj(np.swapaxes(Ublk, 1, 2)), np.matmul(Mmat[2], Ublk))
+        Ublk = resolveDegeneraciesBatched(Eblk, Ublk, Mtraf)
+
+        # expectation values <i|M_c|i> = sum_k conj(U[k,i]) (M_c U)[k,i], one component at a time
+        Mublk = np.zeros((last - first, 3, ndim))
+        for cc in range(3):
+            Mublk[:, cc] = np.sum(np.conj(Ublk) * np.matmul(Mmat[cc], Ublk), axis=1).real
+
+        yield first, last, Eblk, Mublk, Ublk
+
+
+def diagonalizeFieldSweep(Hmat, Mmat, Bvalues, Bdirections=None, chunkSize=None):
+    """ diagonalize the Spin Hamiltonian for many fields at once (cf. diagonalizeSpinHamiltonian)
+        Hmat in cm-1, Mmat[3,dim,dim] in Bohr magnetons, Bvalues (nB) field strengths in Tesla,
+        Bdirections (nO,3) field orientations (normalized internally; default: z axis)
+        the Zeeman Hamiltonians are set up as one stack via tensordot and diagonalized batch-wise;
+        chunkSize limits the number of fields treated at once (default: peak memory of about 256 MB
+        including all temporaries, see maxSweepElements)
+        returns En[nO,nB,dim], the magnetic moment expectation values Mu[nO,nB,3,dim] and
+        the eigenvectors U[nO,nB,dim,dim] (see fieldSweepLevels if they are not needed) """
+
+    Hmat = np.asarray(Hmat)
+    Mmat = np.asarray(Mmat)
+    fields, shape = _sweepFields(Bvalues, Bdirections)
+    nF = fields.shape[0]
+    ndim = Hmat.shape[0]
+
+    En = np.zeros((nF, ndim))
+    Mu = np.zeros((nF, 3, ndim))
+    U = np.zeros((nF, ndim, ndim), dtype=complex)
+    for first, last, Eblk, Mublk, Ublk in _diagonalizeFields(Hmat, Mmat, fields, chunkSize):
+        En[first:last] = Eblk
+        Mu[first:last] = Mublk
+        U[first:last] = Ublk
+
+    return En.reshape(shape + (ndim,)), Mu.reshape(shape + (3, ndim)), U.reshape(shape + (ndim, ndim))
+
+
+def fieldSweepLevels(Hmat, Mmat, Bvalues, Bdirections=None, chunkSize=None):
+    """ like diagonalizeFieldSweep, but the eigenvectors are not kept
+        returns En[nO,nB,dim] and the magnetic moment expectation values Mu[nO,nB,3,dim] """
+
+    Hmat = np.asarray(Hmat)
+    Mmat = np.asarray(Mmat)
+    fields, shape = _sweepFields(Bvalues, Bdirections)
+    nF = fields.shape[0]
+    ndim = Hmat.shape[0]
+
+    En = np.zeros((nF, ndim))
+    Mu = np.zeros((nF, 3, ndim))
+    for first, last, Eblk, Mublk, _ in _diagonalizeFields(Hmat, Mmat, fields, chunkSize):
+        En[first:last] = Eblk
+        Mu[first:last] = Mublk
+
+    return En.reshape(shape + (ndim,)), Mu.reshape(shape + (3, ndim))
+
+
+def _zeroFieldManifolds(En, thr):
+    """ split ascending energies into manifolds of (quasi-)degenerate levels; returns index arrays """
+    starts = np.concatenate(([0], np.nonzero(np.diff(En) >= thr)[0] + 1, [len(En)]))
+    return [np.arange(starts[ii], starts[ii + 1]) for ii in range(len(starts) - 1)]
+
+
+def diagonalizeLowField(Hmat, Mmat, Bvalues, Bdirection=None, ratioThr=0.05, degThr=1e-6):
+    """ energies and magnetic moments for many weak fields from one zero-field diagonalization
+        Hmat in cm-1, Mmat[3,dim,dim] in Bohr magnetons, Bvalues (nB) field strengths in Tesla along
+        Bdirection (default: z axis)
+        Every zero-field manifold b (levels closer than degThr) is treated by quasi-degenerate
+        perturbation theory up to second order in the Zeeman operator V = -muB B.M,
+            H_eff = E_b + V_bb + sum_{m not in b} V_bm V_mb / (E_b - E_m),
+        and H_eff is diagonalized for all fields at once. The moments are obtained as
+        Mu_c = -dE/dB_c / muB from H_eff. Fields for which |B| muB ||M_b,rest|| / gap_b exceeds
+        ratioThr for any manifold are diagonalized exactly instead (cf. fieldSweepLevels)
+        returns En[nB,dim], Mu[nB,3,dim] and a boolean array marking the exactly treated fields """
+
+    Hmat = np.asarray(Hmat)
+    Mmat = np.asarray(Mmat)
+    Bvalues = np.atleast_1d(np.asarray(Bvalues, dtype=float))
+    if Bdirection is None:
+        Bdirection = [0., 0., 1.]
+    Bdirection = np.asarray(Bdirection, dtype=float)
+    Bdirection = Bdirection / np.linalg.norm(Bdirection)
+    ndim = Hmat.shape[0]
+
+    # the only diagonalization needed within the range of validity
+    E0, U0 = np.linalg.eigh(Hmat)
+    # H_Zeeman = - M B = sum_c B_c W_c
+    W = -muBcm * np.matmul(np.conj(U0.T), np.matmul(Mmat, U0))
+
+    fields = Bvalues[:, np.newaxis] * Bdirection[np.newaxis, :]
+    En = np.zeros((len(Bvalues), ndim))
+    Mu = np.zeros((len(Bvalues), 3, ndim))
+    ratio = np.zeros(len(Bvalues))
+
+    pos = 0
+    for block in _zeroFieldManifolds(E0, degThr):
+        rest = np.setdiff1d(np.arange(ndim), block)
+        Wbb = W[:, block][:, :, block]
+        Wbr = W[:, block][:, :, rest]
+        denom = E0[block[0]] - E0[rest]
+
+        # second-order couplings X_cd = W_c,br W_d,rb / (E_b - E_r)
+        X = np.einsum("cir,r,drj->cdij", Wbr, 1.0 / denom, np.conj(np.swapaxes(Wbr, 1, 2)))
+        if len(rest) > 0:
+            coupling = np.sqrt(np.sum(np.abs(Wbr) ** 2))
+            ratio = np.maximum(ratio, np.abs(Bvalues) * coupling / np.min(np.abs(denom)))
+
+        Heff = E0[block[0]] * np.identity(len(block)) + np.tensordot(fields, Wbb, axes=1) \
+            + np.einsum("fc,fd,cdij->fij", fields, fields, X)
+        Eblk, V = np.linalg.eigh(Heff)
+
+        # dH_eff/dB_c = W_c + sum_d B_d (X_cd + X_dc)
+        dHeff = Wbb[np.newaxis] + np.einsum("fd,cdij->fcij", fields, X + np.swapaxes(X, 0, 1))
+        dE = np.einsum("fik,fcij,fjk->fck", np.conj(V), dHeff, V).real
+
+        En[:, pos:pos + len(block)] = Eblk
+        Mu[:, :, pos:pos + len(block)] = -dE / muBcm
+        pos += len(block)
+
+    # levels of different manifolds may have crossed
+    order = np.argsort(En, axis=1)
+    En = np.take_along_axis(En, order, axis=1)
+    Mu = np.take_along_axis(Mu, order[:, np.newaxis, :], axis=2)
+
+    exact = ratio > ratioThr
+    if np.any(exact):
+        Eex, Muex = fieldSweepLevels(Hmat, Mmat, Bvalues[exact], Bdirection)
+        En[exact] = Eex[0]
+        Mu[exact] = Muex[0]
+
+    return En, Mu, exact
+
+
+def gerlochMcMeekingTensor(mu, imagThr=None):
+    """ compute the Gerloch McMeeking tensor A_ab = 1/2 Re Tr(mu_a mu_b) for the magnetic moment
+        operator mu[...,3,dim,dim] (arbitrary leading dimensions, e.g. for many doublets);
+        if imagThr is given, the imaginary parts of the traces are checked to be below it
+        returns A[...,3,3] """
+    traces = np.einsum("...akl,...blk->...ab", mu, mu)
+    if imagThr is not None:
+        assert np.all(np.abs(traces.imag) < imagThr)
+    return 0.5 * traces.real
+
+
+def _orderMagneticAxes(Amat):
+    """ diagonalize (a stack of) Gerloch McMeeking tensors and order the axes as in getMagneticAxes """
+
+    Adia,Rmat = np.linalg.eigh(Amat)
+
+    # evalues are positive and in ascending order
+    oblate = Adia[...,2]-Adia[...,1] < Adia[...,1]-Adia[...,0]
+    order = np.where(oblate[...,np.newaxis],np.array([1,2,0]),np.array([0,1,2]))
+
+    Adia = np.take_along_axis(Adia,order,axis=-1)
+    Rmat = np.take_along_axis(Rmat,order[...,np.newaxis,:],axis=-1)
+
+    # ensure right-handedness:
+    Rmat = np.where((np.linalg.det(Rmat) < 0.)[...,np.newaxis,np.newaxis],-Rmat,Rmat)
+
+    return Adia,Rmat
+
+
 def getMagneticAxes(mu):
     """ mu[3,dim,dim] contains the dim x dim representation of the 
         magnetic moment operator in a given basis, the first dimension
@@ -153,37 +426,33 @@ def getMagneticAxes(mu):
         on exit, return the main magnetic axes the eigenvalues of the 
         Gerloch McMeeking tensor """
 
-    Amat = np.zeros((3,3))
-    dim = mu.shape[1]
+    return _orderMagneticAxes(gerlochMcMeekingTensor(mu))
 
-    for ii in range(3):
-        for jj in range(3):
-            for kk in range(dim):
-                for ll in range(dim):
-                    Amat[ii,jj]=Amat[ii,jj]+0.5*(mu[ii,kk,ll]*mu[jj,ll,kk]).real
 
-    Adia,Rmat = np.linalg.eigh(Amat)
+def getMagneticAxesBatched(mu, S=0.5):
+    """ batched version of getMagneticAxes for mu[...,3,dim,dim], e.g. for many Kramers doublets
+        (see kramersDoubletMoments) or many geometries; S is the pseudospin of the blocks
+        returns the eigenvalues of the Gerloch McMeeking tensors [...,3], the main magnetic axes
+        (as columns) [...,3,3] and the g values [...,3] """
 
-    # evalues are positive and in ascending order
-    if Adia[2]-Adia[1] < Adia[1]-Adia[0]:
-        # oblate case
-        idx0=1
-        idx1=2
-        idx2=0
-    else:
-        # prolate case
-        idx0=0
-        idx1=1
-        idx2=2
-
-    Adia = np.array([Adia[idx0],Adia[idx1],Adia[idx2]])
-    Rmat = np.array([Rmat[:,idx0],Rmat[:,idx1],Rmat[:,idx2]]).T
+    Adia,Rmat = _orderMagneticAxes(gerlochMcMeekingTensor(mu))
 
-    # ensure right-handedness:
-    if (np.linalg.det(Rmat)<0.):
-        Rmat = -Rmat
+    return Adia,Rmat,A_to_g(np.maximum(Adia,0.),S)
 
-    return Adia,Rmat
+
+def kramersDoubletMoments(MmatT, ndoublets=None):
+    """ extract the 2x2 blocks of consecutive (Kramers) doublets from the magnetic moment
+        matrix MmatT[3,dim,dim] given in the eigenbasis; returns mu[ndoublets,3,2,2] """
+
+    MmatT = np.asarray(MmatT)
+    if ndoublets is None:
+        ndoublets = MmatT.shape[1] // 2
+    idx = 2 * np.arange(ndoublets)
+
+    blocks = np.stack((np.stack((MmatT[:,idx,idx],MmatT[:,idx,idx+1]),axis=-1),
+                       np.stack((MmatT[:,idx+1,idx],MmatT[:,idx+1,idx+1]),axis=-1)),axis=-2)
+
+    return np.moveaxis(blocks,1,0)
 
 
 def A_to_g(Adia,S):
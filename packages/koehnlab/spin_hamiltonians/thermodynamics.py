@@ -0,0 +1,77 @@
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+from .phys_const import kBcm, ChiCGS
+
+""" Thermodynamic functions of a set of levels for arrays of temperatures and fields. All quantities are
+    evaluated in the log domain (log-sum-exp with the lowest level of every field as reference), such
+    that neither the partition function nor the Boltzmann factors over- or underflow for large splittings
+    or low temperatures (unlike getBoltzmannFactors). """
+
+
+@dataclass
+class ThermodynamicProperties:
+    """ results of thermodynamics; all arrays have the shape (nT,) + shape of the fields """
+
+    # natural logarithm of the partition function (absolute energies)
+    logZ: np.ndarray
+    # mean energy (cm-1)
+    energy: np.ndarray
+    # heat capacity per molecule in units of kB (per mole in units of R)
+    heat_capacity: np.ndarray
+    # entropy per molecule in units of kB (per mole in units of R)
+    entropy: np.ndarray
+    # magnetization along the field (Bohr magnetons), if moments were given
+    magnetization: Optional[np.ndarray] = None
+    # susceptibility M/B (cm3/mol), if moments and fields were given (nan for zero field)
+    chi: Optional[np.ndarray] = None
+
+    @property
+    def partition_function(self):
+        """ the partition function itself (may overflow for absolute energies far below zero) """
+        return np.exp(self.logZ)
+
+
+def thermodynamics(En, Temps, Mpar=None, Bvalues=None):
+    """ thermodynamic properties for the levels En[...,dim] (cm-1; e.g. [nB,dim] from a field sweep)
+        at the temperatures Temps[nT] (K); Mpar[...,dim] are the moments of the levels along the field
+        (Bohr magnetons) and Bvalues the field strengths (Tesla, broadcastable to En.shape[:-1])
+        the (nT,...) arrays are computed at once from the Boltzmann weights
+            p_i = exp(-beta (E_i - E_0) - log sum_j exp(-beta (E_j - E_0))) """
+    En = np.asarray(En, dtype=float)
+    Temps = np.atleast_1d(np.asarray(Temps, dtype=float))
+    if np.any(Temps <= 0.):
+        raise Exception("thermodynamics: temperatures must be positive")
+
+    E0 = np.min(En, axis=-1, keepdims=True)
+    Erel = En-E0
+    beta = (1./(kBcm*Temps)).reshape((-1,)+(1,)*En.ndim)
+
+    # log-sum-exp with the largest term (ground level) equal to one
+    logw = -beta*Erel[np.newaxis]
+    logZrel = np.log(np.sum(np.exp(logw), axis=-1))
+    p = np.exp(logw-logZrel[..., np.newaxis])
+
+    energy_rel = np.sum(p*Erel, axis=-1)
+    # two-pass variance to avoid cancellation
+    varE = np.sum(p*(Erel-energy_rel[..., np.newaxis])**2, axis=-1)
+    beta = beta[..., 0]
+
+    properties = ThermodynamicProperties(
+        logZ=logZrel-beta*E0[..., 0],
+        energy=energy_rel+E0[..., 0],
+        heat_capacity=beta*beta*varE,
+        entropy=logZrel+beta*energy_rel,
+    )
+
+    if Mpar is not None:
+        magnetization = np.sum(p*np.asarray(Mpar, dtype=float), axis=-1)
+        properties.magnetization = magnetization
+        if Bvalues is not None:
+            Bvalues = np.broadcast_to(np.asarray(Bvalues, dtype=float), En.shape[:-1])
+            with np.errstate(divide="ignore", invalid="ignore"):
+                properties.chi = np.where(Bvalues != 0., ChiCGS*magnetization/Bvalues, np.nan)
+
+    return properties
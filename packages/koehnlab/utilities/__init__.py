@@ -5,3 +5,4 @@ from .sorting import (
 )
 from .vector_analysis import getMainElementIndices, getMainElements
 from .progressbar import progressbar
+from .files import collectFiles
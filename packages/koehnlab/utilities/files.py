@@ -0,0 +1,22 @@
+from collections.abc import Iterable
+from typing import List
+
+import glob
+import os
+
+
+def collectFiles(paths: Iterable[str], pattern: str | Iterable[str] = "*") -> List[str]:
+    """Expands the given paths into a sorted list of files. Paths may be files, glob patterns or
+    directories. Directories are searched recursively for files whose name matches the given pattern
+    (or any of the given patterns)"""
+    patterns = [pattern] if isinstance(pattern, str) else list(pattern)
+    files: List[str] = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            for current in patterns:
+                files.extend(glob.glob(os.path.join(path, "**", current), recursive=True))
+        else:
+            files.extend(glob.glob(path))
+
+    return sorted(set(f for f in files if os.path.isfile(f)))
@@ -11,10 +11,19 @@ import re
 import io
 
 from koehnlab import finite_differences, utilities, print_utilities
+from koehnlab.molecular import (
+    Molecule,
+    symbolsToAtomicNumbers,
+    findSymmetryOperations,
+    expandCartesianDerivatives,
+)
 
 
 XYZGeom = List[Tuple[str, np.ndarray]]
 
+# Coordinate differences (in angstrom) below this threshold are attributed to rounding in the output files
+displacementTolerance = 1e-6
+
 
 class ExtractedData:
     def __init__(
@@ -175,13 +184,10 @@ def extractData(filePath: str, magneticProcessorPath: str) -> ExtractedData:
 def xyzDiff(reference: XYZGeom, compare: XYZGeom) -> np.ndarray:
     """Computes the difference between the given XYZGeom objects"""
     assert len(reference) == len(compare)
-    diff = np.zeros(shape=(len(reference), 3))
-
-    for atom in range(len(reference)):
-        for coord in range(3):
-            diff[atom][coord] = compare[atom][1][coord] - reference[atom][1][coord]
 
-    return diff
+    return np.array([coord for _, coord in compare], dtype=float) - np.array(
+        [coord for _, coord in reference], dtype=float
+    )
 
 
 def differentiate(
@@ -252,7 +258,7 @@ def calculateDerivatives(
     differences: List[Tuple[int, int, float]] = []
     for currentData in distortedData:
         diff = xyzDiff(equilibriumData.geometry, currentData.geometry)
-        nonZeroEntries = np.argwhere(diff != 0)
+        nonZeroEntries = np.argwhere(np.abs(diff) > displacementTolerance)
         if len(nonZeroEntries) != 1:
             raise RuntimeError(
                 "Expected distorted geometries to be elongated along exactly one coordinate"
@@ -317,6 +323,57 @@ def calculateDerivatives(
     return (gDerivatives, DDerivatives if not len(DDerivatives) == 0 else None)
 
 
+def toMolecule(geometry: XYZGeom) -> Molecule:
+    """Converts the given XYZGeom (with Molpro-style atom labels) into a Molecule"""
+    return Molecule.fromArrays(
+        atomicNumbers=symbolsToAtomicNumbers([label for label, _ in geometry]),
+        coordinates=[coordinates for _, coordinates in geometry],
+    )
+
+
+def symmetrizeDerivatives(
+    derivatives: List[TensorDerivative], geometry: XYZGeom, tolerance: float
+) -> List[TensorDerivative]:
+    """Reconstructs the derivatives for the displacements of atoms that have not been explicitly
+    displaced from the derivatives of symmetry-equivalent atoms of the (equilibrium) geometry"""
+    operations = findSymmetryOperations(toMolecule(geometry), tolerance=tolerance)
+
+    byAtom: Dict[int, np.ndarray] = {}
+    coordinates: Dict[int, List[int]] = {}
+    for current in derivatives:
+        if not current.atomIdx in byAtom:
+            byAtom[current.atomIdx] = np.zeros((3,) + current.derivative.shape)
+            coordinates[current.atomIdx] = []
+        byAtom[current.atomIdx][current.coordinate] = current.derivative
+        coordinates[current.atomIdx].append(current.coordinate)
+
+    for atomIdx in coordinates:
+        if sorted(coordinates[atomIdx]) != [0, 1, 2]:
+            raise RuntimeError(
+                "Atom %d has not been displaced along all three coordinates" % (atomIdx + 1)
+            )
+
+    expanded = expandCartesianDerivatives(byAtom, operations)
+
+    print(
+        "Found %d symmetry operations; reconstructed derivatives for %d atoms"
+        % (len(operations), len(expanded) - len(byAtom))
+    )
+
+    symmetrized: List[TensorDerivative] = []
+    for atomIdx in sorted(expanded.keys()):
+        for coordinate in range(3):
+            symmetrized.append(
+                TensorDerivative(
+                    atomIdx=atomIdx,
+                    coordinate=coordinate,
+                    derivative=expanded[atomIdx][coordinate],
+                )
+            )
+
+    return symmetrized
+
+
 def transformToBasis(
     derivatives: List[TensorDerivative], basis: np.ndarray
 ) -> List[TensorDerivative]:
@@ -416,6 +473,21 @@ def main() -> None:
         default=".",
     )
 
+    parser.add_argument(
+        "--use-symmetry",
+        help="Only require calculations for the displacements of symmetry-unique atoms and reconstruct the "
+        + "derivatives for the remaining atoms from the point-group symmetry of the equilibrium structure",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--symmetry-tolerance",
+        help="Tolerance (in angstrom) for considering atom positions as symmetry-equivalent",
+        metavar="VALUE",
+        type=float,
+        default=1e-2,
+    )
+
     args = parser.parse_args()
 
     # Check magneticProcessor is accessible
@@ -474,6 +546,15 @@ def main() -> None:
         equilibriumData, distortedData
     )
 
+    if args.use_symmetry:
+        gTensorDerivatives = symmetrizeDerivatives(
+            gTensorDerivatives, equilibriumData.geometry, args.symmetry_tolerance
+        )
+        if not DTensorDerivatives is None:
+            DTensorDerivatives = symmetrizeDerivatives(
+                DTensorDerivatives, equilibriumData.geometry, args.symmetry_tolerance
+            )
+
     laboratoryToMainAxes = np.linalg.inv(equilibriumData.magneticMainAxes)
 
     # Write out the calculated derivates and also the ones transformed into the system of magnetic main axes (of the equilibrium geometry)
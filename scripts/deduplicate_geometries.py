@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+
+from koehnlab.molecular import readMolecule, guessFileFormat, findDuplicateGeometries
+from koehnlab.utilities import collectFiles
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find identical (up to translation, rotation and optionally atom ordering) geometries "
+        + "in a set of geometry files such that calculations only have to be performed once per geometry"
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        metavar="PATH",
+        help="Geometry files, directories or glob patterns",
+    )
+    parser.add_argument(
+        "--pattern",
+        nargs="+",
+        default=["coord", "*.xyz", "*.xyz.gz", "*.h5", "*.hdf5"],
+        metavar="GLOB",
+        help="File name patterns used when searching directories",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1e-3,
+        metavar="VALUE",
+        help="Resolution (in angstrom) of the interatomic distances compared between geometries",
+    )
+    parser.add_argument(
+        "--permutation-invariant",
+        action="store_true",
+        default=False,
+        help="Also consider geometries as identical if they only differ in the order of the atoms",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        default="duplicates",
+        metavar="PATH",
+        help="Path of the file to which the mapping of duplicates to their original geometries is written",
+    )
+
+    args = parser.parse_args()
+
+    files = []
+    molecules = []
+    for path in collectFiles(args.inputs, args.pattern):
+        try:
+            molecules.append(readMolecule(path, guessFileFormat(path)))
+        except (RuntimeError, OSError, ValueError) as e:
+            print("Warning: skipping '%s': %s" % (path, e), file=sys.stderr)
+            continue
+        files.append(path)
+
+    original = findDuplicateGeometries(
+        molecules, tolerance=args.tolerance, permutationInvariant=args.permutation_invariant
+    )
+
+    with open(args.output, "w") as outputFile:
+        outputFile.write("# duplicate geometry, original geometry\n")
+        for idx, path in enumerate(files):
+            if original[idx] != idx:
+                outputFile.write("%s %s\n" % (path, files[original[idx]]))
+
+    nUnique = len(set(original))
+    print("%d of %d geometries are unique" % (nUnique, len(files)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from typing import List
+from typing import List, Optional, Tuple
 from numpy.typing import NDArray
 
 import argparse
@@ -10,6 +10,15 @@ from ase.io.turbomole import write_turbomole
 
 import numpy as np
 
+from koehnlab.molecular import (
+    Molecule,
+    SymmetryOperation,
+    symbolsToAtomicNumbers,
+    findSymmetryOperations,
+    UniqueDisplacements,
+    writeDisplacementEquivalences,
+)
+
 # Hartree in cm^-1   Eh/(h*c*100)
 Eh_rcm = 219474.631330
 # atomic mass units in multiples of electron masses
@@ -92,6 +101,33 @@ def reweight(Lmat,masses,freqs):
 
     return Lmat
 
+class DisplacementWriter:
+    """Writes displaced geometries in turbomole format. If symmetry operations are given, displacements
+    that are symmetry images of an already written one are skipped and only recorded"""
+
+    def __init__(self, coordinates, atom_names, operations: Optional[List[SymmetryOperation]] = None, tolerance: float = 1e-4):
+        self.coordinates = coordinates
+        self.atom_names = atom_names
+        self.unique = None if operations is None else UniqueDisplacements(operations, tolerance)
+        self.written_names: List[str] = []
+        self.equivalences: List[Tuple[str, str, NDArray]] = []
+
+    def write(self, file_name: str, displacement) -> None:
+        if self.unique is not None:
+            equivalent = self.unique.add(displacement)
+            if equivalent is not None:
+                self.equivalences.append((file_name, self.written_names[equivalent[0]], self.unique.operations[equivalent[1]].matrix))
+                return
+            self.written_names.append(file_name)
+
+        with open(file_name,'w') as outfile:
+            # ase expects angstrom units :/
+            write_turbomole(outfile,Atoms(symbols=self.atom_names,positions=(self.coordinates+displacement)*bohr_ang))
+
+    def write_equivalences(self, file_name: str) -> None:
+        writeDisplacementEquivalences(file_name, self.equivalences)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Generate a grid of unit normal mode displacements "
@@ -132,6 +168,30 @@ def main():
         metavar="VALUE",
         help="maximum wavenumber of considered vibrations",
     )
+    parser.add_argument(
+        "--symmetry-unique",
+        action="store_true",
+        default=False,
+        help="only write displaced geometries that are not symmetry-equivalent to already written ones; the skipped "
+        + "ones are listed in <output-file>_equivalences together with the operation R mapping the equivalent written "
+        + "geometry onto them. Tensor properties of the skipped geometries are T = R T(written) R^T, see "
+        + "koehnlab.molecular.readDisplacementEquivalences and expandDisplacementProperties",
+    )
+    parser.add_argument(
+        "--symmetry-tolerance",
+        type=float,
+        default=1e-2,
+        metavar="VALUE",
+        help="tolerance (in bohr) for detecting symmetry",
+    )
+    parser.add_argument(
+        "--displacement-tolerance",
+        type=float,
+        default=1e-4,
+        metavar="VALUE",
+        help="resolution (in bohr) below which displacements are considered symmetry-equivalent; has to be well "
+        + "below the difference of distinct displacements",
+    )
     parser.add_argument("--output-file", default="coord", metavar="PATH", help="Path to where the result shall be written")
 
     args = parser.parse_args()
@@ -161,11 +221,18 @@ def main():
 
     Lmat = reweight(Lmat,masses,frequencies)
 
+    operations = None
+    sym_tol = args.symmetry_tolerance
+    if args.symmetry_unique:
+        reference = Molecule.fromArrays(symbolsToAtomicNumbers(atom_names), coordinates)
+        operations = findSymmetryOperations(reference, tolerance=sym_tol)
+        print(f"Found {len(operations)} symmetry operations")
+
+    writer = DisplacementWriter(coordinates, atom_names, operations, args.displacement_tolerance)
+
     # write out reference coordinates
     file_name = output_file+"_0"
-    with open(file_name,'w') as outfile:
-        # ase expects angstrom units :/
-        write_turbomole(outfile,Atoms(symbols=atom_names,positions=coordinates*bohr_ang))
+    writer.write(file_name, np.zeros_like(coordinates))
 
     
     for idx in range(3 * nAtoms):
@@ -178,15 +245,14 @@ def main():
             if dsp == 0:
                 continue
 
-            coord_dist = coordinates + float(dsp)*inc*Lmat[:,idx].reshape((nAtoms,3))
+            dist = float(dsp)*inc*Lmat[:,idx].reshape((nAtoms,3))
 
             if dsp > 0:
                 dsp_str = f"p{dsp:1d}" 
             else:
                 dsp_str = f"m{-dsp:1d}"
             file_name = output_file+f"_1_{idx+1:0>3d}_"+dsp_str
-            with open(file_name,'w') as outfile:
-                write_turbomole(outfile,Atoms(symbols=atom_names,positions=coord_dist*bohr_ang))
+            writer.write(file_name, dist)
  
             if order < 2:
                 continue
@@ -201,15 +267,18 @@ def main():
                     if dsp2 == 0:
                         continue
 
-                    coord_dist2 = coord_dist + float(dsp2)*inc*Lmat[:,jdx].reshape((nAtoms,3))
+                    dist2 = dist + float(dsp2)*inc*Lmat[:,jdx].reshape((nAtoms,3))
 
                     if dsp2 > 0:
                         dsp2_str = f"p{dsp2:1d}"
                     else:
                         dsp2_str = f"m{-dsp2:1d}"
                     file_name = output_file+f"_2_{idx+1:0>3d}_{jdx+1:0>3d}_"+dsp_str+"_"+dsp2_str
-                    with open(file_name,'w') as outfile:
-                        write_turbomole(outfile,Atoms(symbols=atom_names,positions=coord_dist2*bohr_ang))
+                    writer.write(file_name, dist2)
+
+    if operations is not None:
+        writer.write_equivalences(output_file+"_equivalences")
+        print(f"Skipped {len(writer.equivalences)} symmetry-equivalent displacements")
 
 
 if __name__ == "__main__":
@@ -1,49 +1,265 @@
 #!/usr/bin/env python3
 
-from koehnlab.molecular import readMolecule, writeMolecule, Molecule
+from typing import Iterator, List, Optional
+
+from koehnlab.molecular import (
+    readMolecule,
+    writeMolecule,
+    writeTrajectory,
+    guessFileFormat,
+    Molecule,
+    FileFormat,
+    GeometryArchive,
+    Eckart_alignment,
+)
+from koehnlab.utilities import collectFiles
+
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from functools import partial
 
 import argparse
+import os
+import sys
+
+
+file_extensions = {
+    FileFormat.XYZ: ".xyz",
+    FileFormat.HDF5: ".h5",
+    FileFormat.TURBOMOLE: "",
+}
+
+# Number of molecules that are written to a geometry archive at once
+archive_chunk_size = 256
 
 
 def action_orient(molecule: Molecule) -> None:
     molecule.bringToStandardOrientation()
 
 
+def action_center(molecule: Molecule) -> None:
+    molecule.translate(-molecule.centerOfMass())
+
+
+def action_eckart(molecule: Molecule, reference: Optional[Molecule]) -> None:
+    if reference is None:
+        raise RuntimeError("The eckart action requires a reference geometry (--reference)")
+    # Eckart_alignment temporarily moves the reference, so work on a copy
+    Eckart_alignment(deepcopy(reference), molecule)
+
+
+def process(path: str, actions: List[str], reference: Optional[Molecule]) -> Optional[Molecule]:
+    """Reads the molecule at the given path and applies all actions in order. Files that can't be read
+    are reported and skipped (None is returned)"""
+    try:
+        molecule: Molecule = readMolecule(path, guessFileFormat(path))
+    except (RuntimeError, OSError, ValueError) as e:
+        print("Warning: skipping '%s': %s" % (path, e), file=sys.stderr)
+        return None
+
+    for action in actions:
+        if action == "orient":
+            action_orient(molecule)
+        elif action == "center":
+            action_center(molecule)
+        elif action == "eckart":
+            action_eckart(molecule, reference)
+        else:
+            raise RuntimeError("Action '%s' not implemented" % action)
+
+    return molecule
+
+
+def process_to_file(
+    path: str,
+    output_path: str,
+    actions: List[str],
+    reference: Optional[Molecule],
+    output_format: Optional[FileFormat],
+) -> bool:
+    """Processes the molecule at the given path (see process) and writes the result to output_path.
+    Returns whether the file could be read"""
+    molecule = process(path, actions, reference)
+    if molecule is None:
+        return False
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    fmt = output_format if output_format is not None else guessFileFormat(path)
+    writeMolecule(molecule, output_path, fmt)
+
+    return True
+
+
+def output_paths(files: List[str], output_dir: str, output_format: Optional[FileFormat]) -> List[str]:
+    """Maps the input files onto paths in the output directory. The paths relative to the common directory
+    of all inputs are kept, such that e.g. job1/coord and job2/coord don't overwrite each other"""
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in files])
+
+    paths = []
+    for path in files:
+        name = os.path.relpath(os.path.abspath(path), root)
+        for extension in [".gz", ".xyz", ".h5", ".hdf5"]:
+            name = name.removesuffix(extension)
+        fmt = output_format if output_format is not None else guessFileFormat(path)
+        paths.append(os.path.join(output_dir, name + file_extensions[fmt]))
+
+    # Inputs only differing in their extension may still end up with the same name
+    seen = {}
+    for path, output_path in zip(files, paths):
+        if output_path in seen:
+            raise RuntimeError(
+                "'%s' and '%s' would both be written to '%s'" % (seen[output_path], path, output_path)
+            )
+        seen[output_path] = path
+
+    return paths
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(
-        description="Helper script to process molecules in different ways"
+        description="Helper script to process molecules in different ways. Processes either a single file "
+        + "or, in batch mode, all given files, directories and globs in parallel"
     )
     parser.add_argument(
         "--input",
         "-i",
-        help="Path to the input file containing the molecule's geometry",
+        help="Path to the input file containing the molecule's geometry. Multiple paths, directories and "
+        + "glob patterns are accepted as well",
         metavar="PATH",
+        nargs="+",
         required=True,
     )
+    parser.add_argument(
+        "--pattern",
+        nargs="+",
+        help="File name patterns used when searching input directories",
+        metavar="GLOB",
+        default=["coord", "*.xyz", "*.xyz.gz", "*.h5", "*.hdf5"],
+    )
     parser.add_argument(
         "--output",
         "-o",
-        help="Path to which the processed molecule shall be written",
+        help="Path to which the processed molecule shall be written (single input only)",
         metavar="PATH",
-        default=True,
+        default=None,
+    )
+    parser.add_argument(
+        "--output-dir",
+        help="Directory into which the processed molecules shall be written as individual files",
+        metavar="PATH",
+        default=None,
+    )
+    parser.add_argument(
+        "--archive",
+        help="Write all processed molecules into a single file instead (geometry archive if the path ends "
+        + "in .h5/.hdf5, multi-frame XYZ file otherwise)",
+        metavar="PATH",
+        default=None,
+    )
+    parser.add_argument(
+        "--output-format",
+        help="Format of the written files (default: same as input)",
+        choices=["xyz", "turbomole", "hdf5"],
+        default=None,
     )
     parser.add_argument(
         "--action",
-        help="The action to perform on the molecule",
-        choices=["orient"],
-        required=True,
+        help="The action to perform on the molecule. Can be given multiple times to apply a pipeline of actions",
+        choices=["orient", "center", "eckart"],
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--reference",
+        help="Path to the reference geometry for the eckart action",
+        metavar="PATH",
+        default=None,
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        help="Number of worker processes",
+        metavar="N",
+        type=int,
+        default=os.cpu_count(),
     )
 
     args = parser.parse_args()
 
-    molecule: Molecule = readMolecule(args.input)
+    files = collectFiles(args.input, args.pattern)
+    if len(files) == 0:
+        raise RuntimeError("No input files found")
+
+    reference = (
+        readMolecule(args.reference, guessFileFormat(args.reference)) if args.reference else None
+    )
+    output_format = FileFormat[args.output_format.upper()] if args.output_format else None
+
+    if args.output is not None:
+        if len(files) != 1:
+            raise RuntimeError("--output can only be used with a single input file")
+        molecule = process(files[0], args.action, reference)
+        if molecule is None:
+            raise RuntimeError("Could not read '%s'" % files[0])
+        writeMolecule(
+            molecule,
+            args.output,
+            output_format if output_format is not None else guessFileFormat(args.output),
+        )
+        return
+
+    if (args.output_dir is None) == (args.archive is None):
+        raise RuntimeError("Exactly one of --output, --output-dir and --archive has to be given")
+
+    # Use chunks to amortize the inter-process communication over several files
+    chunksize = max(1, len(files) // (4 * max(1, args.jobs)))
+
+    if args.output_dir is not None:
+        worker = partial(
+            process_to_file, actions=args.action, reference=reference, output_format=output_format
+        )
+        paths = output_paths(files, args.output_dir, output_format)
+
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            nProcessed = sum(executor.map(worker, files, paths, chunksize=chunksize))
+
+        print("Processed %d of %d files" % (nProcessed, len(files)))
+        return
+
+    nProcessed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        results = executor.map(
+            partial(process, actions=args.action, reference=reference), files, chunksize=chunksize
+        )
+        # unreadable files are skipped; the remaining molecules keep their input path as label
+        processed = ((path, molecule) for path, molecule in zip(files, results) if molecule is not None)
+
+        if guessFileFormat(args.archive) == FileFormat.HDF5:
+            with GeometryArchive(args.archive, "w") as archive:
+                pending: List[Molecule] = []
+                labels: List[str] = []
+                for path, molecule in processed:
+                    pending.append(molecule)
+                    labels.append(path)
+                    if len(pending) == archive_chunk_size:
+                        archive.extend(pending, labels=labels)
+                        pending.clear()
+                        labels.clear()
+                archive.extend(pending, labels=labels)
+                nProcessed = len(archive)
+        else:
+            # results is consumed lazily, so frames are written as they become available
+            written: List[str] = []
+
+            def frames() -> Iterator[Molecule]:
+                for path, molecule in processed:
+                    written.append(path)
+                    yield molecule
 
-    if args.action == "orient":
-        action_orient(molecule)
-    else:
-        raise RuntimeError("Action '%s' not implemented" % args.action)
+            writeTrajectory(frames(), args.archive, FileFormat.XYZ)
+            nProcessed = len(written)
 
-    writeMolecule(molecule, args.output)
+    print("Processed %d of %d files" % (nProcessed, len(files)))
 
 
 if __name__ == "__main__":
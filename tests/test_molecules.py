@@ -2,8 +2,14 @@
 
 import unittest
 import os
+import tempfile
 
-from koehnlab.molecular import Molecule, readMolecule, writeMolecule, Eckart_alignment, check_Eckart
+from koehnlab.molecular import Atom, Element, Molecule, GeometryArchive, readMolecule, writeMolecule, symbolsToAtomicNumbers, ElementMassTable, ElementGroupTable, ElementBlockTable, BlockCodes, Eckart_alignment, check_Eckart
+
+from koehnlab.molecular import internalCoordinates, internalCoordinateIndices, wilsonBMatrix
+from koehnlab.molecular import distanceMatrix, rmsd, maxDeviation, pairwiseRMSD, pairwiseMaxDeviation, sameGeometry
+from koehnlab.molecular import findDuplicateGeometries, findSymmetryOperations, symmetryUniqueAtoms, expandCartesianDerivatives, findEquivalentDisplacement
+from koehnlab.molecular import UniqueDisplacements, writeDisplacementEquivalences, readDisplacementEquivalences, expandDisplacementProperties
 
 import numpy as np
 from numpy.testing import assert_almost_equal
@@ -42,5 +48,287 @@ class TestMolecules(unittest.TestCase):
         assert_almost_equal(eckR,np.zeros((3)))
 
 
+    def test_read_write(self):
+
+        mol_A = readMolecule(os.path.join(data_dir, "biphenyl_planar.xyz"))
+
+        self.assertEqual(mol_A.nAtoms(), 22)
+        self.assertEqual(list(mol_A.atomicNumbers()[:2]), [6, 6])
+        self.assertEqual(mol_A.atoms[0].element, Element.C)
+        assert_almost_equal(mol_A.atoms[1].coordinates, [-2.8130972, -3.6879067, 0.1862528])
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            path = os.path.join(tmpDir, "biphenyl.xyz.gz")
+            writeMolecule(mol_A, path)
+            mol_B = readMolecule(path)
+
+        self.assertEqual(list(mol_A.atomicNumbers()), list(mol_B.atomicNumbers()))
+        assert_almost_equal(mol_A.coordinates(), mol_B.coordinates())
+
+
+    def test_atom_list(self):
+
+        mol = Molecule([Atom(Element.O, [0., 0., 0.]), Atom(Element.H, [0.96, 0., 0.])])
+
+        # changes through the atoms view are written back into the molecule
+        mol.atoms.append(Atom(Element.H, [-0.24, 0.93, 0.]))
+        self.assertEqual(len(mol.bonds()), 2)
+        mol.atoms[1].coordinates = np.array([5., 0., 0.])
+        mol.atoms[0].element = Element.S
+
+        self.assertEqual(mol.nAtoms(), 3)
+        self.assertEqual(list(mol.atomicNumbers()), [16, 1, 1])
+        assert_almost_equal(mol.coordinates()[1], [5., 0., 0.])
+        # the cached connectivity has been discarded
+        self.assertEqual(len(mol.bonds()), 1)
+
+        del mol.atoms[0]
+        mol.atoms.insert(0, Atom(Element.O, [0., 0., 0.]))
+        self.assertEqual([atom.element for atom in mol.atoms], [Element.O, Element.H, Element.H])
+        with self.assertRaises(IndexError):
+            mol.atoms[3]
+
+
+    def test_geometry_archive(self):
+
+        mol_A = readMolecule(os.path.join(data_dir, "biphenyl_aligned.xyz"))
+        mol_B = readMolecule(os.path.join(data_dir, "biphenyl_planar.xyz"))
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            path = os.path.join(tmpDir, "archive.h5")
+
+            with GeometryArchive(path, "w") as archive:
+                archive.append(mol_A, energy=-1.5, label="aligned")
+
+            # append-only writes to an existing archive
+            with GeometryArchive(path, "a") as archive:
+                archive.extend([mol_B, mol_A], labels=["planar", "again"])
+
+            with GeometryArchive(path) as archive:
+                self.assertEqual(len(archive), 3)
+                assert_almost_equal(archive[1].coordinates(), mol_B.coordinates())
+                assert_almost_equal(archive[-1].coordinates(), mol_A.coordinates())
+                self.assertEqual(list(archive[0].atomicNumbers()), list(mol_A.atomicNumbers()))
+                self.assertEqual(archive.energy(0), -1.5)
+                self.assertIsNone(archive.energy(1))
+                self.assertEqual(archive.labels(), ["aligned", "planar", "again"])
+
+            # an extend interrupted after resizing some of the datasets leaves orphaned rows
+            with GeometryArchive(path, "a") as archive:
+                archive.file["coordinates"].resize(archive.file["coordinates"].shape[0] + 5, axis=0)  # type: ignore
+                archive.file["energies"].resize(4, axis=0)  # type: ignore
+
+            with GeometryArchive(path, "a") as archive:
+                archive.append(mol_B, energy=-2.5, label="planar again")
+
+            with GeometryArchive(path) as archive:
+                self.assertEqual(len(archive), 4)
+                assert_almost_equal(archive[3].coordinates(), mol_B.coordinates())
+                self.assertEqual(archive.energy(3), -2.5)
+                self.assertEqual(archive.labels(), ["aligned", "planar", "again", "planar again"])
+
+
+    def test_element_tables(self):
+
+        Z = symbolsToAtomicNumbers(["C12", "fe1", "CARBON", "H", "Gd_3"])
+
+        self.assertEqual(list(Z), [6, 26, 6, 1, 64])
+        assert_almost_equal(ElementMassTable[Z], [Element(x).mass() for x in Z])
+        self.assertEqual(list(ElementGroupTable[Z]), [14, 8, 14, 1, 0])
+        self.assertEqual([BlockCodes[b] for b in ElementBlockTable[Z]], ["p", "d", "p", "s", "f"])
+
+        with self.assertRaises(KeyError):
+            symbolsToAtomicNumbers(["Xx1"])
+
+
+    def test_connectivity(self):
+
+        mol_A = readMolecule(os.path.join(data_dir, "biphenyl_planar.xyz"))
+
+        # 13 C-C and 10 C-H bonds
+        self.assertEqual(len(mol_A.bonds()), 23)
+        self.assertEqual(mol_A.connectivity().nnz, 46)
+        self.assertEqual(len(set(mol_A.fragments())), 1)
+
+        # rigid rotations keep the cached graph
+        graph = mol_A.connectivity()
+        mol_A.bringToStandardOrientation()
+        self.assertIs(mol_A.connectivity(), graph)
+
+        # pulling the molecule apart invalidates it
+        mol_A.setCoordinates(mol_A.coordinates() * 10)
+        self.assertEqual(len(mol_A.bonds()), 0)
+        self.assertEqual(len(set(mol_A.fragments())), 22)
+
+
+    def test_internal_coordinates(self):
+
+        mol_A = readMolecule(os.path.join(data_dir, "biphenyl_unaligned.xyz"))
+        mol_B = readMolecule(os.path.join(data_dir, "biphenyl_planar.xyz"))
+
+        bonds, angles, dihedrals = internalCoordinateIndices(mol_A)
+        self.assertEqual(bonds.shape, (23, 2))
+        self.assertEqual(angles.shape, (36, 3))
+        self.assertEqual(dihedrals.shape, (52, 4))
+
+        stack = np.stack((mol_A.coordinates(), mol_B.coordinates()))
+
+        q = internalCoordinates(stack, bonds, angles, dihedrals)
+        B = wilsonBMatrix(stack, bonds, angles, dihedrals)
+        self.assertEqual(q.shape, (2, 111))
+        self.assertEqual(B.shape, (2, 111, 66))
+
+        # all bond angles in biphenyl are close to 120 degrees
+        self.assertTrue(np.all(np.abs(np.degrees(q[:, 23:59]) - 120) < 5))
+
+        # compare against finite differences
+        h = 1e-5
+        numB = np.zeros((2, 111, 66))
+        for i in range(66):
+            delta = np.zeros(66)
+            delta[i] = h
+            delta = delta.reshape((22, 3))
+            dq = internalCoordinates(stack + delta, bonds, angles, dihedrals) - internalCoordinates(stack - delta, bonds, angles, dihedrals)
+            numB[:, :, i] = ((dq + np.pi) % (2 * np.pi) - np.pi) / (2 * h)
+
+        assert_almost_equal(B, numB, decimal=6)
+
+
+    def test_symmetry(self):
+
+        # D2h and D2 structures of biphenyl
+        mol_A = readMolecule(os.path.join(data_dir, "biphenyl_planar_ec.xyz"))
+        mol_B = readMolecule(os.path.join(data_dir, "biphenyl_aligned.xyz"))
+
+        operations = findSymmetryOperations(mol_A)
+        self.assertEqual(len(findSymmetryOperations(mol_B)), 4)
+        self.assertEqual(len(operations), 8)
+
+        representatives, _ = symmetryUniqueAtoms(operations)
+        self.assertEqual(len(representatives), 7)
+
+        # linear molecules: D2h subgroup of D_inf_h for CO2, C2v subgroup of C_inf_v for CO
+        co2 = Molecule.fromArrays([8, 6, 8], [[0.3, 0.2, -1.16], [0.3, 0.2, 0.0], [0.3, 0.2, 1.16]])
+        co2Operations = findSymmetryOperations(co2)
+        self.assertEqual(len(co2Operations), 8)
+        self.assertEqual(len(symmetryUniqueAtoms(co2Operations)[0]), 2)
+        self.assertEqual(len(findSymmetryOperations(Molecule.fromArrays([6, 8], [[0, 0, 0], [1, 1, 0.5]]))), 4)
+
+        # T = sum_i r_i r_i^T (relative to the center of mass) transforms as a rank-2 tensor and
+        # dT/dx_{k,c} = e_c r_k^T + r_k e_c^T
+        coordinates = mol_A.coordinates() - mol_A.centerOfMass()
+        identity = np.identity(3)
+        derivatives = {
+            k: np.array([np.outer(identity[c], coordinates[k]) + np.outer(coordinates[k], identity[c]) for c in range(3)])
+            for k in range(mol_A.nAtoms())
+        }
+
+        expanded = expandCartesianDerivatives({k: derivatives[k] for k in representatives}, operations)
+
+        self.assertEqual(len(expanded), mol_A.nAtoms())
+        for k in range(mol_A.nAtoms()):
+            assert_almost_equal(expanded[k], derivatives[k], decimal=2)
+
+        # displacing all atoms along x and -x is equivalent
+        displacement = np.zeros((mol_A.nAtoms(), 3))
+        displacement[:, 0] = 0.1
+        self.assertIsNotNone(findEquivalentDisplacement(-displacement, [displacement], operations))
+        displacement[0, 0] = 0.2
+        self.assertIsNone(findEquivalentDisplacement(-displacement, [displacement], operations))
+
+        # canonical keys: all images of a displacement are recognized
+        rng = np.random.default_rng(3)
+        unique = UniqueDisplacements(operations, 1e-6)
+        reference = rng.normal(scale=0.1, size=(mol_A.nAtoms(), 3))
+        self.assertIsNone(unique.add(reference))
+        self.assertIsNone(unique.add(2 * reference))
+        for op in operations:
+            image = op.transformDisplacement(reference)
+            equivalent = unique.add(image)
+            assert equivalent is not None
+            self.assertEqual(equivalent[0], 0)
+            assert_almost_equal(operations[equivalent[1]].transformDisplacement(reference), image)
+        self.assertEqual(len(unique.displacements), 2)
+
+        # skipped displacements are rebuilt from the equivalences file
+        tensor = rng.normal(size=(3, 3))
+        equivalences = [("coord_2", "coord_1", operations[1].matrix)]
+        with tempfile.TemporaryDirectory() as tmpDir:
+            path = os.path.join(tmpDir, "coord_equivalences")
+            writeDisplacementEquivalences(path, equivalences)
+            equivalences = readDisplacementEquivalences(path)
+        expanded = expandDisplacementProperties({"coord_1": tensor}, equivalences)
+        assert_almost_equal(expanded["coord_2"], operations[1].matrix @ tensor @ operations[1].matrix.T)
+
+
+    def test_fingerprint(self):
+
+        mol_A = readMolecule(os.path.join(data_dir, "biphenyl_unaligned.xyz"))
+        mol_B = readMolecule(os.path.join(data_dir, "biphenyl_unaligned.xyz"))
+        mol_B.bringToStandardOrientation()
+
+        order = np.arange(22)[::-1]
+        mol_C = Molecule.fromArrays(mol_A.atomicNumbers()[order], mol_A.coordinates()[order])
+        mol_D = readMolecule(os.path.join(data_dir, "biphenyl_planar.xyz"))
+
+        self.assertEqual(mol_A.fingerprint(), mol_B.fingerprint())
+        self.assertNotEqual(mol_A.fingerprint(), mol_C.fingerprint())
+        self.assertEqual(mol_A.fingerprint(permutationInvariant=True), mol_C.fingerprint(permutationInvariant=True))
+        self.assertNotEqual(mol_A.fingerprint(), mol_D.fingerprint())
+
+        self.assertEqual(list(findDuplicateGeometries([mol_D, mol_A, mol_B, mol_C])), [0, 1, 1, 3])
+        self.assertEqual(list(findDuplicateGeometries([mol_D, mol_A, mol_B, mol_C], permutationInvariant=True)), [0, 1, 1, 1])
+
+        # geometries on both sides of a rounding boundary of the fingerprint are still duplicates
+        mol_E = Molecule.fromArrays([8, 8], [[0., 0., 0.], [0., 0., 1.2085 - 1e-6]])
+        mol_F = Molecule.fromArrays([8, 8], [[0., 0., 0.], [0., 0., 1.2085 + 1e-6]])
+        self.assertNotEqual(mol_E.fingerprint(), mol_F.fingerprint())
+        self.assertEqual(list(findDuplicateGeometries([mol_E, mol_F])), [0, 0])
+
+    def test_comparison(self):
+        import koehnlab.molecular.Comparison as Comparison
+
+        mol_A = readMolecule(os.path.join(data_dir, "biphenyl_unaligned.xyz"))
+        coords = mol_A.coordinates()
+
+        angle = 0.7
+        rotation = np.array([[np.cos(angle), -np.sin(angle), 0], [np.sin(angle), np.cos(angle), 0], [0, 0, 1]])
+        mol_B = Molecule.fromArrays(mol_A.atomicNumbers(), np.matmul(coords, rotation.T) + [1.0, -2.0, 0.5])
+        ref_dist = np.linalg.norm(coords[:, np.newaxis] - coords[np.newaxis], axis=-1)
+
+        rng = np.random.default_rng(42)
+        frames = coords[np.newaxis] + 0.05 * rng.standard_normal((7, 22, 3))
+
+        # Force tiny chunks to exercise the chunked code paths (down to blocks of single elements)
+        defaultChunk = Comparison.maxChunkElements
+        try:
+            for maxChunkElements in [100, 1]:
+                Comparison.maxChunkElements = maxChunkElements
+                assert_almost_equal(distanceMatrix(mol_A), ref_dist)
+                self.assertEqual(distanceMatrix(frames).shape, (7, 22, 22))
+                assert_almost_equal(distanceMatrix(frames)[3], distanceMatrix(frames[3]))
+
+                ref_rmsd = np.array([[rmsd(f, g) for g in frames] for f in frames])
+                assert_almost_equal(pairwiseRMSD(frames), ref_rmsd)
+                ref_rmsd = np.array([[rmsd(f, g, align=True) for g in frames] for f in frames])
+                assert_almost_equal(pairwiseRMSD(frames, align=True), ref_rmsd)
+
+                ref_max = np.array([[maxDeviation(f, g) for g in frames] for f in frames])
+                assert_almost_equal(pairwiseMaxDeviation(frames), ref_max)
+        finally:
+            Comparison.maxChunkElements = defaultChunk
+
+        self.assertGreater(rmsd(mol_A, mol_B), 0.1)
+        self.assertAlmostEqual(float(rmsd(mol_A, mol_B, align=True)), 0.0)
+        self.assertAlmostEqual(float(rmsd(mol_A, mol_B, masses=mol_A.masses(), align=True)), 0.0)
+        self.assertEqual(rmsd(frames, coords).shape, (7,))
+
+        self.assertTrue(sameGeometry(mol_A, coords + 1e-8))
+        shifted = coords.copy()
+        shifted[5, 1] += 0.1
+        self.assertFalse(sameGeometry(mol_A, shifted))
+        self.assertAlmostEqual(float(maxDeviation(mol_A, shifted)), 0.1)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -4,9 +4,15 @@ import unittest
 from koehnlab.spin_hamiltonians.spin_utils import diagonalizeSpinHamiltonian
 
 import numpy as np
-from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_almost_equal, assert_array_almost_equal
 
-from koehnlab.spin_hamiltonians import spinMat, tprod, diagonalizeSpinHamiltonian
+from koehnlab.spin_hamiltonians import spinMat, tprod, diagonalizeSpinHamiltonian, diagonalizeFieldSweep, fieldSweepLevels, SpinSystem, Spin
+from koehnlab.spin_hamiltonians import orientation_grid, powder_magnetization, muBcm, kBcm, getChiVV, getBoltzmannFactors, ChiVVCGS
+from koehnlab.spin_hamiltonians import spinOperators, spinLadderOperators, spinSquared, spinQuadraticOperators
+from koehnlab.spin_hamiltonians import getMagneticAxes, getMagneticAxesBatched, gerlochMcMeekingTensor, kramersDoubletMoments, compute_A_matrix
+from koehnlab.spin_hamiltonians import broaden_sticks, line_shape, diagonalizeLowField
+from koehnlab.spin_hamiltonians import adaptive_field_sweep, adaptive_orientation_sweep, thermodynamics, ChiCGS
+from koehnlab.spin_hamiltonians.phys_const import ge
 
 
 class TestSpinHamiltonians(unittest.TestCase):
@@ -50,6 +56,30 @@ class TestSpinHamiltonians(unittest.TestCase):
         )
         assert_array_almost_equal(spinMat(3 / 2, "X"), spinMat(3 / 2, "x"))
 
+    def test_spinOperators(self):
+        for S in [0.5, 1.0, 2.5, 4.0]:
+            ops = spinOperators(S)
+            # operators are cached and must not be modified
+            self.assertIs(ops, spinOperators(S))
+            with self.assertRaises(ValueError):
+                ops[0, 0, 0] = 1.0
+
+            for cmp, label in enumerate(["x", "y", "z"]):
+                assert_array_almost_equal(ops[cmp], spinMat(S, label))
+
+            assert_array_almost_equal(
+                np.matmul(ops[0], ops[1]) - np.matmul(ops[1], ops[0]), 1j * ops[2]
+            )
+            assert_array_almost_equal(np.sum(np.matmul(ops, ops), axis=0), spinSquared(S))
+
+            ladder = spinLadderOperators(S)
+            assert_array_almost_equal(ladder[0], ops[0] + 1j * ops[1])
+            assert_array_almost_equal(ladder[1], ops[0] - 1j * ops[1])
+
+            quadratic = spinQuadraticOperators(S)
+            assert_array_almost_equal(quadratic[0, 2], np.matmul(ops[0], ops[2]) + np.matmul(ops[2], ops[0]))
+            assert_array_almost_equal(quadratic[1, 1], 2 * np.matmul(ops[1], ops[1]))
+
     def test_tprod(self):
         A = np.array([[0.0, -1.0], [1.0, 2.0]])
         B = B = np.diag([1.0, 2.0, 3.0])
@@ -123,6 +153,257 @@ class TestSpinHamiltonians(unittest.TestCase):
             ev2, np.array([-255.80378613, -241.91164761, -28.42353524, -23.86103102])
         )
 
+    def test_diagonalizeFieldSweep(self):
+        sys = SpinSystem()
+        for idx in range(2):
+            sp = Spin(1.5)
+            sp.set_ZF(ZFaxial=5.0, ZFrhombic=1.0)
+            sys.add(str(idx), sp)
+        sys.set_interaction("0", "1", 3.0)
+        Hmat = sys.get_H_mat()
+        Mmat = sys.get_M_mat()
+
+        # includes zero field to test the treatment of degenerate levels
+        Bvalues = np.array([0.0, 0.5, 2.0])
+        Bdirections = np.array([[0.0, 0.0, 2.0], [1.0, 1.0, 0.0], [0.3, -0.2, 1.0]])
+
+        En, Mu, U = diagonalizeFieldSweep(Hmat, Mmat, Bvalues, Bdirections, chunkSize=4)
+        self.assertEqual(En.shape, (3, 3, 16))
+        self.assertEqual(Mu.shape, (3, 3, 3, 16))
+        self.assertEqual(U.shape, (3, 3, 16, 16))
+
+        for io, direction in enumerate(Bdirections):
+            for ib, B in enumerate(Bvalues):
+                Bfield = B * direction / np.linalg.norm(direction)
+                Eref, Uref = diagonalizeSpinHamiltonian(Hmat, Mmat, Bfield)
+                Muref = np.einsum("ki,ckl,li->ci", np.conj(Uref), Mmat, Uref).real
+                assert_array_almost_equal(En[io, ib], Eref)
+                assert_array_almost_equal(Mu[io, ib], Muref)
+
+        En2, Mu2 = fieldSweepLevels(Hmat, Mmat, Bvalues)
+        assert_array_almost_equal(En2[0], En[0])
+        assert_array_almost_equal(Mu2[0], Mu[0])
+
+    def test_powderAverage(self):
+        for kind, npoints in [("lebedev", 110), ("lebedev", 26), ("design", 12), ("zcw", 12)]:
+            directions, weights = orientation_grid(kind, npoints, reduce_inversion=False)
+            self.assertAlmostEqual(np.sum(weights), 1.0)
+            assert_array_almost_equal(np.linalg.norm(directions, axis=1), np.ones(len(directions)))
+            second = np.einsum("n,ni,nj->ij", weights, directions, directions)
+            assert_array_almost_equal(second, np.identity(3) / 3, decimal=3)
+
+        directions, weights = orientation_grid("lebedev", 110)
+        self.assertEqual(len(directions), 55)
+        fourth = np.einsum("n,n->", weights, directions[:, 2] ** 4)
+        self.assertAlmostEqual(fourth, 0.2)
+
+        # isotropic S=1/2: no orientation dependence, Brillouin function
+        sys = SpinSystem()
+        sys.add("Cu", Spin(0.5))
+        Bvalues = np.array([0.5, 2.0, 7.0])
+        Temps = np.array([2.0, 20.0])
+        Mag = powder_magnetization(sys, Bvalues, Temps)
+        ref = 0.5 * ge * np.tanh(ge * muBcm * Bvalues[np.newaxis] / (2 * kBcm * Temps[:, np.newaxis]))
+        assert_array_almost_equal(Mag, ref)
+
+        # anisotropic case distributed over worker processes
+        sys = SpinSystem()
+        sp = Spin(1.5)
+        sp.set_ZF(ZFaxial=5.0, ZFrhombic=1.0)
+        sys.add("Co", sp)
+        serial = powder_magnetization(sys, Bvalues, Temps)
+        parallel = powder_magnetization(sys, Bvalues, Temps, nworkers=2)
+        assert_array_almost_equal(serial, parallel)
+
+        directions, weights = orientation_grid("zcw", 14)
+        assert_array_almost_equal(powder_magnetization(sys, Bvalues, Temps, directions, weights), serial, decimal=3)
+        # directions without weights are weighted equally
+        assert_array_almost_equal(powder_magnetization(sys, Bvalues, Temps, directions[:5]),
+                                  powder_magnetization(sys, Bvalues, Temps, directions[:5], np.full(5, 0.2)))
+
+    def test_getChiVV(self):
+        sys = SpinSystem()
+        sp = Spin(1.5)
+        sp.set_ZF(ZFaxial=5.0, ZFrhombic=1.0)
+        sys.add("Co", sp)
+        Hmat = sys.get_H_mat()
+        Mmat = sys.get_M_mat()
+        En, U = diagonalizeSpinHamiltonian(Hmat, Mmat)
+        MmatT = np.einsum("ki,ckl,lj->cij", np.conj(U), Mmat, U)
+
+        Temps = np.array([2.0, 10.0, 300.0])
+        ChiT = getChiVV(En, MmatT, None, Temps)
+        self.assertEqual(ChiT.shape, (3, 3, 3))
+        for it, T in enumerate(Temps):
+            fBoltz = getBoltzmannFactors(En - np.min(En), T)
+            assert_array_almost_equal(getChiVV(En, MmatT, fBoltz, T), ChiT[it])
+
+        # Curie law for a free spin S=3/2 at high temperature: chi*T = ChiVVCGS * g^2 S(S+1) / 3
+        sys = SpinSystem()
+        sys.add("free", Spin(1.5))
+        Mmat = sys.get_M_mat()
+        ChiT = getChiVV(np.zeros(4), Mmat, None, 300.0)
+        ge = -Mmat[2][0, 0] / 1.5
+        assert_array_almost_equal(ChiT, np.identity(3) * ChiVVCGS * ge**2 * 1.25)
+
+        with self.assertRaises(Exception):
+            getChiVV(En[:3], MmatT, None, Temps)
+
+    def test_magneticAxes(self):
+        sys = SpinSystem()
+        sp = Spin(2.5)
+        sp.set_ZF(ZFaxial=-10.0, ZFrhombic=2.0)
+        sp.set_g([2.1, 2.0, 1.9])
+        sys.add("Fe", sp)
+        Hmat = sys.get_H_mat()
+        Mmat = sys.get_M_mat()
+        En, U = diagonalizeSpinHamiltonian(Hmat, Mmat)
+        MmatT = np.einsum("ki,ckl,lj->cij", np.conj(U), Mmat, U)
+
+        Amat = np.zeros((3, 3))
+        for ii in range(3):
+            for jj in range(3):
+                Amat[ii, jj] = 0.5 * np.trace(np.matmul(MmatT[ii], MmatT[jj])).real
+        assert_array_almost_equal(gerlochMcMeekingTensor(MmatT), Amat)
+        assert_array_almost_equal(compute_A_matrix(MmatT[0], MmatT[1], MmatT[2], 6), Amat)
+
+        mu = kramersDoubletMoments(MmatT)
+        self.assertEqual(mu.shape, (3, 3, 2, 2))
+        Adia, Rmat, gdia = getMagneticAxesBatched(mu)
+        for k in range(3):
+            Aref, Rref = getMagneticAxes(MmatT[:, 2 * k : 2 * k + 2, 2 * k : 2 * k + 2])
+            assert_array_almost_equal(Adia[k], Aref)
+            assert_array_almost_equal(Rmat[k], Rref)
+            self.assertGreater(np.linalg.det(Rmat[k]), 0.0)
+
+        # the ground doublet is dominated by M_S = +-5/2 (prolate, g_z ~ 5 g_z(spin))
+        self.assertGreater(gdia[0, 2], 9.0)
+        self.assertLess(gdia[0, 0], 1.0)
+
+    def test_diagonalizeLowField(self):
+        Bvalues = np.array([0.01,0.1,0.5,2.])
+        direction = np.array([0.2,0.5,1.])/np.linalg.norm([0.2,0.5,1.])
+
+        # Kramers doublets of a single ion and degenerate multiplets of an isotropic dimer
+        ion = SpinSystem()
+        sp = Spin(2.5)
+        sp.set_ZF(ZFaxial=5.,ZFrhombic=1.)
+        sp.set_g([2.1,2.0,2.3])
+        ion.add("1",sp)
+        dimer = SpinSystem()
+        dimer.add("1",Spin(1.5))
+        dimer.add("2",Spin(1.0))
+        dimer.spins["1"].set_g([2.2,2.1,2.0])
+        dimer.set_interaction("1","2",20.)
+
+        for sys,nexact in [(ion,2),(dimer,0)]:
+            HMat = sys.get_H_mat()
+            MMat = sys.get_M_mat()
+            En,Mu,exact = diagonalizeLowField(HMat,MMat,Bvalues,direction)
+            Eref,Muref = fieldSweepLevels(HMat,MMat,Bvalues,direction)
+            self.assertEqual(np.sum(exact),nexact)
+            assert_array_almost_equal(En,Eref[0],decimal=5)
+            # moments along the field (the components perpendicular to it are not unique for degenerate levels)
+            assert_array_almost_equal(np.einsum("c,bci->bi",direction,Mu),
+                                      np.einsum("c,bci->bi",direction,Muref[0]),decimal=4)
+
+        # the error of the second-order energies is of third order in the field
+        HMat = ion.get_H_mat()
+        MMat = ion.get_M_mat()
+        En,_,_ = diagonalizeLowField(HMat,MMat,[0.01,0.1],direction)
+        Eref,_ = fieldSweepLevels(HMat,MMat,[0.01,0.1],direction)
+        error = np.max(np.abs(En-Eref[0]),axis=1)
+        self.assertGreater(error[1]/error[0],500.)
+
+    def test_adaptiveSweep(self):
+        sys = SpinSystem()
+        sp = Spin(1.0)
+        sp.set_ZF(ZFaxial=1.0)
+        sys.add("1",sp)
+        HMat = sys.get_H_mat()
+        MMat = sys.get_M_mat()
+
+        # along z, M_S = 0 and M_S = -1 cross at B = D/(g muB)
+        Bcross = 1.0/(ge*muBcm)
+        Bvalues,En,Mu,U = adaptive_field_sweep(HMat,MMat,0.,3.,minStep=1e-4)
+        self.assertLess(len(Bvalues),100)
+        steps = np.diff(Bvalues)
+        # the interval containing the crossing is refined down to the smallest step
+        assert_almost_equal(steps[np.searchsorted(Bvalues,Bcross)-1],np.min(steps))
+        self.assertGreater(np.max(steps),50*np.min(steps))
+
+        # level following: every column keeps its M_S (M_z = -g M_S) through the crossing
+        for En_ref,Mu_ref in zip(*fieldSweepLevels(HMat,MMat,Bvalues)):
+            assert_array_almost_equal(np.sort(En,axis=1),En_ref)
+        assert_array_almost_equal(Mu[:,2],np.tile(Mu[0,2],(len(Bvalues),1)))
+        self.assertLess(np.max(np.abs(np.diff(En,axis=0))),0.2)
+
+        angles,directions,En,Mu,U = adaptive_orientation_sweep(HMat,MMat,1.,[0.,0.,1.],[1.,0.,0.])
+        assert_array_almost_equal(directions[[0,-1]],[[0.,0.,1.],[1.,0.,0.]])
+        assert_almost_equal(angles[-1],0.5*np.pi)
+        assert_array_almost_equal(np.linalg.norm(directions,axis=1),np.ones(len(angles)))
+
+    def test_thermodynamics(self):
+        Temps = np.array([1.,10.,100.])
+
+        # two-level system: Schottky heat capacity and entropy
+        delta = 10.
+        props = thermodynamics([0.,delta],Temps)
+        x = delta/(kBcm*Temps)
+        assert_array_almost_equal(props.heat_capacity,x*x*np.exp(x)/(1.+np.exp(x))**2)
+        assert_array_almost_equal(props.entropy,np.log(1.+np.exp(-x))+x/(1.+np.exp(x)))
+        assert_array_almost_equal(props.partition_function,1.+np.exp(-x))
+
+        # S = 1/2 with g = 2 (moments -+1 along the field): Brillouin function
+        sys = SpinSystem()
+        sp = Spin(0.5)
+        sp.set_g([2.,2.,2.])
+        sys.add("1",sp)
+        Bvalues = np.array([0.,0.1,1.,5.])
+        En,Mu = fieldSweepLevels(sys.get_H_mat(),sys.get_M_mat(),Bvalues)
+        props = thermodynamics(En[0],Temps,Mu[0,:,2],Bvalues)
+        assert props.magnetization is not None and props.chi is not None
+        self.assertEqual(props.magnetization.shape,(3,4))
+        assert_array_almost_equal(props.magnetization,np.tanh(muBcm*Bvalues[np.newaxis]/(kBcm*Temps[:,np.newaxis])))
+        self.assertTrue(np.all(np.isnan(props.chi[:,0])))
+        assert_array_almost_equal(props.chi[:,1:],ChiCGS*props.magnetization[:,1:]/Bvalues[1:])
+
+        # no overflow or underflow for large splittings at low temperature
+        En = np.array([[-1e5,-1e5+1.,5e4],[0.,3e4,1e5]])
+        props = thermodynamics(En,[0.1,1.])
+        self.assertTrue(np.all(np.isfinite(props.logZ)))
+        assert_array_almost_equal(props.logZ[0],1e5/(kBcm*0.1)*np.array([1.,0.]))
+        assert_array_almost_equal(props.energy[1],[-1e5+1./(1.+np.exp(1./kBcm)),0.])
+        self.assertTrue(np.all(props.heat_capacity >= 0.))
+
+    def test_broadenSticks(self):
+        grid = np.linspace(0.,10.,2001)
+        rng = np.random.default_rng(7)
+        positions = rng.uniform(2.,8.,40)
+        intensities = rng.uniform(0.5,1.,40)
+        widths = rng.uniform(0.1,0.3,40)
+
+        for shape in ["gauss","lorentz"]:
+            direct = np.sum(intensities[:,np.newaxis]*np.array([line_shape(grid,[pos],width,shape)[0]
+                            for pos,width in zip(positions,widths)]),axis=0)
+            spectrum = broaden_sticks(grid,positions,intensities,widths,shape,width_tol=1e-3,margin=40.)
+            self.assertLess(np.max(np.abs(spectrum-direct)),1e-3*np.max(direct))
+
+        # the area is conserved and the derivative integrates to zero
+        spectrum = broaden_sticks(grid,positions,intensities,0.2,"gauss")
+        self.assertAlmostEqual(np.sum(spectrum)*(grid[1]-grid[0]),np.sum(intensities),places=6)
+        derivative = broaden_sticks(grid,positions,intensities,0.2,"gauss",derivative=True)
+        self.assertLess(np.max(np.abs(derivative-np.gradient(spectrum,grid))),1e-2*np.max(np.abs(derivative)))
+
+        # a descending grid gives the same (positive) spectrum in reversed order
+        assert_array_almost_equal(broaden_sticks(grid[::-1],positions,intensities,0.2,"gauss"),spectrum[::-1])
+        assert_array_almost_equal(broaden_sticks(grid[::-1],positions,intensities,0.2,"gauss",derivative=True),
+                                  derivative[::-1])
+
+        # Voigt profiles reduce to Gaussians for vanishing Lorentzian width
+        voigt = broaden_sticks(grid,positions,intensities,[1e-8,0.2],"voigt")
+        assert_array_almost_equal(voigt,spectrum)
+
 
 if __name__ == "__main__":
     unittest.main()
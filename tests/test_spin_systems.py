@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 
+import pickle
 import unittest
 
 import numpy as np
 from numpy.testing import assert_almost_equal, assert_array_almost_equal
 
-from koehnlab.spin_hamiltonians import Spin, SpinSystem, SpinType
+from koehnlab.spin_hamiltonians import Spin, SpinSystem, SpinType, diagonalizeSpinHamiltonian, muBcm
+from koehnlab.spin_hamiltonians import KambeBasis, clebsch_gordan, wigner_6j, ParametricHamiltonian
+from koehnlab.spin_hamiltonians import SpinHamiltonianFit, getChiVV
+from koehnlab.spin_hamiltonians import EigenfieldSolver, FieldSweepSolver, epr_spectrum, frequency_to_rcm
+from koehnlab.spin_hamiltonians.phys_const import ge
 
 
 class TestSpin(unittest.TestCase):
@@ -327,6 +332,318 @@ class TestSpin(unittest.TestCase):
         assert_almost_equal(HMat[4,3],0.136707311j)
         assert_almost_equal(HMat[11,11],2/15)
 
+    def test_RhombicExchange(self):
+        # Jrh is the rhombic part xx - yy of the exchange tensor
+        sys = SpinSystem()
+        sys.add("1",Spin(0.5))
+        sys.add("2",Spin(1.0))
+        sys.set_interaction("1","2",0.,0.,2.)
+
+        S1 = sys.spins["1"].get_spin_mat()
+        S2 = sys.spins["2"].get_spin_mat()
+        assert_array_almost_equal(sys.get_H_mat(),2.*(np.kron(S1[0],S2[0])-np.kron(S1[1],S2[1])))
+
+    def test_SparseAssembly(self):
+
+        sp1 = Spin(0.5)
+        sp2 = Spin(1.0)
+        sp3 = Spin(1.5)
+
+        sp2.set_ZF(ZFaxial=5.,ZFrhombic=1.)
+        isq2 = np.sqrt(0.5)
+        sp3.set_axes([[isq2,-isq2,0],[isq2,isq2,0],[0,0,1]])
+        sp3.set_g([2.1,2.0,1.9])
+
+        sys = SpinSystem()
+        sys.add("a",sp1)
+        sys.add("b",sp2)
+        sys.add("c",sp3)
+        sys.set_interaction("a","c",10.,2.,1.)
+        sys.set_interaction("c","b",-3.)
+
+        HMat = sys.get_H_mat()
+        assert_array_almost_equal(sys.get_sparse_H_mat().toarray(),HMat)
+        for dense,sparse in zip(sys.get_M_mat(),sys.get_sparse_M_mat()):
+            assert_array_almost_equal(sparse.toarray(),dense)
+        for dense,sparse in zip(sys.get_spin_mat(),sys.get_sparse_spin_mat()):
+            assert_array_almost_equal(sparse.toarray(),dense)
+
+        # the zero-field term only acts on the second center
+        ZFref = np.kron(np.kron(np.identity(2),sp2.get_ZF_mat()),np.identity(4))
+        sys.interaction = []
+        assert_array_almost_equal(sys.get_H_mat(),ZFref)
+
+        sys.max_dim = 10
+        with self.assertRaises(Exception):
+            sys.get_H_mat()
+        self.assertEqual(sys.get_sparse_H_mat().shape,(24,24))
+
+    def test_LowestStates(self):
+
+        sys = SpinSystem()
+        for idx in range(4):
+            sp = Spin(1.5)
+            sp.set_ZF(ZFaxial=5.,ZFrhombic=1.)
+            sys.add(str(idx),sp)
+        for idx in range(4):
+            sys.set_interaction(str(idx),str((idx+1)%4),10.,1.,0.5)
+
+        Bfield = np.array([0.3,0.2,1.0])
+        HMat = sys.get_H_mat()
+        MMat = sys.get_M_mat()
+
+        vec = np.linspace(-1.,1.,sys.dimension)+0.5j
+        HZ = HMat-muBcm*np.tensordot(Bfield,MMat,axes=1)
+        assert_array_almost_equal(sys.get_H_operator(Bfield).matvec(vec),np.matmul(HZ,vec))
+
+        En,U = diagonalizeSpinHamiltonian(HMat,MMat,Bfield)
+        Mexp = np.einsum("ki,ckl,li->ci",np.conj(U[:,:6]),MMat,U[:,:6])
+
+        En6,U6,M6 = sys.get_lowest_states(6,Bfield)
+        assert_array_almost_equal(En6,En[:6])
+        assert_array_almost_equal(np.diagonal(M6,axis1=1,axis2=2),Mexp)
+
+        # ferromagnetic ring of S=1/2: the quintet ground level is completed
+        sys = SpinSystem()
+        for idx in range(4):
+            sys.add(str(idx),Spin(0.5))
+        for idx in range(4):
+            sys.set_interaction(str(idx),str((idx+1)%4),-10.)
+        En,_ = diagonalizeSpinHamiltonian(sys.get_H_mat(),sys.get_M_mat(),None)
+        En5,U5,M5 = sys.get_lowest_states(2)
+        assert_array_almost_equal(En5,En[:5])
+        assert_array_almost_equal(np.sort(np.real(np.diagonal(M5[2]))),ge*np.arange(-2,3))
+
+    def test_ConservedBlocks(self):
+
+        def make_system(rhombic):
+            sys = SpinSystem()
+            for idx in range(3):
+                sp = Spin(1.0)
+                sp.set_ZF(ZFaxial=5.,ZFrhombic=rhombic)
+                sys.add(str(idx),sp)
+            sys.set_interaction("0","1",10.,1.)
+            sys.set_interaction("1","2",-4.)
+            return sys
+
+        sys = make_system(0.)
+        self.assertEqual([len(block) for block in sys.get_conserved_blocks([0.,0.,1.])],[1,3,6,7,6,3,1])
+        self.assertEqual(len(sys.get_conserved_blocks([1.,0.,0.])),1)
+        # rhombic terms couple M_S and M_S +- 2
+        self.assertEqual([len(block) for block in make_system(1.).get_conserved_blocks()],[13,14])
+
+        for sys,Bfield in [(make_system(0.),[0.,0.,1.5]),(make_system(1.),None),(make_system(1.),[0.5,0.,1.])]:
+            HMat = sys.get_H_mat()
+            MMat = sys.get_M_mat()
+            En,U = sys.diagonalize(Bfield)
+            Eref,_ = diagonalizeSpinHamiltonian(HMat,MMat,Bfield)
+            assert_array_almost_equal(En,Eref)
+            if Bfield is not None:
+                HMat = HMat-muBcm*np.tensordot(Bfield,MMat,axes=1)
+            assert_array_almost_equal(np.matmul(np.conj(U.T),np.matmul(HMat,U)),np.diag(En))
+
+    def test_KambeBasis(self):
+
+        assert_almost_equal(clebsch_gordan(0.5,0.5,0.5,-0.5,1,0),np.sqrt(0.5))
+        assert_almost_equal(clebsch_gordan(0.5,0.5,0.5,-0.5,0,0),np.sqrt(0.5))
+        assert_almost_equal(clebsch_gordan(1,1,0.5,-0.5,0.5,0.5),np.sqrt(2/3))
+        assert_almost_equal(wigner_6j(1,1,1,1,1,1),1/6)
+        assert_almost_equal(wigner_6j(0.5,0.5,1,0.5,0.5,0),0.5)
+
+        sys = SpinSystem()
+        for idx,S in enumerate([1.5,1.0,2.5,0.5]):
+            sys.add(str(idx),Spin(S))
+        sys.set_interaction("0","1",10.)
+        sys.set_interaction("1","2",-3.)
+        sys.set_interaction("2","0",4.)
+        sys.set_interaction("2","3",7.)
+
+        basis = KambeBasis(sys)
+        En,Svals,coeffs = basis.diagonalize()
+        self.assertEqual(int(np.sum(2*Svals+1)),sys.dimension)
+
+        HMat = sys.get_H_mat()
+        levels = np.concatenate([np.full(int(2*S+1),E) for E,S in zip(En,Svals)])
+        assert_array_almost_equal(np.sort(levels),np.linalg.eigvalsh(HMat))
+
+        vectors = basis.get_product_vectors(coeffs[:,0].toarray(),Svals[0])
+        assert_array_almost_equal(np.matmul(HMat,vectors),En[0]*vectors)
+        assert_array_almost_equal(np.matmul(vectors.T,vectors),np.identity(int(2*Svals[0]+1)))
+
+        # within the complete set of multiplets, the truncated treatment becomes exact
+        sys.spins["2"].set_ZF(ZFaxial=3.,ZFrhombic=0.5)
+        Bfield = [0.2,0.,0.5]
+        En,U = basis.diagonalize_truncated(len(Svals),Bfield)
+        Eref,_ = sys.diagonalize(Bfield)
+        assert_array_almost_equal(En,Eref)
+
+    def test_ParametricHamiltonian(self):
+
+        def make_system(J,Jax,Jrh,D,E,g):
+            sys = SpinSystem()
+            sp1 = Spin(1.5)
+            sp1.set_axes([[0.,0.,1.],[0.,1.,0.],[-1.,0.,0.]])
+            sp1.set_ZF(ZFaxial=D,ZFrhombic=E)
+            sp1.set_g(g)
+            sys.add("1",sp1)
+            sp2 = Spin(1.0)
+            sp2.set_ZF(ZFaxial=-2.,ZFrhombic=0.3)
+            sys.add("2",sp2)
+            sys.add("3",Spin(0.5))
+            sys.set_interaction("1","2",J,Jax,Jrh)
+            sys.set_interaction("2","3",-5.)
+            return sys
+
+        par = ParametricHamiltonian(make_system(10.,1.,0.5,3.,0.4,[2.1,2.0,2.3]))
+        self.assertEqual(len(par.names),2*3+2*2+3*3)
+        # every parameter has only the operator it enters (H for exchange and zero-field, M for g)
+        self.assertEqual(par.Hops.shape,(2*3+2*2,)+2*(par.dimension,))
+        self.assertEqual(par.Mops.shape,(3*3,3)+2*(par.dimension,))
+        self.assertEqual(sorted(np.concatenate((par.Hidx,par.Midx))),list(range(len(par.names))))
+        self.assertAlmostEqual(par.values[par.index("Jrh(1,2)")],0.5)
+        self.assertAlmostEqual(par.values[par.index("gz(1)")],2.3)
+
+        params = [(10.,1.,0.5,3.,0.4,[2.1,2.0,2.3]),(-4.,0.,-1.,-2.,0.5,[1.9,2.2,2.0])]
+        grid = np.tile(par.values,(len(params),1))
+        for row,(J,Jax,Jrh,D,E,g) in enumerate(params):
+            for name,value in zip(["J(1,2)","Jax(1,2)","Jrh(1,2)","D(1)","E(1)","gx(1)","gy(1)","gz(1)"],
+                                  [J,Jax,Jrh,D,E]+g):
+                grid[row,par.index(name)] = value
+
+        Bfield = [0.3,-0.2,1.1]
+        En = par.scan(grid,Bfield,batch_size=1)
+        for row,args in enumerate(params):
+            sys = make_system(*args)
+            assert_array_almost_equal(par.get_H(grid[row]),sys.get_H_mat())
+            assert_array_almost_equal(par.get_M(grid[row]),sys.get_M_mat())
+            Eref,_ = diagonalizeSpinHamiltonian(sys.get_H_mat(),sys.get_M_mat(),Bfield)
+            assert_array_almost_equal(En[row],Eref)
+
+        # frozen parameters end up in the constant part
+        sub = ParametricHamiltonian(make_system(*params[0]),["J(1,2)","D(1)"])
+        grid = sub.make_grid({"J(1,2)": [-4.,10.], "D(1)": [3.,-2.]})
+        self.assertEqual(grid.shape,(4,2))
+        assert_array_almost_equal(sub.get_H(grid[2]),make_system(*params[0]).get_H_mat())
+
+    def test_SpinHamiltonianFit(self):
+
+        def make_system(J,D,gz):
+            sys = SpinSystem()
+            sp1 = Spin(1.0)
+            sp1.set_ZF(ZFaxial=D,ZFrhombic=0.5)
+            sp1.set_g([2.1,2.1,gz])
+            sys.add("1",sp1)
+            sys.add("2",Spin(1.5))
+            sys.set_interaction("1","2",J,0.5)
+            return sys
+
+        Temps = np.array([2.,5.,20.,100.,300.])
+        Bvalues = np.array([0.5,2.,5.])
+        directions = [[0.,0.,1.],[1.,0.,0.],[0.,1.,0.]]
+        weights = np.full(3,1./3.)
+
+        # synthetic data from the reference parameters
+        ref = ParametricHamiltonian(make_system(-3.,4.,2.1),["J(1,2)","D(1)","gz(1)"])
+        data = SpinHamiltonianFit(ref,chiT=(Temps,np.ones(len(Temps))),
+                                  magnetization=(Bvalues,Temps[:2],np.ones((2,3))),
+                                  directions=directions,weights=weights)
+        chiT,grad = data.chiT(ref.values)
+        Mag,_ = data.magnetization(ref.values)
+
+        En,U = np.linalg.eigh(ref.get_H())
+        MmatT = np.matmul(np.conj(U.T),np.matmul(ref.get_M(),U))
+        assert_array_almost_equal(chiT,np.trace(getChiVV(En,MmatT,None,Temps),axis1=1,axis2=2)/3.)
+
+        # analytic against numerical gradients
+        par = ParametricHamiltonian(make_system(-1.,2.,2.0),["J(1,2)","D(1)","gz(1)"])
+        fit = SpinHamiltonianFit(par,chiT=(Temps,chiT),magnetization=(Bvalues,Temps[:2],Mag),
+                                 directions=directions,weights=weights)
+        jac = fit.jacobian(par.values)
+        for k in range(len(par.values)):
+            step = np.zeros(len(par.values))
+            step[k] = 1e-5
+            numerical = (fit.residuals(par.values+step)-fit.residuals(par.values-step))/2e-5
+            assert_array_almost_equal(jac[:,k],numerical,decimal=6)
+
+        result = fit.fit()
+        assert_array_almost_equal(result.x,ref.values,decimal=4)
+        assert_array_almost_equal(par.values,result.x)
+
+        # directions without weights are weighted equally, weights are normalized
+        fit_equal = SpinHamiltonianFit(par,magnetization=(Bvalues,Temps[:2],Mag),directions=directions)
+        assert_array_almost_equal(fit_equal.weights,weights)
+        fit_scaled = SpinHamiltonianFit(par,magnetization=(Bvalues,Temps[:2],Mag),directions=directions,
+                                        weights=[2.,2.,2.])
+        assert_array_almost_equal(fit_scaled.magnetization(par.values)[0],fit_equal.magnetization(par.values)[0])
+        with self.assertRaises(Exception):
+            SpinHamiltonianFit(par,magnetization=(Bvalues,Temps[:2],Mag),directions=directions,weights=[1.,1.])
+
+    def test_EigenfieldEPR(self):
+
+        sys = SpinSystem()
+        sp = Spin(0.5)
+        sp.set_g([2.0,2.0,2.2])
+        sys.add("1",sp)
+        hv = frequency_to_rcm(9.5)
+
+        solver = EigenfieldSolver(sys.get_H_mat(),sys.get_M_mat())
+        fields,intensities = solver.transitions([0.,0.,1.],9.5)
+        assert_array_almost_equal(fields,[hv/(2.2*muBcm)])
+        # |<+|M_x|->|^2 = g_perp^2/4, divided by |dE/dB| = g_par
+        assert_array_almost_equal(intensities,[0.5*(1.+1.)*0.25*4./2.2])
+
+        sys = SpinSystem()
+        sp = Spin(1.0)
+        sp.set_ZF(ZFaxial=0.1,ZFrhombic=0.01)
+        sys.add("1",sp)
+        sys.add("2",Spin(0.5))
+        sys.set_interaction("1","2",0.05)
+        HMat = sys.get_H_mat()
+        MMat = sys.get_M_mat()
+        direction = np.array([0.3,0.5,0.8])/np.linalg.norm([0.3,0.5,0.8])
+
+        fields,intensities = EigenfieldSolver(HMat,MMat).transitions(direction,9.5,Temp=5.,Bmax=1.)
+        self.assertTrue(np.all(intensities > 0.))
+        for B in fields:
+            En,_ = diagonalizeSpinHamiltonian(HMat,MMat,B*direction)
+            self.assertAlmostEqual(np.min(np.abs(En[:,np.newaxis]-En[np.newaxis,:]-hv)),0.)
+
+        # worker processes only receive the matrices; the superoperators are rebuilt there
+        solver = EigenfieldSolver(HMat,MMat)
+        solver.fields(direction,9.5)
+        copy = pickle.loads(pickle.dumps(solver))
+        self.assertIsNone(copy._superops)
+        assert_array_almost_equal(copy.fields(direction,9.5,Bmax=1.),fields)
+
+        # the field sweep finds the same resonances, including pairs within one grid step
+        sweep_fields,sweep_intensities = FieldSweepSolver(HMat,MMat).transitions(direction,9.5,Temp=5.,Bmax=1.)
+        assert_array_almost_equal(sweep_fields,fields,decimal=7)
+        assert_array_almost_equal(sweep_intensities,intensities)
+        assert_array_almost_equal(FieldSweepSolver(HMat,MMat,nfields=8).fields(direction,9.5,1.),fields,decimal=7)
+
+        sys.add("3",Spin(2.5))
+        with self.assertRaises(Exception):
+            EigenfieldSolver(sys.get_H_mat(),sys.get_M_mat())
+        # larger systems fall back to the field sweep
+        Bgrid = np.linspace(0.,0.5,501)
+        spectrum = epr_spectrum(sys,9.5,Bgrid,0.01,directions=[direction],weights=[1.])
+        self.assertTrue(np.all(np.isfinite(spectrum)) and np.max(spectrum) > 0.)
+
+        # powder spectrum of an isotropic doublet peaks at the g = 2 resonance
+        sys = SpinSystem()
+        sp = Spin(0.5)
+        sp.set_g([2.0,2.0,2.0])
+        sys.add("1",sp)
+        Bgrid = np.linspace(0.3,0.38,801)
+        spectrum = epr_spectrum(sys,9.5,Bgrid,0.002,directions=[[0.,0.,1.]],weights=[1.])
+        self.assertAlmostEqual(Bgrid[np.argmax(spectrum)],hv/(2.*muBcm),places=4)
+        assert_almost_equal(np.sum(spectrum)*(Bgrid[1]-Bgrid[0]),0.5,decimal=3)
+
+        # the first-derivative spectrum is the exact derivative of the broadened absorption
+        derivative = epr_spectrum(sys,9.5,Bgrid,0.002,directions=[[0.,0.,1.]],weights=[1.],derivative=True)
+        assert_array_almost_equal(derivative[1:-1]/np.max(derivative),
+                                  np.gradient(spectrum,Bgrid)[1:-1]/np.max(derivative),decimal=2)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -7,8 +7,12 @@ from koehnlab.utilities import (
     proxySort,
     getMainElements,
     compositeSort,
+    collectFiles,
 )
 
+import os
+import tempfile
+
 import numpy as np
 
 
@@ -62,5 +66,26 @@ class TestUtilities(unittest.TestCase):
         )
 
 
+    def test_collectFiles(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            os.makedirs(os.path.join(tmpDir, "sub"))
+            for name in ["a.xyz", "b.txt", os.path.join("sub", "c.xyz")]:
+                open(os.path.join(tmpDir, name), "w").close()
+
+            self.assertEqual(
+                [os.path.relpath(f, tmpDir) for f in collectFiles([tmpDir], "*.xyz")],
+                ["a.xyz", os.path.join("sub", "c.xyz")],
+            )
+            self.assertEqual(
+                [os.path.relpath(f, tmpDir) for f in collectFiles([os.path.join(tmpDir, "*.txt"), os.path.join(tmpDir, "a.xyz")])],
+                ["a.xyz", "b.txt"],
+            )
+            self.assertEqual(
+                [os.path.relpath(f, tmpDir) for f in collectFiles([tmpDir], ["c.*", "*.txt"])],
+                ["b.txt", os.path.join("sub", "c.xyz")],
+            )
+            self.assertEqual(collectFiles([os.path.join(tmpDir, "missing")]), [])
+
+
 if __name__ == "__main__":
     unittest.main()